@@ -6,6 +6,10 @@ import data_processor
 import model_trainer
 import data_inference_collector
 import data_inference_downloader
+import download_index
+
+# The UI process is the only one watching the image tree, the worker processes rely on the hooks
+download_index.get_download_index(watch=True)
 
 tab1, tab2, tab3, tab4, tab5, tab6, tab7, tab8 = st.tabs([
     "Tab 1", 
@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import asyncio
+import threading
+import aiohttp
+import catalog_search
+import rate_limiter
+
+
+STREAM_CHUNK_SIZE = 1 << 16
+
+
+def make_async_job(download_request, job_id=None):
+    '''
+    Turn a prepared sentinelhub DownloadRequest (SenHub(...).request.download_list[0]) into an engine job
+    args:
+        download_request: a sentinelhub DownloadRequest with its data_folder set
+        job_id: optional identifier reported back with the result
+    return:
+        job: a dictionary with the url, payload, headers and the paths the response is streamed to
+    '''
+    request_path, response_path = download_request.get_storage_paths()
+    return {
+        'job_id': job_id if job_id is not None else response_path,
+        'url': download_request.url,
+        'payload': download_request.post_values,
+        'headers': dict(download_request.headers),
+        'request_params': download_request.get_request_params(),
+        'request_path': request_path,
+        'response_path': response_path,
+    }
+
+
+class AsyncDownloadEngine:
+    '''
+    asyncio engine for Sentinel Hub catalog searches and process API downloads.
+    A fixed pool of worker coroutines reads jobs from a bounded queue, so producers wait whenever
+    the queue is full. Every request goes through an AdaptiveConcurrencyController, which decides
+    how many are in flight and backs off on 429 and 5xx. The engine has its own controller, starting
+    at and capped by max_concurrency, so the AIMD limit never holds the engine below the number of
+    sockets it opens. Response bodies are streamed to disk chunk by chunk and never held in memory.
+    '''
+    def __init__(self, session_manager, max_concurrency=16, queue_size=None, controller=None, timeout=None):
+        self.session_manager = session_manager
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size if queue_size is not None else 2 * max_concurrency
+        if controller is None:
+            controller = rate_limiter.AdaptiveConcurrencyController(initial_limit=max_concurrency, max_limit=max_concurrency)
+        self.controller = controller
+        if timeout is None:
+            timeout = session_manager.config.download_timeout_seconds
+        self.timeout = timeout
+        self.stats = {'requests': 0, 'done': 0, 'failed': 0, 'skipped': 0, 'retries': 0, 'throttled': 0, 'bytes': 0}
+
+    def make_client_session(self):
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, ttl_dns_cache=300)
+        return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def get_headers(self, headers=None):
+        # The token refresh is a blocking call guarded by a thread lock, keep it off the event loop
+        token = await asyncio.to_thread(lambda: self.session_manager.token)
+        return {**(headers or {}), 'Authorization': 'Bearer ' + token}
+
+    async def post(self, client_session, url, payload, headers, handle_response):
+        '''
+        POST under the concurrency controller, retrying 429 and 5xx with its backoff and Retry-After pauses.
+        handle_response is awaited with the first good response.
+        '''
+        for attempt in range(self.controller.max_retries + 1):
+            request_headers = await self.get_headers(headers)
+            await self.controller.acquire_async()
+            start = time.time()
+            try:
+                self.controller.count('calls')
+                self.stats['requests'] += 1
+                async with client_session.post(url, json=payload, headers=request_headers) as response:
+                    status = response.status
+                    if status not in rate_limiter.RETRY_STATUS_CODES:
+                        response.raise_for_status()
+                        result = await handle_response(response)
+                    else:
+                        retry_after = rate_limiter.parse_retry_after(response.headers.get('Retry-After'))
+            finally:
+                self.controller.release()
+            if status not in rate_limiter.RETRY_STATUS_CODES:
+                self.controller.on_success(time.time() - start, issued_at=start)
+                return result
+            if status == 429:
+                self.stats['throttled'] += 1
+            self.controller.on_throttle(status, retry_after, issued_at=start)
+            if attempt == self.controller.max_retries:
+                break
+            self.controller.count('retries')
+            self.stats['retries'] += 1
+            await asyncio.sleep(retry_after if retry_after is not None else self.controller.get_backoff(attempt))
+        raise rate_limiter.RetryableResponseError(status, 'after retries')
+
+    async def stream_to_file(self, response, response_path):
+        temp_path = response_path + '.tmp'
+        os.makedirs(os.path.dirname(response_path), exist_ok=True)
+        size = 0
+        try:
+            with open(temp_path, 'wb') as f:
+                async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+                    f.write(chunk)
+                    size += len(chunk)
+        except BaseException:
+            # A connection dropped mid-body would otherwise leave the partial file beside the response
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        os.replace(temp_path, response_path)
+        self.stats['bytes'] += size
+        return size
+
+    async def download_job(self, client_session, job, redownload=False):
+        '''
+        Download one job to its response path, the request parameters are saved beside it
+        like sentinelhub does
+        '''
+        start = time.time()
+        result = {'job_id': job['job_id'], 'response_path': job['response_path'], 'status': 'done', 'size': 0, 'error': None}
+        try:
+            if os.path.exists(job['response_path']) and not redownload:
+                result['status'] = 'skipped'
+            else:
+                result['size'] = await self.post(
+                    client_session, job['url'], job['payload'], job['headers'],
+                    lambda response: self.stream_to_file(response, job['response_path']),
+                )
+                if job['request_path'] is not None:
+                    with open(job['request_path'], 'w') as f:
+                        json.dump(job['request_params'], f, indent=2)
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = e
+        result['elapsed'] = time.time() - start
+        self.stats[result['status']] += 1
+        return result
+
+    async def download_jobs(self, jobs, redownload=False, progress_callback=None):
+        '''
+        Download every job through the bounded queue
+        args:
+            jobs: an iterable of jobs from make_async_job, consumed lazily in a worker thread so a
+                generator preparing the jobs (sqlite, file system) does not block the event loop
+            redownload: download again responses that already exist on disk
+            progress_callback: optional function called with (result, finished_count), an exception
+                it raises stops the download and is raised here
+        return:
+            results: the job results in job order
+        '''
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        results = {}
+        done = object()
+
+        async def worker(client_session):
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                position, job = item
+                results[position] = await self.download_job(client_session, job, redownload)
+                if progress_callback is not None:
+                    progress_callback(results[position], len(results))
+
+        async def producer(n_workers):
+            iterator = iter(jobs)
+            position = 0
+            while True:
+                job = await asyncio.to_thread(next, iterator, done)
+                if job is done:
+                    break
+                # Blocks while the queue is full, which bounds the memory held by pending jobs
+                await queue.put((position, job))
+                position += 1
+            for _ in range(n_workers):
+                await queue.put(None)
+
+        async with self.make_client_session() as client_session:
+            tasks = [asyncio.create_task(worker(client_session)) for _ in range(self.max_concurrency)]
+            tasks.append(asyncio.create_task(producer(self.max_concurrency)))
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # Without its workers the producer would wait on the full queue forever
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        return [results[position] for position in sorted(results)]
+
+    async def search_catalog(self, client_session, payload, url=catalog_search.CATALOG_SEARCH_URL):
+        '''
+        Async version of catalog_search.search_catalog, following the pagination
+        '''
+        features = []
+        payload = dict(payload)
+        payload['limit'] = catalog_search.CATALOG_PAGE_LIMIT
+        while True:
+            response_json = await self.post(client_session, url, payload, {'Content-Type': 'application/json'}, lambda response: response.json())
+            features.extend(response_json['features'])
+            next_token = response_json.get('context', {}).get('next')
+            if next_token is None:
+                return features
+            payload['next'] = next_token
+
+    async def search_catalogs(self, payloads, url=catalog_search.CATALOG_SEARCH_URL):
+        '''
+        Run many catalog searches concurrently, at most max_concurrency at a time and within
+        the limit of the concurrency controller
+        '''
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def search(client_session, payload):
+            async with semaphore:
+                return await self.search_catalog(client_session, payload, url)
+
+        async with self.make_client_session() as client_session:
+            return await asyncio.gather(*[search(client_session, payload) for payload in payloads])
+
+
+def run_sync(coroutine):
+    '''
+    Run a coroutine from synchronous code. When the calling thread already runs an event loop
+    (e.g. a notebook) the coroutine runs in a separate thread with its own loop.
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    result = {}
+
+    def runner():
+        try:
+            result['value'] = asyncio.run(coroutine)
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=runner)
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+def download_jobs(session_manager, jobs, redownload=False, max_concurrency=16, progress_callback=None):
+    '''
+    Synchronous facade of AsyncDownloadEngine.download_jobs
+    '''
+    engine = AsyncDownloadEngine(session_manager, max_concurrency=max_concurrency)
+    return run_sync(engine.download_jobs(jobs, redownload=redownload, progress_callback=progress_callback))
+
+
+def search_catalogs(session_manager, payloads, max_concurrency=16):
+    '''
+    Synchronous facade of AsyncDownloadEngine.search_catalogs
+    '''
+    engine = AsyncDownloadEngine(session_manager, max_concurrency=max_concurrency)
+    return run_sync(engine.search_catalogs(payloads))
@@ -0,0 +1,248 @@
+import os
+import re
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import rasterio
+import evalscript_registry
+import download_index
+import spectral_indices
+import training_matrix
+
+
+NETWORKS = ['FCOVER', 'LAI', 'CAB']
+INPUT_BANDS = ['B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12']
+ANGLE_NAMES = ['viewZenithMean', 'viewAzimuthMean', 'sunZenithAngles', 'sunAzimuthAngles']
+# Sentinel-2 is close to nadir, these stand in for the per-scene view angles when they are not known.
+# The relative azimuth only enters through its cosine and the view zenith through a narrow normalisation range.
+DEFAULT_VIEW_ANGLES = {'viewZenithMean': 5.0, 'viewAzimuthMean': 105.0}
+# Local mean solar time of the Sentinel-2 descending node, used when only the date is known
+OVERPASS_SOLAR_HOURS = 10.5
+DEFAULT_CHUNK_SIZE = 256 * 1024
+
+NUMBER = r'[-+]?\d*\.?\d+(?:[eE][-+]?\d+)?'
+
+_NETWORKS = {}
+
+
+def parse_sum(expression):
+    '''
+    Parse a 'bias + w1 * x1 - w2 * x2 ...' expression of the evalscripts into (bias, {input: weight})
+    '''
+    expression = re.sub(r'\s+', '', expression)
+    expression = expression.replace('+-', '-').replace('-+', '-').replace('--', '+')
+    bias = 0.0
+    weights = {}
+    for value, name in re.findall(rf'({NUMBER})(?:\*(\w+))?', expression):
+        if name:
+            weights[name] = float(value)
+        else:
+            bias += float(value)
+    return bias, weights
+
+
+def load_network(name):
+    '''
+    Read the weights of a biophysical network from its evalscript, so the NumPy port and the
+    server always run the same coefficients. Parsed once per process and evalscript version.
+    return:
+        network: a dictionary with the input normalisation ranges, the hidden layer weights (5, 11)
+            and biases (5,), the output layer weights (5,) and bias, the output range and scale
+    '''
+    if name not in NETWORKS:
+        raise ValueError(f'Unknown network {name}, expected one of {NETWORKS}')
+    script_hash = evalscript_registry.get_evalscript_hash(name)
+    if (name, script_hash) in _NETWORKS:
+        return _NETWORKS[(name, script_hash)]
+    script = evalscript_registry.get_evalscript(name)
+    inputs = [band.lower() for band in INPUT_BANDS] + ['viewZen', 'sunZen', 'relAzim']
+    ranges = {}
+    for variable, low, high in re.findall(rf'var (\w+)_norm\s*=\s*normalize\(.*?,\s*({NUMBER}),\s*({NUMBER})\);', script):
+        ranges[variable] = (float(low), float(high))
+    hidden_weights = np.zeros((5, len(inputs)))
+    hidden_biases = np.zeros(5)
+    for i in range(5):
+        body = re.search(rf'function neuron{i + 1}\(.*?\)\s*{{\s*var sum\s*=(.*?);', script, re.S).group(1)
+        hidden_biases[i], weights = parse_sum(body)
+        for j, variable in enumerate(inputs):
+            hidden_weights[i, j] = weights.get(f'{variable}_norm', 0.0)
+    body = re.search(r'function layer2\(.*?\)\s*{\s*var sum\s*=(.*?);', script, re.S).group(1)
+    output_bias, weights = parse_sum(body)
+    output_weights = np.array([weights.get(f'neuron{i + 1}', 0.0) for i in range(5)])
+    low, high = re.search(rf'denormalize\(l2,\s*({NUMBER}),\s*({NUMBER})\)', script).groups()
+    scale = re.search(rf'default:\s*\[\s*\w+\s*/\s*({NUMBER})\s*\]', script)
+    network = {
+        'input_ranges': [ranges[variable] for variable in inputs[:-1]],
+        'hidden_weights': hidden_weights,
+        'hidden_biases': hidden_biases,
+        'output_weights': output_weights,
+        'output_bias': output_bias,
+        'output_range': (float(low), float(high)),
+        'output_scale': 1.0 if scale is None else 1.0 / float(scale.group(1)),
+    }
+    _NETWORKS[(name, script_hash)] = network
+    return network
+
+
+def normalize(values, low, high):
+    return 2 * (values - low) / (high - low) - 1
+
+
+def get_sun_angles(date, longitudes, latitudes):
+    '''
+    Sun zenith and azimuth in degrees from the NOAA solar position equations
+    args:
+        date: a datetime of the acquisition in UTC, e.g. from catalog_search, or a YYYY-MM-DD date,
+            in which case the Sentinel-2 overpass time is assumed
+        longitudes, latitudes: arrays of pixel coordinates in degrees
+    return:
+        sun_zenith, sun_azimuth: arrays with the shape of the coordinates
+    '''
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    if isinstance(date, str):
+        date = datetime.datetime.fromisoformat(date.replace('Z', '+00:00'))
+    if not isinstance(date, datetime.datetime):
+        date = datetime.datetime(date.year, date.month, date.day)
+    day_of_year = date.timetuple().tm_yday
+    if date.hour == 0 and date.minute == 0 and date.second == 0:
+        utc_hours = OVERPASS_SOLAR_HOURS - longitudes / 15
+    else:
+        utc_hours = np.full_like(longitudes, date.hour + date.minute / 60 + date.second / 3600)
+    gamma = 2 * np.pi / 365 * (day_of_year - 1 + (utc_hours - 12) / 24)
+    equation_of_time = 229.18 * (0.000075 + 0.001868 * np.cos(gamma) - 0.032077 * np.sin(gamma) - 0.014615 * np.cos(2 * gamma) - 0.040849 * np.sin(2 * gamma))
+    declination = 0.006918 - 0.399912 * np.cos(gamma) + 0.070257 * np.sin(gamma) - 0.006758 * np.cos(2 * gamma) + 0.000907 * np.sin(2 * gamma) - 0.002697 * np.cos(3 * gamma) + 0.00148 * np.sin(3 * gamma)
+    solar_minutes = utc_hours * 60 + equation_of_time + 4 * longitudes
+    hour_angle = np.radians(solar_minutes / 4 - 180)
+    latitudes = np.radians(latitudes)
+    cos_zenith = np.sin(latitudes) * np.sin(declination) + np.cos(latitudes) * np.cos(declination) * np.cos(hour_angle)
+    zenith = np.arccos(np.clip(cos_zenith, -1, 1))
+    azimuth = np.degrees(np.arctan2(np.sin(hour_angle), np.cos(hour_angle) * np.sin(latitudes) - np.tan(declination) * np.cos(latitudes))) + 180
+    return np.degrees(zenith), np.mod(azimuth, 360)
+
+
+def run_network(name, bands, angles):
+    '''
+    Evaluate a network on arrays of pixels, the vectorized equivalent of evaluatePixel
+    args:
+        name: FCOVER, LAI or CAB
+        bands: a dictionary of band name -> reflectance array, at least the INPUT_BANDS
+        angles: a dictionary of ANGLE_NAMES -> degrees, arrays or scalars broadcastable to the bands
+    return:
+        values: a float32 array with the shape of the bands
+    '''
+    network = load_network(name)
+    shape = np.shape(bands[INPUT_BANDS[0]])
+    inputs = [bands[band] for band in INPUT_BANDS]
+    inputs.append(np.cos(np.radians(angles['viewZenithMean'])))
+    inputs.append(np.cos(np.radians(angles['sunZenithAngles'])))
+    normalized = [normalize(np.broadcast_to(values, shape).astype(np.float64).ravel(), low, high) for values, (low, high) in zip(inputs, network['input_ranges'])]
+    relative_azimuth = np.cos(np.radians(np.asarray(angles['sunAzimuthAngles'], dtype=np.float64) - np.asarray(angles['viewAzimuthMean'], dtype=np.float64)))
+    normalized.append(np.broadcast_to(relative_azimuth, shape).ravel())
+    hidden = np.tanh(np.stack(normalized, axis=1) @ network['hidden_weights'].T + network['hidden_biases'])
+    output = hidden @ network['output_weights'] + network['output_bias']
+    low, high = network['output_range']
+    values = (0.5 * (output + 1) * (high - low) + low) * network['output_scale']
+    return values.astype(np.float32).reshape(shape)
+
+
+def run_network_chunked(name, bands, angles, chunk_size=DEFAULT_CHUNK_SIZE, max_workers=None):
+    '''
+    run_network over flat pixel arrays in chunks spread across threads, NumPy releases the GIL
+    in the matrix products so the chunks run on all the cores
+    args:
+        bands: a dictionary of band name -> 1-d reflectance array
+        angles: a dictionary of ANGLE_NAMES -> scalars or 1-d arrays aligned with the bands
+    '''
+    n_pixels = len(bands[INPUT_BANDS[0]])
+    values = np.empty(n_pixels, dtype=np.float32)
+
+    def run_chunk(start):
+        chunk = slice(start, min(start + chunk_size, n_pixels))
+        chunk_angles = {key: value if np.ndim(value) == 0 else value[chunk] for key, value in angles.items()}
+        values[chunk] = run_network(name, {band: bands[band][chunk] for band in INPUT_BANDS}, chunk_angles)
+
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count() or 1) as executor:
+        list(executor.map(run_chunk, range(0, n_pixels, chunk_size)))
+    return values
+
+
+def get_angles(img, window, date, view_angles=None):
+    '''
+    Per-pixel angles of a window of an ALL raster: the sun angles from the pixel coordinates and the
+    acquisition date, the view angles from view_angles or DEFAULT_VIEW_ANGLES
+    '''
+    longitudes, latitudes = training_matrix.get_window_coordinates(img.transform, window)
+    sun_zenith, sun_azimuth = get_sun_angles(date, longitudes, latitudes)
+    angles = dict(DEFAULT_VIEW_ANGLES)
+    angles.update(view_angles or {})
+    angles['sunZenithAngles'] = sun_zenith
+    angles['sunAzimuthAngles'] = sun_azimuth
+    return angles
+
+
+def compute_network_raster(response_path, name, date, view_angles=None, max_window_bytes=training_matrix.DEFAULT_MAX_WINDOW_BYTES,
+                           chunk_size=DEFAULT_CHUNK_SIZE, max_workers=None, overwrite=False):
+    '''
+    Compute FCOVER, LAI or CAB from an ALL response instead of requesting it, and cache it beside the
+    response like the spectral_indices products, where download_index lists it under the network name.
+    No-data pixels, all their input bands at 0, are NaN like in the spectral_indices products.
+    args:
+        response_path: the path of an ALL response
+        name: FCOVER, LAI or CAB
+        date: the acquisition datetime, or its date (see get_sun_angles)
+        view_angles: optional dictionary with viewZenithMean and viewAzimuthMean in degrees
+    return:
+        product_path: the path of the float32 GeoTIFF
+    '''
+    product_path = spectral_indices.get_product_path(response_path, name)
+    if not overwrite and spectral_indices.is_product_fresh(response_path, product_path):
+        return product_path
+    os.makedirs(os.path.dirname(product_path), exist_ok=True)
+    band_indexes = [spectral_indices.BANDS_NAMES.index(band) + 1 for band in INPUT_BANDS]
+    with rasterio.open(response_path) as img:
+        if img.count != len(spectral_indices.BANDS_NAMES):
+            raise Exception(f'{response_path} has {img.count} bands, expected the {len(spectral_indices.BANDS_NAMES)} bands of the ALL evalscript')
+        profile = {'driver': 'GTiff', 'width': img.width, 'height': img.height, 'crs': img.crs, 'transform': img.transform, 'compress': 'deflate'}
+        with rasterio.open(product_path + '.tmp', 'w', count=1, dtype='float32', nodata=np.nan, **profile) as output:
+            for window in training_matrix.get_row_windows(img, max_window_bytes):
+                values = img.read(band_indexes, window=window).astype(np.float32)
+                bands = {band: band_values.ravel() for band, band_values in zip(INPUT_BANDS, values)}
+                angles = get_angles(img, window, date, view_angles)
+                result = run_network_chunked(name, bands, angles, chunk_size=chunk_size, max_workers=max_workers)
+                result[np.all(values == 0, axis=0).ravel()] = np.nan
+                output.write(result.reshape(values.shape[1:]), 1, window=window)
+    os.replace(product_path + '.tmp', product_path)
+    download_index.record_product(product_path)
+    return product_path
+
+
+def read_product(product_path):
+    with rasterio.open(product_path) as img:
+        return img.read(1)
+
+
+def compare_with_server(response_path, server_response_path, name, date, view_angles=None):
+    '''
+    Check the local network against a response the server computed for the same bbox and date
+    args:
+        response_path: the path of the ALL response
+        server_response_path: the path of the FCOVER, LAI or CAB response of the same request
+    return:
+        report: a dictionary with the mean and max absolute error, the RMSE, the correlation and
+            the share of pixels within 0.01 of the server value
+    '''
+    local_values = read_product(compute_network_raster(response_path, name, date, view_angles=view_angles)).astype(np.float64).ravel()
+    server_values = read_product(server_response_path).astype(np.float64).ravel()
+    if local_values.shape != server_values.shape:
+        raise Exception(f'The local {name} has {local_values.size} pixels, the server one {server_values.size}')
+    valid = np.isfinite(local_values) & np.isfinite(server_values)
+    errors = local_values[valid] - server_values[valid]
+    return {
+        'pixels': int(valid.sum()),
+        'mean_absolute_error': float(np.mean(np.abs(errors))),
+        'max_absolute_error': float(np.max(np.abs(errors))),
+        'rmse': float(np.sqrt(np.mean(errors ** 2))),
+        'correlation': float(np.corrcoef(local_values[valid], server_values[valid])[0, 1]),
+        'within_0.01': float(np.mean(np.abs(errors) <= 0.01)),
+    }
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+import jsonlines as jsonl
+
+
+DEFAULT_CACHE_PATH = './cache/cached_dates/catalog.sqlite'
+LEGACY_JSONL_PATH = './cache/cached_dates/cached_dates.jsonl'
+BBOX_DECIMALS = 6
+
+
+def get_bbox_hash(bbox):
+    '''
+    Hash a bounding box after rounding it, so the same box computed twice
+    with slightly different float noise maps to the same key
+    args:
+        bbox: [min_x, min_y, max_x, max_y]
+    return:
+        bbox_hash: a hex digest of the rounded bounding box
+    '''
+    rounded = [round(float(value), BBOX_DECIMALS) for value in bbox]
+    return hashlib.sha1(json.dumps(rounded).encode()).hexdigest()
+
+
+def get_entry_key(bbox, start_date, end_date):
+    return f'{get_bbox_hash(bbox)}_{start_date}_{end_date}'
+
+
+class CatalogCache:
+    '''
+    Indexed local store of catalog search results.
+    Entries are keyed by a bbox hash and date range, writes are deduplicated,
+    entries can expire after a TTL and a cached query over a longer period answers
+    a shorter one of the same bbox.
+    '''
+    def __init__(self, path=DEFAULT_CACHE_PATH, ttl=None, legacy_jsonl_path=LEGACY_JSONL_PATH):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        is_new = not os.path.exists(path)
+        self.create_tables()
+        if is_new and legacy_jsonl_path is not None and os.path.exists(legacy_jsonl_path):
+            self.import_jsonl(legacy_jsonl_path)
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create_tables(self):
+        with self.connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS catalog_entries (
+                    key TEXT PRIMARY KEY,
+                    bbox_hash TEXT,
+                    min_x REAL, min_y REAL, max_x REAL, max_y REAL,
+                    start_date TEXT, end_date TEXT,
+                    dates TEXT,
+                    fetched_at REAL
+                )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS catalog_entries_extent ON catalog_entries (min_x, min_y, max_x, max_y)')
+            conn.execute('CREATE INDEX IF NOT EXISTS catalog_entries_period ON catalog_entries (start_date, end_date)')
+            conn.execute('CREATE INDEX IF NOT EXISTS catalog_entries_bbox_hash ON catalog_entries (bbox_hash, start_date, end_date)')
+
+    def import_jsonl(self, jsonl_path):
+        '''
+        Import the entries of the old append-only cached_dates.jsonl, keeping one entry per key
+        '''
+        with jsonl.open(jsonl_path, mode='r') as reader:
+            for entry in reader:
+                self.put(entry['bbox'], entry['start_date'], entry['end_date'], entry['dates'])
+
+    def is_fresh(self, fetched_at):
+        return self.ttl is None or time.time() - fetched_at <= self.ttl
+
+    def put(self, bbox, start_date, end_date, dates):
+        '''
+        Store the dates of a catalog query, replacing any previous entry for the same key
+        '''
+        key = get_entry_key(bbox, start_date, end_date)
+        row = (key, get_bbox_hash(bbox), *[float(value) for value in bbox], start_date, end_date, json.dumps(dates), time.time())
+        with self.lock, self.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO catalog_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+
+    def get_exact(self, bbox, start_date, end_date):
+        '''
+        Primary key lookup of a query
+        '''
+        key = get_entry_key(bbox, start_date, end_date)
+        with self.connect() as conn:
+            row = conn.execute('SELECT dates, fetched_at FROM catalog_entries WHERE key = ?', (key,)).fetchone()
+        if row is None or not self.is_fresh(row[1]):
+            return None
+        return json.loads(row[0])
+
+    def get_containing(self, bbox, start_date, end_date):
+        '''
+        Answer a query from a cached query of the same bbox over a period containing it.
+        The dates of the longer query are filtered down to the requested period.
+        A larger bbox cannot answer a smaller one: only dates are stored, not the footprints
+        of the acquisitions, and a date covering part of the larger bbox may miss the smaller one.
+        '''
+        with self.connect() as conn:
+            rows = conn.execute('''
+                SELECT dates, fetched_at FROM catalog_entries
+                WHERE bbox_hash = ? AND start_date <= ? AND end_date >= ?
+                ORDER BY fetched_at DESC''', (get_bbox_hash(bbox), start_date, end_date)).fetchall()
+        for dates, fetched_at in rows:
+            if self.is_fresh(fetched_at):
+                dates = json.loads(dates)
+                return [date for date in dates if start_date <= date[:10] <= end_date]
+        return None
+
+    def get(self, bbox, start_date, end_date, allow_containment=True):
+        '''
+        Get the cached dates of a query, or None when the query has to go to the API
+        args:
+            bbox: the bounding box of the area of interest
+            start_date: the start date of the time period
+            end_date: the end date of the time period
+            allow_containment: whether a cached query of the same bbox over a longer period may answer this one
+        return:
+            dates: a list of dates or None
+        '''
+        dates = self.get_exact(bbox, start_date, end_date)
+        if dates is None and allow_containment:
+            dates = self.get_containing(bbox, start_date, end_date)
+        return dates
+
+    def purge_expired(self):
+        '''
+        Delete the entries older than the TTL
+        '''
+        if self.ttl is None:
+            return 0
+        with self.lock, self.connect() as conn:
+            cursor = conn.execute('DELETE FROM catalog_entries WHERE fetched_at < ?', (time.time() - self.ttl,))
+            return cursor.rowcount
+
+
+_CATALOG_CACHE = None
+
+
+def get_catalog_cache():
+    '''
+    Get the default catalog cache of the project
+    '''
+    global _CATALOG_CACHE
+    if _CATALOG_CACHE is None:
+        _CATALOG_CACHE = CatalogCache()
+    return _CATALOG_CACHE
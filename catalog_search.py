@@ -0,0 +1,121 @@
+import geopandas as gpd
+import shapely.geometry
+import catalog_cache
+import rate_limiter
+
+
+CATALOG_SEARCH_URL = 'https://services.sentinel-hub.com/api/v1/catalog/search'
+CATALOG_PAGE_LIMIT = 100
+
+
+def search_catalog(session, headers, payload, url=CATALOG_SEARCH_URL):
+    '''
+    Run a catalog search and follow its pagination until every page has been read
+    args:
+        session: a requests session (or the requests module)
+        headers: the request headers, including the Authorization header
+        payload: the search body, without the next token
+        url: the catalog search url
+    return:
+        features: the features of all the pages
+    '''
+    features = []
+    payload = dict(payload)
+    payload['limit'] = CATALOG_PAGE_LIMIT
+    while True:
+        response = rate_limiter.get_controller().call(session.post, url, headers=headers, json=payload)
+        response.raise_for_status()
+        response_json = response.json()
+        features.extend(response_json['features'])
+        next_token = response_json.get('context', {}).get('next')
+        if next_token is None:
+            return features
+        payload['next'] = next_token
+
+
+def get_footprints_gdf(features):
+    '''
+    Turn catalog features into a geodataframe of tile footprints and acquisition dates
+    args:
+        features: catalog features with geometry and properties.datetime
+    return:
+        footprints: a geodataframe with a date column
+    '''
+    geometry = [shapely.geometry.shape(feature['geometry']) for feature in features]
+    dates = [feature['properties']['datetime'][:10] for feature in features]
+    footprints = gpd.GeoDataFrame({'date': dates}, geometry=geometry, crs='EPSG:4326')
+    return footprints
+
+
+def assign_dates_to_squares(squares_gdf, footprints):
+    '''
+    Assign acquisition dates to each square by intersecting it with the tile footprints
+    args:
+        squares_gdf: a geodataframe of squares in EPSG:4326
+        footprints: the geodataframe returned by get_footprints_gdf
+    return:
+        square_dates: a dictionary of square index -> list of dates, newest first
+    '''
+    square_dates = {index: set() for index in squares_gdf.index}
+    if len(footprints) > 0:
+        joined = gpd.sjoin(squares_gdf[['geometry']], footprints, how='inner', predicate='intersects')
+        for index, date in zip(joined.index, joined['date']):
+            square_dates[index].add(date)
+    return {index: sorted(dates, reverse=True) for index, dates in square_dates.items()}
+
+
+def get_available_dates_for_squares(squares_gdf, start_year, end_year, session, token, collection='sentinel-2-l2a', cache=None):
+    '''
+    Get the available dates of many squares with one paginated catalog query over their union footprint.
+    Squares that are already cached for every year are not queried, and the result of each
+    square is stored in the catalog cache year by year.
+    args:
+        squares_gdf: a geodataframe of squares
+        start_year: the first year of the range
+        end_year: the last year of the range (inclusive)
+        session: a requests session used for the catalog calls
+        token: the SentinelHub API token
+        collection: the catalog collection to search
+        cache: the CatalogCache to use, defaults to the project catalog cache
+    return:
+        square_dates: a dictionary of square index -> {year: list of dates}
+    '''
+    if cache is None:
+        cache = catalog_cache.get_catalog_cache()
+    squares_gdf = squares_gdf.to_crs(crs='EPSG:4326')
+    years = [str(year) for year in range(int(start_year), int(end_year) + 1)]
+    square_dates = {}
+    missing = []
+    for index, polygon in zip(squares_gdf.index, squares_gdf.geometry):
+        bounds = list(polygon.bounds)
+        cached = {year: cache.get(bounds, f'{year}-01-01', f'{year}-12-31') for year in years}
+        if all(dates is not None for dates in cached.values()):
+            square_dates[index] = cached
+        else:
+            missing.append(index)
+    if len(missing) == 0:
+        return square_dates
+
+    missing_gdf = squares_gdf.loc[missing]
+    footprint = missing_gdf.unary_union
+    headers = {
+        'Content-Type': 'application/json',
+        'Authorization': 'Bearer ' + token,
+    }
+    payload = {
+        'collections': [collection],
+        'datetime': f'{years[0]}-01-01T00:00:00Z/{years[-1]}-12-31T23:59:59Z',
+        'intersects': shapely.geometry.mapping(footprint),
+        'fields': {'include': ['id', 'geometry', 'properties.datetime'], 'exclude': []},
+    }
+    features = search_catalog(session, headers, payload)
+    footprints = get_footprints_gdf(features)
+    assigned = assign_dates_to_squares(missing_gdf, footprints)
+    for index, polygon in zip(missing_gdf.index, missing_gdf.geometry):
+        bounds = list(polygon.bounds)
+        square_dates[index] = {}
+        for year in years:
+            dates = [date for date in assigned[index] if date.startswith(year)]
+            cache.put(bounds, f'{year}-01-01', f'{year}-12-31', dates)
+            square_dates[index][year] = dates
+    return square_dates
@@ -0,0 +1,178 @@
+import threading
+import numpy as np
+from sentinelhub import BBox, CRS, bbox_to_dimensions
+import download_scheduler
+
+
+PROBE_RESOLUTION = 160
+FULL_RESOLUTION = 10
+# A pixel is cloudy above this CLP probability, and a date is overcast above this share of cloudy pixels
+CLOUD_PROBABILITY_THRESHOLD = 0.4
+CLOUD_COVER_THRESHOLD = 0.3
+# Uncompressed bytes per pixel of the outputs of each evalscript, used to size the requests a probe avoids
+OUTPUT_BYTES_PER_PIXEL = {
+    'ALL': 13 * 4,
+    'CLP': 4,
+    'FCOVER': 4,
+    'LAI': 4,
+    'CAB': 4,
+    'NDVI': 4,
+    'TRUECOLOR': 3,
+}
+
+
+def estimate_response_bytes(polygon, evalscripts, resolution=FULL_RESOLUTION):
+    '''
+    Size of the responses of a bbox at a resolution, before compression
+    args:
+        polygon: the shapely polygon of the request
+        evalscripts: an evalscript name or a list of them, e.g. the outputs of a COMBINED request
+        resolution: the resolution in meters
+    '''
+    if isinstance(evalscripts, str):
+        evalscripts = [evalscripts]
+    width, height = bbox_to_dimensions(BBox(bbox=list(polygon.bounds), crs=CRS.WGS84), resolution=resolution)
+    return int(width * height * sum(OUTPUT_BYTES_PER_PIXEL.get(evalscript, 4) for evalscript in evalscripts))
+
+
+def get_cloud_cover(clp, cloud_probability_threshold=CLOUD_PROBABILITY_THRESHOLD):
+    '''
+    Share of the pixels of a CLP image above the cloud probability threshold, and the mean probability
+    '''
+    clp = np.asarray(clp, dtype=np.float32)
+    return float(np.mean(clp > cloud_probability_threshold)), float(np.mean(clp))
+
+
+def probe_with_sentinelhub(job, resolution=PROBE_RESOLUTION):
+    '''
+    Default probe, returns (clp, downloaded) where downloaded is False when the probe came from the raster cache
+    '''
+    import new_app
+    clp, _, downloaded = new_app.probe_cloud_cover_from_sentinelhub(job['polygon'], job['date'], job['location'], resolution=resolution)
+    return clp, downloaded
+
+
+class CloudGate:
+    '''
+    Download policy probing the cloud probability of a date at a coarse resolution before the
+    full-resolution requests. Overcast dates are skipped, or deferred so the caller can fall back
+    to the least cloudy of them. Keeps count of the requests and bytes it saved, net of the probes
+    that were actually sent. probe_fn takes a job and returns (clp, downloaded) like probe_with_sentinelhub.
+    '''
+    def __init__(self, cloud_cover_threshold=CLOUD_COVER_THRESHOLD, cloud_probability_threshold=CLOUD_PROBABILITY_THRESHOLD,
+                 probe_resolution=PROBE_RESOLUTION, full_resolution=FULL_RESOLUTION, probe_fn=None, mode='skip'):
+        if mode not in ['skip', 'defer']:
+            raise ValueError(f'Invalid mode {mode}, expected skip or defer')
+        self.cloud_cover_threshold = cloud_cover_threshold
+        self.cloud_probability_threshold = cloud_probability_threshold
+        self.probe_resolution = probe_resolution
+        self.full_resolution = full_resolution
+        self.probe_fn = probe_fn
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.probes = {}
+        self.stats = {
+            'probe_requests': 0,
+            'probe_bytes': 0,
+            'probe_failures': 0,
+            'requests_kept': 0,
+            'requests_skipped': 0,
+            'requests_deferred': 0,
+            'bytes_kept': 0,
+            'bytes_skipped': 0,
+            'bytes_deferred': 0,
+        }
+
+    def probe_job(self, job):
+        if self.probe_fn is not None:
+            clp, downloaded = self.probe_fn(job)
+        else:
+            clp, downloaded = probe_with_sentinelhub(job, resolution=self.probe_resolution)
+        cloud_cover, mean_clp = get_cloud_cover(clp, self.cloud_probability_threshold)
+        probe = {'cloud_cover': cloud_cover, 'mean_clp': mean_clp, 'overcast': cloud_cover > self.cloud_cover_threshold}
+        return probe, downloaded
+
+    def probe(self, polygon, dates, location, max_workers=8, progress_callback=None):
+        '''
+        Probe the cloud cover of several dates of an area, each date once
+        return:
+            probes: a dictionary of date -> {'cloud_cover', 'mean_clp', 'overcast'}, None when the probe failed
+        '''
+        with self.lock:
+            pending = sorted(set(date for date in dates if (location, date) not in self.probes))
+        jobs = [download_scheduler.make_download_job(polygon, date, 'CLP_PROBE', location) for date in pending]
+        results = download_scheduler.run_download_jobs(jobs, download_fn=self.probe_job, max_workers=max_workers, progress_callback=progress_callback)
+        with self.lock:
+            for job_result in results:
+                if job_result['status'] == 'failed':
+                    self.stats['probe_failures'] += 1
+                    continue
+                probe, downloaded = job_result['result']
+                # Only the probes sent and received cost a request, cached ones are free
+                if downloaded:
+                    self.stats['probe_requests'] += 1
+                    self.stats['probe_bytes'] += estimate_response_bytes(job_result['job']['polygon'], 'CLP', self.probe_resolution)
+                self.probes[(location, job_result['job']['date'])] = probe
+            return {date: self.probes.get((location, date)) for date in dates}
+
+    def plan(self, jobs, evalscripts=None, max_workers=8):
+        '''
+        Split download jobs into the ones to run and the ones of overcast dates.
+        A date whose probe failed is downloaded, the gate never loses a date it could not check.
+        args:
+            jobs: download_scheduler jobs
+            evalscripts: the outputs of COMBINED jobs, used to size them
+        return:
+            plan: a dictionary with the 'download' jobs, the 'skipped' or 'deferred' jobs sorted from the least
+                cloudy, and the 'probes' of every date
+        '''
+        jobs_by_location = {}
+        for job in jobs:
+            jobs_by_location.setdefault(job['location'], []).append(job)
+        probes = {}
+        for location, location_jobs in jobs_by_location.items():
+            location_probes = self.probe(location_jobs[0]['polygon'], [job['date'] for job in location_jobs], location, max_workers=max_workers)
+            probes.update({(location, date): probe for date, probe in location_probes.items()})
+        outcome = 'skipped' if self.mode == 'skip' else 'deferred'
+        kept, gated = [], []
+        with self.lock:
+            for job in jobs:
+                probe = probes[(job['location'], job['date'])]
+                job_evalscripts = evalscripts if job['evalscript'] == 'COMBINED' and evalscripts is not None else job['evalscript']
+                job_bytes = estimate_response_bytes(job['polygon'], job_evalscripts, self.full_resolution)
+                if probe is not None and probe['overcast']:
+                    gated.append(job)
+                    self.stats[f'requests_{outcome}'] += 1
+                    self.stats[f'bytes_{outcome}'] += job_bytes
+                else:
+                    kept.append(job)
+                    self.stats['requests_kept'] += 1
+                    self.stats['bytes_kept'] += job_bytes
+        gated.sort(key=lambda job: probes[(job['location'], job['date'])]['cloud_cover'])
+        plan = {'download': kept, 'probes': {f'{location}/{date}': probe for (location, date), probe in probes.items()}}
+        plan[outcome] = gated
+        return plan
+
+    def record_deferred_download(self, job, evalscripts=None):
+        '''
+        Count a deferred job the caller ended up downloading as a fallback
+        '''
+        job_evalscripts = evalscripts if job['evalscript'] == 'COMBINED' and evalscripts is not None else job['evalscript']
+        job_bytes = estimate_response_bytes(job['polygon'], job_evalscripts, self.full_resolution)
+        with self.lock:
+            self.stats['requests_deferred'] -= 1
+            self.stats['bytes_deferred'] -= job_bytes
+            self.stats['requests_kept'] += 1
+            self.stats['bytes_kept'] += job_bytes
+
+    def get_report(self):
+        '''
+        Requests and bytes saved so far, net of the probes. Deferred jobs that were never downloaded count as saved.
+        '''
+        with self.lock:
+            report = dict(self.stats)
+        avoided_requests = report['requests_skipped'] + report['requests_deferred']
+        avoided_bytes = report['bytes_skipped'] + report['bytes_deferred']
+        report['requests_saved'] = avoided_requests - report['probe_requests']
+        report['bytes_saved'] = avoided_bytes - report['probe_bytes']
+        return report
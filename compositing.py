@@ -0,0 +1,233 @@
+import os
+import warnings
+import numpy as np
+import rasterio
+import pixel_table
+import training_matrix
+import spectral_indices
+import download_scheduler
+import streaming_pipeline
+
+
+COMPOSITES_DIR = './data/composites'
+METHODS = ['median', 'mean', 'max_ndvi']
+# s2cloudless probability above which a pixel is treated as cloudy, scripts/clp.js returns CLP / 255
+CLOUD_THRESHOLD = 0.4
+MONTHS = list(range(1, 13))
+
+
+def get_composite_dir(location, year, method='median', cloud_threshold=CLOUD_THRESHOLD, composites_dir=COMPOSITES_DIR):
+    return os.path.join(composites_dir, location, str(year), f'{method}_clp{int(round(cloud_threshold * 100))}')
+
+
+def get_month_date(year, month):
+    '''
+    Name of a monthly composite, the first day of the month so the <band>_<YYYY-MM-DD> columns
+    of the pixel tables and training matrices keep working
+    '''
+    return f'{int(year)}-{int(month):02d}-01'
+
+
+def group_dates_by_month(dates, year, months=MONTHS):
+    dates_by_month = {month: [] for month in months}
+    for date in sorted(set(dates)):
+        if int(date[:4]) == int(year) and int(date[5:7]) in dates_by_month:
+            dates_by_month[int(date[5:7])].append(date)
+    return dates_by_month
+
+
+def composite_window(bands, clp, method='median', cloud_threshold=CLOUD_THRESHOLD):
+    '''
+    Reduce a stack of acquisitions of the same pixels to one value per pixel and band
+    args:
+        bands: a (n_dates, 13, height, width) float32 array of ALL bands
+        clp: a (n_dates, height, width) array of cloud probabilities between 0 and 1
+        method: 'median' or 'mean' of the clear acquisitions, or 'max_ndvi' to keep the clear
+            acquisition with the highest NDVI, which keeps the bands of one date together
+        cloud_threshold: the cloud probability above which an acquisition of a pixel is masked
+    return:
+        composite: a (13, height, width) float32 array, NaN where no acquisition is clear
+        clear_count: a (height, width) uint16 array of the clear acquisitions of each pixel
+    '''
+    if method not in METHODS:
+        raise ValueError(f'Invalid method {method}, expected one of {METHODS}')
+    # Pixels outside the swath come back as 0 in every band
+    clear = (clp <= cloud_threshold) & np.any(bands != 0, axis=1)
+    clear_count = clear.sum(axis=0).astype(np.uint16)
+    if method == 'max_ndvi':
+        red = bands[:, spectral_indices.BANDS_NAMES.index('B04')]
+        nir = bands[:, spectral_indices.BANDS_NAMES.index('B08')]
+        ndvi = spectral_indices.normalized_difference(nir, red)
+        ndvi[~clear | np.isnan(ndvi)] = -np.inf
+        best = np.argmax(ndvi, axis=0)
+        composite = np.take_along_axis(bands, best[np.newaxis, np.newaxis], axis=0)[0]
+    else:
+        masked = np.where(clear[:, np.newaxis], bands, np.nan)
+        with warnings.catch_warnings():
+            # All-NaN pixels are the fully cloudy ones, they stay NaN
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            composite = np.nanmedian(masked, axis=0) if method == 'median' else np.nanmean(masked, axis=0)
+    composite = composite.astype(np.float32, copy=False)
+    composite[:, clear_count == 0] = np.nan
+    return composite, clear_count
+
+
+def write_empty_composite(grid, output_path, count_path):
+    '''
+    Month without any acquisition, written as NaN so every cube has the same months
+    '''
+    profile = {'driver': 'GTiff', 'width': grid['width'], 'height': grid['height'], 'crs': grid['crs'], 'transform': rasterio.Affine(*grid['transform']), 'compress': 'deflate'}
+    with rasterio.open(output_path + '.tmp', 'w', count=len(spectral_indices.BANDS_NAMES), dtype='float32', nodata=np.nan, **profile) as output:
+        output.write(np.full((len(spectral_indices.BANDS_NAMES), grid['height'], grid['width']), np.nan, dtype=np.float32))
+    with rasterio.open(count_path + '.tmp', 'w', count=1, dtype='uint16', **profile) as output:
+        output.write(np.zeros((1, grid['height'], grid['width']), dtype=np.uint16))
+    os.replace(output_path + '.tmp', output_path)
+    os.replace(count_path + '.tmp', count_path)
+
+
+def composite_month(all_paths, clp_paths, output_path, method='median', cloud_threshold=CLOUD_THRESHOLD,
+                    max_window_bytes=training_matrix.DEFAULT_MAX_WINDOW_BYTES):
+    '''
+    Composite the acquisitions of one month window by window, only one window of every date is in memory
+    args:
+        all_paths: the ALL responses of the month
+        clp_paths: the CLP responses of the same dates, in the same order
+        output_path: the 13-band float32 GeoTIFF to write, an ALL-like raster spectral_indices and
+            biophysical can read. The clear acquisition counts go to <output_path>_count.tif.
+        max_window_bytes: the memory ceiling of the window of all the dates together
+    return:
+        output_path
+    '''
+    count_path = os.path.splitext(output_path)[0] + '_count.tif'
+    imgs = [rasterio.open(path) for path in all_paths]
+    clps = [rasterio.open(path) for path in clp_paths]
+    try:
+        grid = pixel_table.get_grid(imgs[0])
+        for img in imgs[1:] + clps:
+            if (img.width, img.height) != (grid['width'], grid['height']):
+                raise Exception(f'{img.name} is not on the grid of {imgs[0].name}')
+        profile = {'driver': 'GTiff', 'width': grid['width'], 'height': grid['height'], 'crs': imgs[0].crs, 'transform': imgs[0].transform, 'compress': 'deflate'}
+        # The stack of every date is in memory at once, the windows shrink with the number of dates
+        windows = training_matrix.get_row_windows(imgs[0], max(1, max_window_bytes // (len(imgs) * 2)))
+        with rasterio.open(output_path + '.tmp', 'w', count=imgs[0].count, dtype='float32', nodata=np.nan, **profile) as output, \
+                rasterio.open(count_path + '.tmp', 'w', count=1, dtype='uint16', **profile) as count_output:
+            for window in windows:
+                bands = np.stack([img.read(window=window).astype(np.float32) for img in imgs])
+                clp = np.stack([img.read(1, window=window).astype(np.float32) for img in clps])
+                composite, clear_count = composite_window(bands, clp, method, cloud_threshold)
+                output.write(composite, window=window)
+                count_output.write(clear_count, 1, window=window)
+    finally:
+        for img in imgs + clps:
+            img.close()
+    os.replace(output_path + '.tmp', output_path)
+    os.replace(count_path + '.tmp', count_path)
+    return output_path
+
+
+def download_acquisitions(polygon, location, dates, download_fn=None, max_workers=8, progress_callback=None):
+    '''
+    Make sure the ALL and CLP responses of every date are on disk, through the raster cache
+    return:
+        response_paths: a dictionary of (date, evalscript) -> response path, dates that failed are left out
+        failed_dates: the dates with a failed download
+    '''
+    if download_fn is None:
+        download_fn = streaming_pipeline.download_response_with_sentinelhub
+    jobs = [download_scheduler.make_download_job(polygon, date, evalscript, location) for date in dates for evalscript in ['ALL', 'CLP']]
+    results = download_scheduler.run_download_jobs(jobs, download_fn=download_fn, max_workers=max_workers, progress_callback=progress_callback)
+    response_paths = {}
+    failed_dates = set()
+    for job_result in results:
+        if job_result['status'] == 'done':
+            response_paths[(job_result['job']['date'], job_result['job']['evalscript'])] = job_result['result'][0]
+        else:
+            failed_dates.add(job_result['job']['date'])
+    return response_paths, failed_dates
+
+
+def build_composite_cube(polygon, location, year, dates=None, months=MONTHS, method='median', cloud_threshold=CLOUD_THRESHOLD,
+                         download_fn=None, max_workers=8, max_window_bytes=training_matrix.DEFAULT_MAX_WINDOW_BYTES, overwrite=False):
+    '''
+    Build the monthly cloud-free composites of a square for a year from every available acquisition,
+    instead of a handful of hardcoded dates. The cube has the same months whatever the clouds:
+    a month without any clear acquisition, or without any acquisition in the catalog, is all NaN.
+    A month with a failed download is not written, so the next call retries it, and an exception
+    listing those months is raised once the other months are written.
+    args:
+        polygon: the polygon of the square
+        location: the location name the responses and composites are filed under
+        year: the year of the cube
+        dates: the acquisition dates, defaults to the catalog dates of the year
+        months: the months of the cube
+        method: see composite_window
+        cloud_threshold: see composite_window
+        download_fn: the download function of the jobs, see download_acquisitions
+    return:
+        cube: a dictionary of month date (YYYY-MM-01) -> composite path, ready for
+            training_matrix.build_training_matrix
+    '''
+    if dates is None:
+        import new_app
+        dates = new_app.get_available_dates_from_sentinelhub(polygon, year=str(year))
+    output_dir = get_composite_dir(location, year, method, cloud_threshold)
+    os.makedirs(output_dir, exist_ok=True)
+    dates_by_month = group_dates_by_month(dates, year, months)
+    cube = {get_month_date(year, month): os.path.join(output_dir, f'{get_month_date(year, month)}.tif') for month in months}
+    pending = [month for month in months if overwrite or not os.path.exists(cube[get_month_date(year, month)])]
+    pending_dates = [date for month in pending for date in dates_by_month[month]]
+    response_paths, failed_dates = download_acquisitions(polygon, location, pending_dates, download_fn=download_fn, max_workers=max_workers)
+    grid = None
+    empty_months = []
+    failed_months = []
+    for month in pending:
+        output_path = cube[get_month_date(year, month)]
+        month_dates = dates_by_month[month]
+        if len(month_dates) == 0:
+            empty_months.append(month)
+            continue
+        if any(date in failed_dates for date in month_dates):
+            # A composite of part of the month would be cached as if it were complete
+            failed_months.append(month)
+            continue
+        all_paths = [response_paths[(date, 'ALL')] for date in month_dates]
+        clp_paths = [response_paths[(date, 'CLP')] for date in month_dates]
+        composite_month(all_paths, clp_paths, output_path, method, cloud_threshold, max_window_bytes)
+        if grid is None:
+            with rasterio.open(output_path) as img:
+                grid = pixel_table.get_grid(img)
+    if len(empty_months) > 0:
+        if grid is None:
+            existing = [path for path in cube.values() if os.path.exists(path)]
+            if len(existing) == 0:
+                raise Exception(f'No acquisition of {location} could be downloaded for {year}, failed months: {failed_months}')
+            with rasterio.open(existing[0]) as img:
+                grid = pixel_table.get_grid(img)
+        for month in empty_months:
+            output_path = cube[get_month_date(year, month)]
+            write_empty_composite(grid, output_path, os.path.splitext(output_path)[0] + '_count.tif')
+    if len(failed_months) > 0:
+        raise Exception(f'Downloads of {location} failed for the months {failed_months} of {year}, call again to retry them')
+    return cube
+
+
+def fill_composite_gaps(table, months_dates):
+    '''
+    Fill the NaN of the composite columns of a pixel table, which the trainers cannot take.
+    A pixel without any clear acquisition in a month, or a month without acquisitions, is
+    interpolated from the neighbouring months of the same band, and the nearest month is repeated
+    at the ends of the year. Pixels never clear in the year are set to 0, the no-data value of
+    the ALL rasters.
+    args:
+        table: a pixel table with <band>_<YYYY-MM-01> columns, filled in place
+        months_dates: the month dates of the columns, see get_month_date
+    return:
+        table
+    '''
+    for band in spectral_indices.BANDS_NAMES:
+        columns = [f'{band}_{month_date}' for month_date in sorted(months_dates) if f'{band}_{month_date}' in table.columns]
+        if len(columns) == 0:
+            continue
+        values = table[columns].interpolate(axis=1, limit_direction='both')
+        table[columns] = values.fillna(0).astype(np.float32)
+    return table
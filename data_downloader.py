@@ -7,6 +7,8 @@ import shapely.geometry
 import geopandas as gpd
 import datetime
 import new_app
+import download_scheduler
+import cloud_gate
 import numpy as np
 import matplotlib.pyplot as plt
 import pickle
@@ -137,17 +139,29 @@ def date_selection_logic(gdf):
     return date
 
 
-def get_dictionary_of_images_from_evalscripts(total_polygon, date, location_name):
-    eval_true_color = 'TRUECOLOR'
+def get_dictionary_of_images_from_evalscripts(total_polygon, date, location_name, combined=False):
     eval_CLP = 'CLP'
-    eval_FCOVER = 'FCOVER'
     eval_all = 'ALL'
-    eval_ndvi = 'NDVI'
-    all, all_dir = new_app.get_any_image_from_sentinelhub(total_polygon, date, eval_all, location_name)
-    tc, tc_dir = new_app.get_any_image_from_sentinelhub(total_polygon, date, eval_true_color, location_name)
-    clp, clp_dir = new_app.get_any_image_from_sentinelhub(total_polygon, date, eval_CLP, location_name)
-    fcover, fcover_dir = new_app.get_any_image_from_sentinelhub(total_polygon, date, eval_FCOVER, location_name)
-    ndvi, ndvi_dir = new_app.get_any_image_from_sentinelhub(total_polygon, date, eval_ndvi, location_name)
+    evalscripts = [eval_all, eval_CLP]
+    # True colour, NDVI and FCOVER are computed locally from the ALL bands instead of requested
+    products = ['TRUECOLOR', 'NDVI']
+    networks = ['FCOVER']
+    if combined:
+        images = new_app.get_combined_images_from_sentinelhub(total_polygon, date, location_name, evalscripts=evalscripts, products=products, networks=networks)
+        results = [{'result': images[evalscript]} for evalscript in evalscripts]
+    else:
+        jobs = [download_scheduler.make_download_job(total_polygon, date, evalscript, location_name) for evalscript in evalscripts]
+        results = download_scheduler.run_download_jobs(jobs, max_workers=len(jobs))
+        for job_result in results:
+            if job_result['status'] == 'failed':
+                raise Exception(f'Download failed for {job_result["job_id"]}: {job_result["error"]}')
+        images = new_app.get_product_images_from_sentinelhub(total_polygon, date, products, location_name)
+        images.update(new_app.get_biophysical_images_from_sentinelhub(total_polygon, date, networks, location_name))
+    all, all_dir = results[0]['result']
+    clp, clp_dir = results[1]['result']
+    fcover, fcover_dir = images['FCOVER']
+    tc, tc_dir = images['TRUECOLOR']
+    ndvi, ndvi_dir = images['NDVI']
     images_dict = {
         'all': all,
         'all_dir': all_dir,
@@ -172,7 +186,7 @@ def download_images_logic(total_polygon, date, location_name, gdf):
         clp = images_dict['clp']
         fcover = images_dict['fcover']
         st.write(f'CLP Average Value: {np.mean(clp)}')
-        st.write(f'FCOVER Average Value: {np.mean(fcover)}')
+        st.write(f'FCOVER Average Value: {np.nanmean(fcover)}')
         st.write(f'True Color Image Downloaded to: {tc_dir}')
         st.image(tc)
 
@@ -191,14 +205,22 @@ def download_preselected_dates_images_logic(total_polygon, location_name, year='
     st.write(f'Preselected Dates: {pre_selsected_dates}')
     download_images_for_preselected_dates = st.button('Download Images for Preselected Dates', key='download_images_for_preselected_dates')
     if download_images_for_preselected_dates:
-        for date in pre_selsected_dates:
+        # Overcast dates are probed at a coarse resolution and not downloaded
+        gate = cloud_gate.CloudGate()
+        jobs = [download_scheduler.make_download_job(total_polygon, date, evalscript, location_name) for date in pre_selsected_dates for evalscript in ['ALL', 'CLP']]
+        plan = gate.plan(jobs)
+        clear_dates = sorted(set(job['date'] for job in plan['download']))
+        skipped_dates = sorted(set(job['date'] for job in plan['skipped']))
+        st.write(f'Skipping overcast dates: {skipped_dates}')
+        st.write(gate.get_report())
+        for date in clear_dates:
             images_dict = get_dictionary_of_images_from_evalscripts(total_polygon, date, location_name)
             tc = images_dict['tc']
             tc_dir = images_dict['tc_dir']
             clp = images_dict['clp']
             fcover = images_dict['fcover']
             st.write(f'CLP Average Value: {np.mean(clp)}')
-            st.write(f'FCOVER Average Value: {np.mean(fcover)}')
+            st.write(f'FCOVER Average Value: {np.nanmean(fcover)}')
             st.write(f'True Color Image Downloaded to: {tc_dir}')
             st.image(tc)
 
@@ -213,15 +235,13 @@ def plot_cloud_coverage_averages_through_time(polygon, location_name, gdf, year=
     else:
         st.write('Calculating Cloud Coverage Averages Through Time')
         dates = get_avilable_dates(gdf, year)
-        num_dates = len(dates)
-        clp_averages = []
         my_bar = st.progress(0)
-        i= 0
-        for date in dates:
-            i += 1
-            clp, _ = new_app.get_any_image_from_sentinelhub(polygon, date, 'CLP', location_name)
-            clp_averages.append(np.mean(clp))
-            my_bar.progress(i/num_dates)
+        # The averages come from coarse CLP probes, not from a full resolution CLP raster per date
+        gate = cloud_gate.CloudGate()
+        probes = gate.probe(polygon, dates, location_name, progress_callback=lambda finished, total, job_result: my_bar.progress(finished/total))
+        clp_averages = [np.nan if probes[date] is None else probes[date]['mean_clp'] for date in dates]
+        full_bytes = len(dates) * cloud_gate.estimate_response_bytes(polygon, 'CLP')
+        st.write(f'Probed {len(dates)} dates with {gate.get_report()["probe_bytes"]} bytes instead of {full_bytes} bytes of full resolution CLP')
         save_dir = './avg_cloud_coverage'
         os.makedirs(save_dir, exist_ok=True)
         save_path = os.path.join(save_dir, f'{location_name}_avg_cloud_coverage_{year}.pickle')
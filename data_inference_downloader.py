@@ -1,3 +1,4 @@
+import os
 import streamlit as st
 import geopandas as gpd
 from streamlit_folium import st_folium
@@ -7,6 +8,11 @@ import folium
 import numpy as np
 import joblib
 import new_app
+import download_scheduler
+import download_manifest
+import cloud_gate
+import spectral_indices
+import biophysical
 
 
 def get_folium_basemap(basemap):
@@ -66,17 +72,29 @@ def get_folium_map(center = [15,32], zoom_start = 12, basemap = 'Google Satellit
 
 
 
-def get_dictionary_of_images_from_evalscripts(total_polygon, date, location_name):
-    eval_true_color = 'TRUECOLOR'
+def get_dictionary_of_images_from_evalscripts(total_polygon, date, location_name, combined=False):
     eval_CLP = 'CLP'
-    eval_FCOVER = 'FCOVER'
     eval_all = 'ALL'
-    eval_ndvi = 'NDVI'
-    all, all_dir = new_app.get_any_image_from_sentinelhub(total_polygon, date, eval_all, location_name)
-    tc, tc_dir = new_app.get_any_image_from_sentinelhub(total_polygon, date, eval_true_color, location_name)
-    clp, clp_dir = new_app.get_any_image_from_sentinelhub(total_polygon, date, eval_CLP, location_name)
-    fcover, fcover_dir = new_app.get_any_image_from_sentinelhub(total_polygon, date, eval_FCOVER, location_name)
-    ndvi, ndvi_dir = new_app.get_any_image_from_sentinelhub(total_polygon, date, eval_ndvi, location_name)
+    evalscripts = [eval_all, eval_CLP]
+    # True colour, NDVI and FCOVER are computed locally from the ALL bands instead of requested
+    products = ['TRUECOLOR', 'NDVI']
+    networks = ['FCOVER']
+    if combined:
+        images = new_app.get_combined_images_from_sentinelhub(total_polygon, date, location_name, evalscripts=evalscripts, products=products, networks=networks)
+        results = [{'result': images[evalscript]} for evalscript in evalscripts]
+    else:
+        jobs = [download_scheduler.make_download_job(total_polygon, date, evalscript, location_name) for evalscript in evalscripts]
+        results = download_scheduler.run_download_jobs(jobs, max_workers=len(jobs))
+        for job_result in results:
+            if job_result['status'] == 'failed':
+                raise Exception(f'Download failed for {job_result["job_id"]}: {job_result["error"]}')
+        images = new_app.get_product_images_from_sentinelhub(total_polygon, date, products, location_name)
+        images.update(new_app.get_biophysical_images_from_sentinelhub(total_polygon, date, networks, location_name))
+    all, all_dir = results[0]['result']
+    clp, clp_dir = results[1]['result']
+    fcover, fcover_dir = images['FCOVER']
+    tc, tc_dir = images['TRUECOLOR']
+    ndvi, ndvi_dir = images['NDVI']
     images_dict = {
         'all': all,
         'all_dir': all_dir,
@@ -110,7 +128,7 @@ def download_preselected_dates_images_logic(total_polygon, location_name, year='
             clp = images_dict['clp']
             fcover = images_dict['fcover']
             st.write(f'CLP Average Value: {np.mean(clp)}')
-            st.write(f'FCOVER Average Value: {np.mean(fcover)}')
+            st.write(f'FCOVER Average Value: {np.nanmean(fcover)}')
             st.write(f'True Color Image Downloaded to: {tc_dir}')
             st.image(tc)
 
@@ -136,11 +154,15 @@ def main():
     # if confirm_index:
     indexs = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
     years = ['2021']
+    evalscripts = ['ALL', 'CLP']
+    # Computed locally from the ALL output instead of requested
+    products = ['TRUECOLOR', 'NDVI']
+    networks = ['FCOVER']
+    jobs = []
     for index in indexs:
         for year in years:
             current_gdf = gdf.iloc[[index]]
             square_id = current_gdf['square_id'].values[0]
-            st.write(f'Square ID: {square_id}, Year: {year}')
             total_bounds = current_gdf.total_bounds
             total_polygon = shapely.geometry.box(*total_bounds, ccw=True)
             location_name = f'gaizera_inference_data_{square_id}'
@@ -151,14 +173,35 @@ def main():
                 f'{year}-09-19',
                 f'{year}-10-29',
             ]
-            st.write(f'Preselected Dates: {pre_selsected_dates}')
             for date in pre_selsected_dates:
-                images_dict = get_dictionary_of_images_from_evalscripts(total_polygon, date, location_name)
-                tc = images_dict['tc']
-                tc_dir = images_dict['tc_dir']
-                clp = images_dict['clp']
-                fcover = images_dict['fcover']
-                st.write(f'CLP Average Value: {np.mean(clp)}')
-                st.write(f'FCOVER Average Value: {np.mean(fcover)}')
-                st.write(f'True Color Image Downloaded to: {tc_dir}')
-                st.image(tc)
+                jobs.append(download_scheduler.make_download_job(total_polygon, date, 'COMBINED', location_name))
+    gate = cloud_gate.CloudGate()
+    plan = gate.plan(jobs, evalscripts=evalscripts)
+    st.write(f'Skipping {len(plan["skipped"])} overcast jobs')
+    st.write(gate.get_report())
+    jobs = plan['download']
+    manifest = download_manifest.DownloadManifest()
+    pending_jobs = manifest.plan(jobs)
+    st.write(f'Number of Download Jobs: {len(jobs)}, already done: {len(jobs) - len(pending_jobs)}')
+    jobs = pending_jobs
+    my_bar = st.progress(0)
+    def on_progress(finished, total, job_result):
+        my_bar.progress(finished/total)
+    def download_combined(job):
+        # Only the response paths are kept in the results, the manifest checksums those files
+        response_paths = new_app.download_combined_responses_from_sentinelhub(job['polygon'], job['date'], job['location'], evalscripts=evalscripts)
+        spectral_indices.compute_product_rasters(response_paths['ALL'], products)
+        for name in networks:
+            biophysical.compute_network_raster(response_paths['ALL'], name, job['date'])
+        return response_paths
+    results = download_scheduler.run_download_jobs(jobs, download_fn=manifest.wrap(download_combined), max_workers=8, max_per_host=8, progress_callback=on_progress)
+    summary = download_scheduler.summarize_download_results(results)
+    st.write(f'Downloaded {summary["done"]} of {summary["total"]} jobs, {summary["failed"]} failed')
+    if summary['failed'] > 0:
+        st.write(summary['failures'])
+    for job_result in results:
+        if job_result['status'] == 'done':
+            all_path = job_result['result']['ALL']
+            tc_dir = os.path.dirname(spectral_indices.get_product_path(all_path, 'TRUECOLOR'))
+            st.write(f'True Color Image Downloaded to: {tc_dir}')
+            st.image(spectral_indices.read_product(all_path, 'TRUECOLOR'))
@@ -8,9 +8,16 @@ import os
 from tqdm import tqdm
 import geopandas as gpd
 import pandas as pd
+import numpy as np
+import evalscript_registry
+import pixel_table
+import feature_store
+import training_matrix
+import extraction_runner
+import data_reader
 
 def load_raw_data(location='gaziera', evalscript= 'ALL'):
-    data_path = f'data/training_data/{location}/training_data_{evalscript}.pkl'
+    data_path = f'data/training_data/{location}/' + evalscript_registry.get_artifact_file_name('training_table', evalscript, 'pkl')
     with open(data_path, 'rb') as f:
         raw_data = pickle.load(f)
     return raw_data
@@ -71,8 +78,43 @@ def get_points_labels(points_list, labels_gdf):
                 points_labels.append(-1)
     return points_labels
 
+def get_batch_labels(batch, labels_gdf):
+    '''
+    Label every pixel of a batch of data_reader.iter_training_batches
+    '''
+    latitudes = [col for col in batch.columns if 'latitude' in col][0]
+    longitudes = [col for col in batch.columns if 'longitude' in col][0]
+    return get_pixel_labels(batch[longitudes].values, batch[latitudes].values, labels_gdf)
+
+def get_pixel_labels(longitudes, latitudes, labels_gdf):
+    '''
+    Label pixels with one spatial join per class instead of one contains() per pixel.
+    Same labels as get_points_labels: 1 cultivated, 0 uncultivated, 2 other, -1 outside every polygon.
+    '''
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(longitudes, latitudes), crs='EPSG:4326')
+    labels = np.full(len(points), -1, dtype=np.int64)
+    # Assigned from the lowest to the highest priority, so cultivated wins where polygons overlap
+    for label, crop_type in [(2, 'Other'), (0, 'Uncultivated'), (1, 'Cultivated')]:
+        class_gdf = labels_gdf[labels_gdf['Crop_Type_Binary'] == crop_type]
+        if len(class_gdf) == 0:
+            continue
+        joined = gpd.sjoin(points, class_gdf[['geometry']], how='inner', predicate='within')
+        labels[np.unique(joined.index.values)] = label
+    return labels
+
+def label_batches(batches, labels_gdf):
+    '''
+    Add the Labels column to each batch of data_reader.iter_training_batches as it streams through
+    '''
+    for batch in batches:
+        batch['Labels'] = get_batch_labels(batch, labels_gdf)
+        yield batch
+
 def get_processed_data(raw_data , location='gaziera', evalscript='ALL', other_flag=False):
-    processed_data_path = f'./data/training_data/{location}/processed_data_{evalscript}.pkl'
+    if feature_store.has_partition(location, evalscript):
+        return read_all_processed_data(location=location, evalscript=evalscript)
+    # Tables processed before the feature store existed are moved into it
+    processed_data_path = f'./data/training_data/{location}/' + evalscript_registry.get_artifact_file_name('processed_table', evalscript, 'pkl')
     if os.path.exists(processed_data_path):
         with open(processed_data_path, 'rb') as f:
             processed_data = pickle.load(f)
@@ -85,19 +127,43 @@ def get_processed_data(raw_data , location='gaziera', evalscript='ALL', other_fl
         st.write(f'Labels shape: {labels_gdf.shape}')
         st.write(labels_gdf)
         
-        points_list = get_points_list_from_raw_data(raw_data)
-        points_labels = get_points_labels(points_list, labels_gdf)
-        raw_data['Labels'] = points_labels
+        longitudes, latitudes = pixel_table.get_coordinates(raw_data)
+        raw_data['Labels'] = get_pixel_labels(longitudes, latitudes, labels_gdf)
         processed_data = raw_data
-        saved_processed_data(processed_data, processed_data_path)
+    feature_store.write_features(processed_data, location, evalscript)
     return processed_data
 
+def get_training_matrix(location='gaziera', evalscript='ALL', dates=None, year='2021', other_flag=False, keep_unlabelled=False):
+    '''
+    Labelled training matrix of a location, built straight from the rasters with training_matrix
+    instead of the per-date tables, and reused while the evalscript is unchanged
+    return:
+        features, labels, schema: see training_matrix.load_training_matrix
+    '''
+    output_dir = training_matrix.get_matrix_dir(location, year, evalscript)
+    if training_matrix.has_training_matrix(output_dir):
+        features, labels, schema = training_matrix.load_training_matrix(output_dir)
+        if schema['keep_unlabelled'] == keep_unlabelled:
+            return features, labels, schema
+        del features
+    downloaded_data = data_reader.get_available_data_dataframe(location=location, evalscript=evalscript, dates=dates)
+    image_paths = {row['date']: data_reader.get_image_path_from_row(row) for _, row in downloaded_data.iterrows()}
+    if len(image_paths) == 0:
+        raise Exception(f'No {evalscript} images downloaded for {location}')
+    binary = not ('other' in location or other_flag)
+    labels_gdf = get_labels_gdf(location=location, binary=binary)
+    with st.spinner(f'Building the {evalscript} training matrix of {location}...'):
+        training_matrix.build_training_matrix(
+            image_paths,
+            output_dir,
+            script=evalscript,
+            labels_fn=lambda longitudes, latitudes: get_pixel_labels(longitudes, latitudes, labels_gdf),
+            keep_unlabelled=keep_unlabelled,
+        )
+    return training_matrix.load_training_matrix(output_dir)
+
 def convert_to_gdf(processed_data):
-    geometry_columns = [col for col in processed_data.columns if 'geometry' in col]
-    geometry_columns = geometry_columns[0]
-    geometry = processed_data[geometry_columns]
-    processed_data['geometry'] = geometry
-    processed_data_gdf = gpd.GeoDataFrame(processed_data, geometry='geometry')
+    processed_data_gdf = pixel_table.to_geodataframe(processed_data)
     return processed_data_gdf
 
 def get_labels_gdf_maps(labels_gdf):
@@ -113,37 +179,97 @@ def get_labels_gdf_maps(labels_gdf):
     labels_gdf_other.explore(m=m, color='yellow')
     return m
 
-def read_all_processed_data(data_dir = './data/training_data/gaziera/', evalscript=None):
-    files = os.listdir(data_dir)
-    files = [file for file in files if 'processed' in file]
-    if evalscript is not None:
-        files = [file for file in files if evalscript in file]
-    processed_data = []
-    for file in files:
-        with open(data_dir + file, 'rb') as f:
-            df = pickle.load(f)
-            labels = df['Labels']
-            df = df.drop(columns=['Labels'])
-            processed_data.append(df)
-    processed_data = pd.concat(processed_data, axis=1)
-    columns = processed_data.columns
-    geometry_columns = [col for col in columns if 'geometry' in col]
-    latitudes_cols = [col for col in columns if 'latitude' in col]
-    longitudes_cols = [col for col in columns if 'longitude' in col]
-    labels_cols = [col for col in columns if 'Labels' in col]
-    geom = processed_data[geometry_columns[0]].values
-    lat = processed_data[latitudes_cols[0]]
-    long = processed_data[longitudes_cols[0]]
-    processed_data = processed_data.drop(columns=geometry_columns)
-    processed_data = processed_data.drop(columns=latitudes_cols)
-    processed_data = processed_data.drop(columns=longitudes_cols)
-    processed_data = processed_data.drop(columns=labels_cols)
-    processed_data = pd.DataFrame(processed_data)
-    processed_data_gdf = gpd.GeoDataFrame(processed_data, geometry=geom)
-    processed_data_gdf['latitude'] = lat
-    processed_data_gdf['longitude'] = long
-    processed_data_gdf['Labels'] = labels
-    return processed_data_gdf
+def read_all_processed_data(data_dir = './data/training_data/gaziera/', evalscript=None, location=None, columns=None, labels=None, bbox=None, sample_fraction=None):
+    '''
+    Read the processed tables of a location from the feature store, the evalscripts side by side.
+    Only the requested feature columns, labels, bbox and share of the row groups are read.
+    The location defaults to the name of data_dir, e.g. ./data/training_data/gaziera_2023/.
+    '''
+    if location is None:
+        location = os.path.basename(os.path.normpath(data_dir))
+    evalscripts = None if evalscript is None else [evalscript]
+    processed_data = feature_store.read_location_features(locations=[location], evalscripts=evalscripts, columns=columns, labels=labels, bbox=bbox, sample_fraction=sample_fraction)
+    processed_data = processed_data.drop(columns=['location', 'year', 'latitude', 'longitude'], errors='ignore')
+    labels = processed_data.pop('Labels')
+    grid = processed_data[pixel_table.GRID_COLUMNS]
+    processed_data = processed_data.drop(columns=pixel_table.GRID_COLUMNS)
+    processed_data[pixel_table.GRID_COLUMNS] = grid
+    processed_data['Labels'] = labels
+    return processed_data
+
+
+REFLECTANCE_SCALE = 10000
+CATEGORICAL_COLUMNS = ['location', 'year', 'target_state']
+COORDINATE_COLUMNS = ['latitude', 'longitude', 'geometry']
+
+
+def is_reflectance_column(col):
+    return str(col).split('_')[0] in data_reader.ALL_BANDS_NAMES
+
+
+def compact_processed_data(processed_data, reflectance_dtype='float32', reflectance_scale=REFLECTANCE_SCALE, keep_coordinates=False):
+    '''
+    Shrink a processed table to the smallest dtypes that hold its values
+    args:
+        processed_data: a processed (geo)dataframe
+        reflectance_dtype: 'float32', or 'uint16' to store the reflectances multiplied by reflectance_scale.
+            Columns with missing values stay float32.
+        reflectance_scale: the scale of the uint16 reflectances
+        keep_coordinates: keep the latitude, longitude and geometry columns. They are dropped when the
+            grid columns are there, pixel_table.get_coordinates recomputes them.
+    return:
+        compacted: a dataframe with float32 or uint16 features, int8 labels and categorical
+            location, year and grid_id
+    '''
+    if reflectance_dtype not in ['float32', 'uint16']:
+        raise ValueError(f'Invalid reflectance dtype {reflectance_dtype}')
+    has_grid = all(col in processed_data.columns for col in pixel_table.GRID_COLUMNS)
+    columns = {}
+    for col in processed_data.columns:
+        if col in COORDINATE_COLUMNS and has_grid and not keep_coordinates:
+            continue
+        values = processed_data[col]
+        if col == 'geometry':
+            columns[col] = values
+        elif col == 'Labels':
+            columns[col] = values.astype(np.int8)
+        elif col in CATEGORICAL_COLUMNS or col == 'grid_id':
+            columns[col] = values.astype('category')
+        elif col in ['row', 'col']:
+            columns[col] = values.astype(np.int32)
+        elif col in COORDINATE_COLUMNS or not pd.api.types.is_float_dtype(values):
+            columns[col] = values
+        elif reflectance_dtype == 'uint16' and is_reflectance_column(col) and not values.isna().any():
+            columns[col] = np.round(values.values * reflectance_scale).clip(0, np.iinfo(np.uint16).max).astype(np.uint16)
+        else:
+            columns[col] = values.astype(np.float32)
+    compacted = pd.DataFrame(columns, index=processed_data.index)
+    if 'geometry' in compacted.columns:
+        compacted = gpd.GeoDataFrame(compacted, geometry='geometry', crs=processed_data.crs)
+    return compacted
+
+
+def get_memory_report(before, after):
+    '''
+    Bytes taken by every column before and after compact_processed_data
+    return:
+        report: a dataframe indexed by column with the dtypes, bytes and bytes saved, and a Total row
+    '''
+    bytes_before = before.memory_usage(deep=True)
+    bytes_after = after.memory_usage(deep=True)
+    report = pd.DataFrame({
+        'dtype_before': before.dtypes.astype(str),
+        'bytes_before': bytes_before,
+        'dtype_after': after.dtypes.astype(str),
+        'bytes_after': bytes_after,
+    }, index=bytes_before.index)
+    report['bytes_after'] = report['bytes_after'].fillna(0).astype(np.int64)
+    report['dtype_before'] = report['dtype_before'].fillna('')
+    report['dtype_after'] = report['dtype_after'].fillna('dropped')
+    report.loc['Index', 'dtype_after'] = ''
+    report['saved_bytes'] = report['bytes_before'] - report['bytes_after']
+    report.loc['Total'] = ['', report['bytes_before'].sum(), '', report['bytes_after'].sum(), report['saved_bytes'].sum()]
+    return report
 
 
 def merge_final_processed_data_evalscripts_for_location(location, evalscript_gdfs):
@@ -152,17 +278,12 @@ def merge_final_processed_data_evalscripts_for_location(location, evalscript_gdf
     for evalscript in evalscripts:
         gdf = evalscript_gdfs[evalscript]
         gdf = gdf.drop(columns=['Labels'])
-        gdf = gdf.drop(columns=['latitude'])
-        gdf = gdf.drop(columns=['longitude'])
-        gdf = gdf.drop(columns=['geometry'])
+        gdf = gdf.drop(columns=pixel_table.GRID_COLUMNS)
         stripped_gdfs.append(gdf)
     gdf = pd.concat(stripped_gdfs, axis=1)
     gdf['location'] = location
     gdf['Labels'] = evalscript_gdfs[evalscripts[0]]['Labels']
-    gdf['latitude'] = evalscript_gdfs[evalscripts[0]]['latitude']
-    gdf['longitude'] = evalscript_gdfs[evalscripts[0]]['longitude']
-    gdf['geometry'] = evalscript_gdfs[evalscripts[0]]['geometry']
-    gdf = gpd.GeoDataFrame(gdf, geometry='geometry')
+    gdf[pixel_table.GRID_COLUMNS] = evalscript_gdfs[evalscripts[0]][pixel_table.GRID_COLUMNS]
     return gdf
     
 
@@ -171,16 +292,26 @@ def main():
     evalscripts = ['ALL', 'FCOVER']
     location_gdfs = []
     other_flag = True
+    # Label every (location, evalscript) into the feature store in parallel, then merge in a fixed order
+    units = [extraction_runner.make_extraction_unit(location, evalscript, stage='processed_data', other_flag=other_flag) for location in locations for evalscript in evalscripts]
+    results = extraction_runner.run_extraction_units(units)
+    summary = extraction_runner.summarize_extraction_results(results)
+    st.write(summary)
+    failed_locations = set(result['unit']['location'] for result in results if result['status'] == 'failed')
     for location in locations:
+        if location in failed_locations:
+            st.write(f'Skipping {location}, some of its evalscripts failed')
+            continue
         evalscript_gdfs = {}
         for evalscript in evalscripts:
-            st.write(f'Getting processed data for {location} and {evalscript}')
-            raw_data = load_raw_data(location=location, evalscript=evalscript)
-            processed_data = get_processed_data(raw_data, location=location, evalscript=evalscript, other_flag=other_flag)
             data_dir = f'./data/training_data/{location}/'
             final_processed_data = read_all_processed_data(data_dir=data_dir, evalscript=evalscript)
             evalscript_gdfs[evalscript] = final_processed_data
         gdf = merge_final_processed_data_evalscripts_for_location(location, evalscript_gdfs)
+        compacted_gdf = compact_processed_data(gdf)
+        st.write('Memory report')
+        st.write(get_memory_report(gdf, compacted_gdf))
+        gdf = compacted_gdf
         st.write(f'Final processed data shape: {gdf.shape}')
         st.write(gdf)
         file_path = f'./data/joblibs/processed_data_{location}.joblib'
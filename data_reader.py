@@ -1,59 +1,66 @@
 import streamlit as st
 import os
+import shutil
 import pandas as pd
 import rasterio
 from rasterio import plot
+from rasterio.windows import Window
 import numpy as np
 import matplotlib.pyplot as plt
 import folium
 from streamlit_folium import st_folium
 import pickle
-import geopandas as gpd
-from shapely.geometry import Point
-
-def get_available_data_dataframe():
-    satellite_images_dir = './data/satellite_images'
-    downloaded_dates = os.listdir(satellite_images_dir)
-    #remove dates if they are not in YYYY-MM-DD format
-    downloaded_dates = [date for date in downloaded_dates if len(date) == 10]
-    downloaded_dates = sorted(downloaded_dates)
-    downloaded_data_dict = {
-        'date': [],
-        'location': [],
-        'evalscript': [],
-        'identifier': [],
-        'file_name': []
-    }
-    for date in downloaded_dates:
-        date_dir = os.path.join(satellite_images_dir, date)
-        locations = os.listdir(date_dir)
-        for location in locations:
-            location_dir = os.path.join(date_dir, location)
-            evalscripts = os.listdir(location_dir)
-            for evalscript in evalscripts:
-                evalscript_dir = os.path.join(location_dir, evalscript)
-                identifiers = os.listdir(evalscript_dir)
-                for identifier in identifiers:
-                    identifier_dir = os.path.join(evalscript_dir, identifier)
-                    file_names = os.listdir(identifier_dir)
-                    for file_name in file_names:
-                        if file_name.startswith('response'):
-                            downloaded_data_dict['date'].append(date)
-                            downloaded_data_dict['location'].append(location)
-                            downloaded_data_dict['evalscript'].append(evalscript)
-                            downloaded_data_dict['identifier'].append(identifier)
-                            downloaded_data_dict['file_name'].append(file_name)
-    downloaded_data = pd.DataFrame(downloaded_data_dict)
+import datacube_store
+import download_index
+import evalscript_registry
+import download_scheduler
+import streaming_pipeline
+import pixel_table
+import extraction_runner
+import compositing
+import biophysical
+import spectral_indices
+
+# Products computed from the ALL responses instead of being requested
+LOCAL_PRODUCTS = spectral_indices.PRODUCTS + biophysical.NETWORKS
+
+
+def get_available_data_dataframe(location=None, evalscript=None, dates=None):
+    if evalscript in LOCAL_PRODUCTS:
+        compute_missing_products(evalscript, location=location, dates=dates)
+    downloaded_data = download_index.get_download_index().query(location=location, evalscript=evalscript, dates=dates)
     return downloaded_data
 
 def get_image_path_from_row(row):
-    date = row['date']
-    location = row['location']
-    evalscript = row['evalscript']
-    identifier = row['identifier']
-    file_name = row['file_name']
-    image_path = f'./data/satellite_images/{date}/{location}/{evalscript}/{identifier}/{file_name}'
-    return image_path
+    return download_index.get_entry_path(row)
+
+
+def compute_local_product(response_path, name, date):
+    '''
+    Compute (or reuse) a LOCAL_PRODUCTS product of an ALL response, the product hooks index it
+    '''
+    if name in biophysical.NETWORKS:
+        return biophysical.compute_network_raster(response_path, name, date)
+    return spectral_indices.compute_product_rasters(response_path, [name])[name]
+
+
+def compute_missing_products(name, location=None, dates=None):
+    '''
+    Compute a local product for the downloaded ALL responses of the dates that have none yet,
+    neither computed nor downloaded under that name
+    return:
+        product_paths: the paths of the products computed
+    '''
+    index = download_index.get_download_index()
+    available = index.query(location=location, evalscript=name, dates=dates)
+    available = set(zip(available['location'], available['date']))
+    responses = index.query(location=location, evalscript='ALL', dates=dates)
+    responses = responses[responses['file_name'].str.endswith('.tiff')].drop_duplicates(['location', 'date'])
+    product_paths = []
+    for _, row in responses.iterrows():
+        if (row['location'], row['date']) not in available:
+            product_paths.append(compute_local_product(get_image_path_from_row(row), name, row['date']))
+    return product_paths
 
 def read_image_with_rasterio(image_path):
     img = rasterio.open(image_path)
@@ -82,119 +89,154 @@ def image_info(img):
         st.pyplot(fig)
 
 
-def image_13_bands_as_dataframe(img):
-    bands = []
-    bands_names = ["B01", "B02", "B03","B04","B05","B06","B07","B08","B8A","B09","B10","B11","B12"]
-    add_names = False
-    if img.count == len(bands_names):
-        add_names = True
-    for i in range(1, img.count + 1):
-        band = img.read(i)
-        bands.append(band)
-    bands = np.array(bands)
-    bands = bands.reshape(img.count, img.width * img.height)
-    bands = bands.T
-    if add_names:
+DEFAULT_MAX_BATCH_BYTES = 64 * 2**20
+ALL_BANDS_NAMES = ["B01", "B02", "B03","B04","B05","B06","B07","B08","B8A","B09","B10","B11","B12"]
+
+
+def get_pixel_coordinates(transform, height, width, row_off=0, col_off=0):
+    '''
+    Compute the coordinates of every pixel centre at once from the affine transform,
+    the same values img.xy(row, col) returns one pixel at a time
+    args:
+        transform: the affine transform of the image
+        height: the number of rows
+        width: the number of columns
+        row_off: the row of the first pixel, for a window of the image
+        col_off: the column of the first pixel, for a window of the image
+    return:
+        longitudes, latitudes: two float64 arrays of height * width values in row-major order
+    '''
+    cols = np.arange(col_off, col_off + width, dtype=np.float64) + 0.5
+    rows = np.arange(row_off, row_off + height, dtype=np.float64) + 0.5
+    cols, rows = np.meshgrid(cols, rows)
+    longitudes = transform.a * cols + transform.b * rows + transform.c
+    latitudes = transform.d * cols + transform.e * rows + transform.f
+    return longitudes.ravel(), latitudes.ravel()
+
+
+def image_as_dataframe(img, bands_names=None):
+    '''
+    Read every band of an image into a table with one row per pixel, plus latitude and longitude columns
+    args:
+        img: an open rasterio dataset
+        bands_names: the names of the bands, used as column names when they match the band count
+    return:
+        bands: a pandas dataframe with one contiguous column per band
+    '''
+    bands = img.read()
+    bands = np.ascontiguousarray(bands.reshape(img.count, img.width * img.height).T)
+    if bands_names is not None and img.count == len(bands_names):
         bands = pd.DataFrame(bands, columns=bands_names)
     else:
         bands = pd.DataFrame(bands)
-    latitudes = []
-    longitudes = []
-    for i in range(img.height):
-        for j in range(img.width):
-            lon, lat = img.xy(i, j)
-            latitudes.append(lat)
-            longitudes.append(lon)
+    longitudes, latitudes = get_pixel_coordinates(img.transform, img.height, img.width)
     bands['latitude'] = latitudes
     bands['longitude'] = longitudes
     return bands
 
-def image_NDVI_as_dataframe(img):
-    st.write('Getting NDVI image as dataframe')
-    bands = []
-    bands_names = ["NDVI"]
-    add_names = False
-    st.write(f'Bands Names: {bands_names}')
-    st.write(f'Image count: {img.count}')
-    if img.count == len(bands_names):
-        add_names = True
-    for i in range(1, img.count + 1):
-        band = img.read(i)
-        bands.append(band)
-    bands = np.array(bands)
-    bands = bands.reshape(img.count, img.width * img.height)
-    bands = bands.T
-    if add_names:
-        bands = pd.DataFrame(bands, columns=bands_names)
+def get_batch_windows(height, width, row_bytes, max_batch_bytes=DEFAULT_MAX_BATCH_BYTES):
+    '''
+    Split an image into full-width row strips holding at most max_batch_bytes each
+    args:
+        height: the number of rows
+        width: the number of columns
+        row_bytes: the memory one row of the batch table takes
+        max_batch_bytes: the memory ceiling of a batch
+    return:
+        windows: a list of rasterio Windows covering the image top to bottom
+    '''
+    rows_per_batch = max(1, int(max_batch_bytes // max(1, row_bytes)))
+    return [Window(0, row_off, width, min(rows_per_batch, height - row_off)) for row_off in range(0, height, rows_per_batch)]
+
+
+def window_as_dataframe(img, window, bands_names=None):
+    '''
+    Same table as image_as_dataframe for a single window, indexed by the pixel position in the whole image
+    '''
+    window = window.round_offsets().round_lengths()
+    height, width = int(window.height), int(window.width)
+    bands = img.read(window=window)
+    bands = np.ascontiguousarray(bands.reshape(img.count, width * height).T)
+    rows = np.arange(int(window.row_off), int(window.row_off) + height)
+    cols = np.arange(int(window.col_off), int(window.col_off) + width)
+    index = (rows[:, None] * img.width + cols[None, :]).ravel()
+    if bands_names is not None and img.count == len(bands_names):
+        bands = pd.DataFrame(bands, columns=bands_names, index=index)
     else:
-        bands = pd.DataFrame(bands)
-    latitudes = []
-    longitudes = []
-    for i in range(img.height):
-        for j in range(img.width):
-            lon, lat = img.xy(i, j)
-            latitudes.append(lat)
-            longitudes.append(lon)
+        bands = pd.DataFrame(bands, index=index)
+    longitudes, latitudes = get_pixel_coordinates(img.transform, height, width, int(window.row_off), int(window.col_off))
     bands['latitude'] = latitudes
     bands['longitude'] = longitudes
     return bands
 
+
+def get_row_bytes(imgs):
+    # band values of every image plus a float64 latitude and longitude per image
+    return sum(img.width * (img.count * np.dtype(img.dtypes[0]).itemsize + 16) for img in imgs)
+
+
+def iter_image_batches(img, bands_names=None, max_batch_bytes=DEFAULT_MAX_BATCH_BYTES):
+    '''
+    Read an image as a sequence of pixel tables of bounded size, only one window is in memory at a time
+    args:
+        img: an open rasterio dataset
+        bands_names: the names of the bands, used as column names when they match the band count
+        max_batch_bytes: the memory ceiling of a batch
+    return:
+        batches: a generator of dataframes shaped like image_as_dataframe, indexed by pixel position
+    '''
+    for window in get_batch_windows(img.height, img.width, get_row_bytes([img]), max_batch_bytes):
+        yield window_as_dataframe(img, window, bands_names)
+
+
+def iter_training_batches(image_paths, script='ALL', max_batch_bytes=DEFAULT_MAX_BATCH_BYTES):
+    '''
+    Read the images of several dates window by window, each batch holds the same pixels of every date
+    with the <column>_<date> names get_bands_gdf uses
+    args:
+        image_paths: a dictionary of date -> image path, the images share the same grid
+        script: the evalscript of the images
+        max_batch_bytes: the memory ceiling of a batch, all dates included
+    return:
+        batches: a generator of dataframes indexed by pixel position
+    '''
+    bands_names = SCRIPT_BANDS_NAMES.get(script, [script])
+    imgs = {date: rasterio.open(path) for date, path in image_paths.items()}
+    try:
+        first = next(iter(imgs.values()))
+        for window in get_batch_windows(first.height, first.width, get_row_bytes(imgs.values()), max_batch_bytes):
+            batch = []
+            for date, img in imgs.items():
+                bands = window_as_dataframe(img, window, bands_names)
+                bands.columns = [f'{col}_{date}' for col in bands.columns]
+                batch.append(bands)
+            yield pd.concat(batch, axis=1)
+    finally:
+        for img in imgs.values():
+            img.close()
+
+
+def iter_location_batches(location='gaziera', evalscript='ALL', dates=None, max_batch_bytes=DEFAULT_MAX_BATCH_BYTES):
+    '''
+    Streaming counterpart of get_training_data_evalscript, reads the downloaded images of a location
+    through iter_training_batches instead of building the whole table
+    '''
+    downloaded_data = get_available_data_dataframe(location=location, evalscript=evalscript, dates=dates)
+    downloaded_data = downloaded_data[downloaded_data['file_name'].str.endswith(('.tiff', '.tif'))]
+    image_paths = {row['date']: get_image_path_from_row(row) for _, row in downloaded_data.iterrows()}
+    return iter_training_batches(image_paths, script=evalscript, max_batch_bytes=max_batch_bytes)
+
+def image_13_bands_as_dataframe(img):
+    return image_as_dataframe(img, ALL_BANDS_NAMES)
+
+def image_NDVI_as_dataframe(img):
+    return image_as_dataframe(img, ["NDVI"])
+
 def image_FCOVER_as_dataframe(img):
-    st.write('Getting FCOVER image as dataframe')
-    bands = []
-    bands_names = ["FCOVER"]
-    add_names = False
-    st.write(f'Bands Names: {bands_names}')
-    st.write(f'Image count: {img.count}')
-    if img.count == len(bands_names):
-        add_names = True
-    for i in range(1, img.count + 1):
-        band = img.read(i)
-        bands.append(band)
-    bands = np.array(bands)
-    bands = bands.reshape(img.count, img.width * img.height)
-    bands = bands.T
-    if add_names:
-        bands = pd.DataFrame(bands, columns=bands_names)
-    else:
-        bands = pd.DataFrame(bands)
-    latitudes = []
-    longitudes = []
-    for i in range(img.height):
-        for j in range(img.width):
-            lon, lat = img.xy(i, j)
-            latitudes.append(lat)
-            longitudes.append(lon)
-    bands['latitude'] = latitudes
-    bands['longitude'] = longitudes
-    return bands
+    return image_as_dataframe(img, ["FCOVER"])
 
 def image_CLP_as_dataframe(img):
-    bands = []
-    bands_names = ["CLP"]
-    add_names = False
-    if img.count == len(bands_names):
-        add_names = True
-    for i in range(1, img.count + 1):
-        band = img.read(i)
-        bands.append(band)
-    bands = np.array(bands)
-    bands = bands.reshape(img.count, img.width * img.height)
-    bands = bands.T
-    if add_names:
-        bands = pd.DataFrame(bands, columns=bands_names)
-    else:
-        bands = pd.DataFrame(bands)
-    latitudes = []
-    longitudes = []
-    for i in range(img.height):
-        for j in range(img.width):
-            lon, lat = img.xy(i, j)
-            latitudes.append(lat)
-            longitudes.append(lon)
-    bands['latitude'] = latitudes
-    bands['longitude'] = longitudes
-    return bands
+    return image_as_dataframe(img, ["CLP"])
 
 
 def plot_lat_lon_on_folium_map(bands, sample_size=10, value_column=None):
@@ -230,57 +272,165 @@ def plot_lat_lon_on_folium_map(bands, sample_size=10, value_column=None):
     return m
 
 
-def get_bands_gdf(row, script='ALL'):
+SCRIPT_BANDS_NAMES = {
+    'ALL': ALL_BANDS_NAMES,
+    'CLP': ['CLP'],
+    **{name: [name] for name in list(spectral_indices.INDICES) + biophysical.NETWORKS},
+    # Named like training_matrix and datacube_store name the bands of multi-band scripts
+    **{name: [f'{name}_{i}' for i in range(len(bands))] for name, bands in spectral_indices.COMPOSITES.items()},
+}
+
+
+def get_bands_table(row, script='ALL'):
     date = row['date']
     selected_image_path = get_image_path_from_row(row)
     img = read_image_with_rasterio(selected_image_path)
-    if script == 'ALL':
-        bands_df = image_13_bands_as_dataframe(img)
-    elif script == 'NDVI':
-        bands_df = image_NDVI_as_dataframe(img)
-    elif script == 'CLP':
-        bands_df = image_CLP_as_dataframe(img)
-    elif script == 'FCOVER':
-        bands_df = image_FCOVER_as_dataframe(img)
-    else:
+    bands_table = get_bands_table_from_image(img, date, script=script)
+    return bands_table, img
+
+
+def get_bands_table_from_image(img, date, script='ALL'):
+    '''
+    Compact pixel table of one date, the band columns are suffixed with the date and the
+    grid columns are not, so the tables of several dates of the same grid line up
+    '''
+    if script not in SCRIPT_BANDS_NAMES:
         raise Exception('Invalid Script')
-    geometry = [Point(xy) for xy in zip(bands_df['longitude'], bands_df['latitude'])]
-    bands_gdf = gpd.GeoDataFrame(bands_df, geometry=geometry)
-    bands_gdf.crs = {'init': 'epsg:4326'}
-    bands_gdf = bands_gdf.to_crs(crs='EPSG:4326')
-    bands_gdf.columns = [f'{col}_{date}' for col in bands_gdf.columns]
-    return bands_gdf, img
+    bands_table = pixel_table.image_as_pixel_table(img, SCRIPT_BANDS_NAMES[script])
+    bands_table.columns = [col if col in pixel_table.GRID_COLUMNS else f'{col}_{date}' for col in bands_table.columns]
+    return bands_table
 
 
+def merge_bands_tables(bands_tables):
+    '''
+    Put the tables of several dates side by side, keeping a single set of grid columns
+    '''
+    grid_ids = set(grid_id for bands_table in bands_tables for grid_id in bands_table['grid_id'].cat.categories)
+    if len(grid_ids) > 1:
+        raise Exception(f'The images are on different grids: {sorted(grid_ids)}')
+    others = [bands_table.drop(columns=pixel_table.GRID_COLUMNS) for bands_table in bands_tables[1:]]
+    return pd.concat([bands_tables[0]] + others, axis=1)
+
+
+def get_bands_gdf(row, script='ALL'):
+    '''
+    Pixel table of one date with point geometries, for export or map display
+    '''
+    bands_table, img = get_bands_table(row, script=script)
+    return pixel_table.to_geodataframe(bands_table), img
+
+
+
+def get_training_data_from_datacube(location='gaziera', evalscript='ALL', dates=None):
+    downloaded_data = get_available_data_dataframe(location=location, evalscript=evalscript)
+    datacube_store.ingest_downloaded_data(downloaded_data)
+    values = datacube_store.open_datacube(location, evalscript)
+    if dates is not None:
+        values = values.sel(time=[np.datetime64(date) for date in dates])
+    training_data = datacube_store.datacube_to_table(values)
+    return training_data
+
 
 def get_training_data_evalscript(location='gaziera', evalscript='ALL', dates=None, year='2021'):
     data_dir = 'data/training_data/'
     os.makedirs(data_dir, exist_ok=True)
     final_dir = data_dir + location+ '_'+ year + '/'
     os.makedirs(final_dir, exist_ok=True)
-    filename = final_dir + 'training_data_' + evalscript + '.pkl'
+    filename = final_dir + evalscript_registry.get_artifact_file_name('training_table', evalscript, 'pkl')
     if os.path.exists(filename):
         with open(filename, 'rb') as f:
             training_data = pickle.load(f)
     else:
-        downloaded_data = get_available_data_dataframe()
-        downloaded_data = downloaded_data[downloaded_data['evalscript'] == evalscript]
-        downloaded_data = downloaded_data[downloaded_data['location'] == location]
-        if dates is not None:
-            downloaded_data = downloaded_data[downloaded_data['date'].isin(dates)]
+        downloaded_data = get_available_data_dataframe(location=location, evalscript=evalscript, dates=dates)
         st.write(f'Final Dataframe for {evalscript} in {location}')
         st.write(downloaded_data)
         total_images = len(downloaded_data.index)
-        bands_gdf_list = []
+        bands_tables = []
         for index, row in downloaded_data.iterrows():
             st.write(f'Processing Image {index + 1} of {total_images}')
-            bands_gdf, img = get_bands_gdf(row, script=evalscript)
-            bands_gdf_list.append(bands_gdf)
-        training_data = pd.concat(bands_gdf_list,axis=1,ignore_index=False)
+            bands_table, img = get_bands_table(row, script=evalscript)
+            bands_tables.append(bands_table)
+        training_data = merge_bands_tables(bands_tables)
         with open(filename, 'wb') as f:
             pickle.dump(training_data, f)
     return training_data
 
+def get_training_data_composites(polygon, location='gaziera', year='2021', months=None, method='median', cloud_threshold=compositing.CLOUD_THRESHOLD, fill_gaps=True):
+    '''
+    Same table as get_training_data_evalscript for ALL, with one cloud-free monthly composite per
+    month instead of hardcoded dates, so a cloudy acquisition no longer spoils a square.
+    The composites are NaN where a month has no clear acquisition, with fill_gaps those values are
+    interpolated from the neighbouring months (see compositing.fill_composite_gaps) so the table
+    can go straight to the trainers. Without it the NaN are kept and have to be handled by the caller.
+    '''
+    if months is None:
+        months = compositing.MONTHS
+    cube = compositing.build_composite_cube(polygon, location, year, months=months, method=method, cloud_threshold=cloud_threshold)
+    bands_tables = []
+    for month_date, composite_path in cube.items():
+        with rasterio.open(composite_path) as img:
+            bands_tables.append(get_bands_table_from_image(img, month_date, script='ALL'))
+    training_data = merge_bands_tables(bands_tables)
+    if fill_gaps:
+        compositing.fill_composite_gaps(training_data, list(cube.keys()))
+    return training_data
+
+def extract_bands_table_from_response(job, downloaded):
+    '''
+    Feature extraction stage of the streaming pipeline, decodes one downloaded response
+    into the per-date columns get_training_data_evalscript builds
+    '''
+    response_path, _ = downloaded
+    with rasterio.open(response_path) as img:
+        bands_table = get_bands_table_from_image(img, job['date'], script=job['evalscript'])
+    return bands_table
+
+
+def get_training_data_streaming(polygon, location='gaziera', evalscript='ALL', dates=None, year='2021', download_workers=8, process_workers=None, queue_size=16):
+    '''
+    Same table as get_training_data_evalscript, built while the images are still downloading:
+    every response is decoded and turned into features as soon as it is on disk. The table of each
+    date is spilled to a parquet file instead of being kept by the pipeline, so only the final merge
+    holds the whole table in memory.
+    '''
+    data_dir = 'data/training_data/'
+    final_dir = data_dir + location+ '_'+ year + '/'
+    os.makedirs(final_dir, exist_ok=True)
+    filename = final_dir + evalscript_registry.get_artifact_file_name('training_table', evalscript, 'pkl')
+    if os.path.exists(filename):
+        with open(filename, 'rb') as f:
+            training_data = pickle.load(f)
+        return training_data
+    jobs = [download_scheduler.make_download_job(polygon, date, evalscript, location) for date in dates]
+    parts_dir = filename + '.parts'
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    os.makedirs(parts_dir)
+
+    def get_part_path(job):
+        return os.path.join(parts_dir, f'{job["date"]}.parquet')
+
+    def write_part(job, bands_table):
+        bands_table.to_parquet(get_part_path(job))
+
+    try:
+        results = streaming_pipeline.run_streaming_pipeline(
+            jobs,
+            extract_bands_table_from_response,
+            sink_fn=write_part,
+            download_workers=download_workers,
+            process_workers=process_workers,
+            queue_size=queue_size,
+        )
+        for job_result in results:
+            if job_result['status'] == 'failed':
+                raise Exception(f'{job_result["stage"].capitalize()} failed for {job_result["job_id"]}: {job_result["error"]}')
+        training_data = merge_bands_tables([pd.read_parquet(get_part_path(job_result['job'])) for job_result in results])
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+    with open(filename, 'wb') as f:
+        pickle.dump(training_data, f)
+    return training_data
+
 def main():
     st.write("Data Reader")
     st.write("Getting Available Data")
@@ -309,12 +459,11 @@ def main():
     # st.write(training_data_FCOVER)
 
     # Training Data for gaizera_square_45X45_0, gaizera_square_45X45_1, ... gaziera_square_45X45_80
-    for i in range(81):
-        location = f'gaizera_square_45X45_{i}'
-        st.write(f'Getting Training Data for {location}')
-        training_data = get_training_data_evalscript(location=location, evalscript='ALL', dates=dates, year=year)
-        st.write(f'Getting Training Data for {location} FCOVER')
-        training_data_FCOVER = get_training_data_evalscript(location=location, evalscript='FCOVER', dates=dates, year=year)
+    # Every (location, evalscript) is independent, they run on all the cores
+    units = [extraction_runner.make_extraction_unit(f'gaizera_square_45X45_{i}', evalscript, dates=dates, year=year) for i in range(81) for evalscript in ['ALL', 'FCOVER']]
+    progress_bar = st.progress(0.0)
+    results = extraction_runner.run_extraction_units(units, progress_callback=lambda finished, total, unit_result: progress_bar.progress(finished / total))
+    st.write(extraction_runner.summarize_extraction_results(results))
 
 
 
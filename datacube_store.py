@@ -0,0 +1,170 @@
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+import rioxarray
+import download_index
+import pixel_table
+from affine import Affine
+
+
+DATACUBES_DIR = './data/datacubes'
+CHUNK_SIZE = 512
+ALL_BANDS_NAMES = ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B10", "B11", "B12"]
+
+
+def get_datacube_path(location, datacubes_dir=DATACUBES_DIR):
+    return os.path.join(datacubes_dir, f'{location}.zarr')
+
+
+def get_band_names(evalscript, count):
+    '''
+    Name the bands of a response the same way data_reader does
+    '''
+    if evalscript == 'ALL' and count == len(ALL_BANDS_NAMES):
+        return ALL_BANDS_NAMES
+    if count == 1:
+        return [evalscript]
+    return [f'{evalscript}_{i}' for i in range(count)]
+
+
+def get_stored_dates(location, evalscript, datacubes_dir=DATACUBES_DIR):
+    '''
+    Get the dates already stored for a location and evalscript
+    '''
+    store_path = get_datacube_path(location, datacubes_dir)
+    if not os.path.exists(os.path.join(store_path, evalscript)):
+        return []
+    cube = xr.open_zarr(store_path, group=evalscript, chunks=None)
+    return [str(date)[:10] for date in cube['time'].values]
+
+
+def append_to_datacube(location, evalscript, date, image_path, datacubes_dir=DATACUBES_DIR):
+    '''
+    Append a downloaded response to the chunked, compressed array store of its location.
+    Each evalscript is a group holding a (time, band, y, x) array, chunked one date at a time
+    in CHUNK_SIZE x CHUNK_SIZE spatial blocks. Dates already stored are skipped.
+    args:
+        location: the location name
+        evalscript: the evalscript of the response
+        date: the acquisition date in YYYY-MM-DD format
+        image_path: the path of the response.tiff
+        datacubes_dir: the folder holding the stores
+    return:
+        appended: False if the date was already stored
+    '''
+    if date in get_stored_dates(location, evalscript, datacubes_dir):
+        return False
+    store_path = get_datacube_path(location, datacubes_dir)
+    os.makedirs(datacubes_dir, exist_ok=True)
+    image = rioxarray.open_rasterio(image_path)
+    image = image.assign_coords(band=get_band_names(evalscript, image.sizes['band']))
+    image = image.expand_dims(time=[np.datetime64(date)])
+    crs = image.rio.crs.to_string() if image.rio.crs is not None else ''
+    transform = list(image.rio.transform())[:6]
+    # Drop the GeoTIFF scale/offset attributes rioxarray attaches, the values are stored as read
+    image.attrs = {}
+    image.encoding = {}
+    cube = image.to_dataset(name='values')
+    cube = cube.drop_vars('spatial_ref', errors='ignore')
+    cube.attrs['crs'] = crs
+    cube.attrs['transform'] = transform
+    chunks = (1, image.sizes['band'], min(CHUNK_SIZE, image.sizes['y']), min(CHUNK_SIZE, image.sizes['x']))
+    if os.path.exists(os.path.join(store_path, evalscript)):
+        cube.to_zarr(store_path, group=evalscript, append_dim='time')
+    else:
+        cube['values'].encoding = {'chunks': chunks}
+        cube.to_zarr(store_path, group=evalscript, mode='a')
+    return True
+
+
+def ingest_downloaded_data(downloaded_data, datacubes_dir=DATACUBES_DIR):
+    '''
+    Append every response listed in a data_reader.get_available_data_dataframe table
+    args:
+        downloaded_data: a dataframe with date, location, evalscript, identifier and file_name columns
+        datacubes_dir: the folder holding the stores
+    return:
+        appended: the number of responses appended
+    '''
+    appended = 0
+    downloaded_data = downloaded_data.sort_values('date')
+    for _, row in downloaded_data.iterrows():
+        if not row['file_name'].endswith(('.tiff', '.tif')):
+            continue
+        image_path = download_index.get_entry_path(row)
+        if append_to_datacube(row['location'], row['evalscript'], row['date'], image_path, datacubes_dir):
+            appended += 1
+    return appended
+
+
+def open_datacube(location, evalscript, start_date=None, end_date=None, bands=None, datacubes_dir=DATACUBES_DIR):
+    '''
+    Lazily open the datacube of a location, only the chunks of the selected dates and bands
+    are read when the values are accessed
+    args:
+        location: the location name
+        evalscript: the evalscript group to open
+        start_date: optional first date of the time range
+        end_date: optional last date of the time range
+        bands: optional list of band names
+        datacubes_dir: the folder holding the stores
+    return:
+        values: a lazy (time, band, y, x) DataArray, its attrs hold the crs, transform and size of the grid
+    '''
+    cube = xr.open_zarr(get_datacube_path(location, datacubes_dir), group=evalscript, chunks=None)
+    values = cube['values'].sortby('time')
+    values.attrs.update(crs=cube.attrs['crs'], transform=cube.attrs['transform'], width=cube.sizes['x'], height=cube.sizes['y'])
+    values = values.sel(time=slice(start_date, end_date))
+    if bands is not None:
+        values = values.sel(band=bands)
+    return values
+
+
+def open_datacubes(locations, evalscript, start_date=None, end_date=None, bands=None, datacubes_dir=DATACUBES_DIR):
+    '''
+    Open the datacubes of several locations as a dictionary of location -> lazy DataArray.
+    Locations have their own grids, so they are kept apart instead of stacked on one axis.
+    '''
+    return {location: open_datacube(location, evalscript, start_date, end_date, bands, datacubes_dir) for location in locations}
+
+
+def get_grid(values):
+    '''
+    Grid of a datacube in the pixel_table format, the same grid as the GeoTIFFs it was built from
+    '''
+    return {
+        'transform': [float(value) for value in values.attrs['transform']],
+        'crs': values.attrs['crs'] or 'EPSG:4326',
+        'width': int(values.attrs['width']),
+        'height': int(values.attrs['height']),
+    }
+
+
+def datacube_to_table(values):
+    '''
+    Flatten a (time, band, y, x) selection into a pixel table like pixel_table.image_as_pixel_table:
+    one <band>_<date> column per band and date plus the grid_id, row and col of each pixel, so it lines
+    up with the tables read from the GeoTIFFs
+    args:
+        values: a DataArray returned by open_datacube, or a spatial selection of it
+    return:
+        table: a pandas dataframe
+    '''
+    data = values.values
+    n_times, n_bands, height, width = data.shape
+    data = data.reshape(n_times * n_bands, height * width).T
+    dates = [str(date)[:10] for date in values['time'].values]
+    columns = [f'{band}_{date}' for date in dates for band in values['band'].values]
+    table = pd.DataFrame(data, columns=columns)
+    grid = get_grid(values)
+    grid_id = pixel_table.get_grid_registry().register(grid)
+    # Rows and columns in the whole grid from the pixel-centre coordinates, a selection keeps its offsets
+    transform = Affine(*grid['transform'])
+    cols = np.floor((values['x'].values - transform.c) / transform.a).astype(np.int32)
+    rows = np.floor((values['y'].values - transform.f) / transform.e).astype(np.int32)
+    cols, rows = np.meshgrid(cols, rows)
+    table['grid_id'] = pd.Categorical.from_codes(np.zeros(height * width, dtype=np.int8), categories=[grid_id])
+    table['row'] = rows.ravel()
+    table['col'] = cols.ravel()
+    return table
@@ -0,0 +1,296 @@
+import os
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+import pandas as pd
+try:
+    import inotify.adapters
+except ImportError:
+    inotify = None
+
+
+SATELLITE_IMAGES_DIR = './data/satellite_images'
+DEFAULT_INDEX_PATH = './data/satellite_images/index.sqlite'
+INDEX_COLUMNS = ['date', 'location', 'evalscript', 'identifier', 'file_name']
+# Folders of the image tree that are not downloads, e.g. the coarse cloud probes of cloud_gate
+UNINDEXED_EVALSCRIPTS = ['CLP_PROBE']
+# Products computed locally from an ALL response (spectral_indices, biophysical) are saved in
+# <date>/<location>/ALL/<identifier>/indices/<name>.tif and indexed under their own name
+PRODUCTS_SOURCE_EVALSCRIPT = 'ALL'
+PRODUCTS_DIR_NAME = 'indices'
+
+
+def parse_response_path(path, satellite_images_dir=SATELLITE_IMAGES_DIR):
+    '''
+    Split a <date>/<location>/<evalscript>/<identifier>/response.* path into its index columns.
+    A product of an ALL response is indexed with its name as evalscript and indices/<name>.tif as file_name.
+    args:
+        path: the path of a downloaded file
+        satellite_images_dir: the root of the downloaded images
+    return:
+        entry: a tuple (date, location, evalscript, identifier, file_name) or None if the path is not
+            a response or a product, or the response of an UNINDEXED_EVALSCRIPTS folder
+    '''
+    relative_path = os.path.relpath(path, satellite_images_dir)
+    parts = relative_path.split(os.sep)
+    if len(parts) == 6 and parts[2] == PRODUCTS_SOURCE_EVALSCRIPT and parts[4] == PRODUCTS_DIR_NAME:
+        date, location, _, identifier, _, file_name = parts
+        name, extension = os.path.splitext(file_name)
+        if len(date) != 10 or extension != '.tif':
+            return None
+        return date, location, name, identifier, f'{PRODUCTS_DIR_NAME}/{file_name}'
+    if len(parts) != 5:
+        return None
+    date, location, evalscript, identifier, file_name = parts
+    if len(date) != 10 or not file_name.startswith('response') or file_name.endswith('.tmp'):
+        return None
+    if evalscript in UNINDEXED_EVALSCRIPTS:
+        return None
+    return date, location, evalscript, identifier, file_name
+
+
+def is_product_entry(file_name):
+    return file_name.startswith(PRODUCTS_DIR_NAME + '/')
+
+
+def get_entry_path(entry, satellite_images_dir=SATELLITE_IMAGES_DIR):
+    '''
+    Path of an indexed file, the inverse of parse_response_path
+    args:
+        entry: a (date, location, evalscript, identifier, file_name) tuple or a row of query
+    '''
+    date, location, evalscript, identifier, file_name = (entry[column] for column in INDEX_COLUMNS) if hasattr(entry, 'keys') else entry
+    if is_product_entry(file_name):
+        evalscript = PRODUCTS_SOURCE_EVALSCRIPT
+    return os.path.join(satellite_images_dir, date, location, evalscript, identifier, *file_name.split('/'))
+
+
+class DownloadIndex:
+    '''
+    Persistent index of the downloaded responses and of the products computed from them, kept up to
+    date by the downloader and product hooks and an optional inotify watcher. Every open reconciles it
+    with the image folders: the mtime of each response folder (and of its products folder) is recorded,
+    and only the folders added, removed or changed since the last scan are listed again.
+    '''
+    def __init__(self, path=DEFAULT_INDEX_PATH, satellite_images_dir=SATELLITE_IMAGES_DIR):
+        self.path = path
+        self.satellite_images_dir = satellite_images_dir
+        self.lock = threading.Lock()
+        self.watcher = None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.create_tables()
+        self.reconcile()
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create_tables(self):
+        with self.connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS responses (
+                    date TEXT, location TEXT, evalscript TEXT, identifier TEXT, file_name TEXT,
+                    indexed_at REAL,
+                    PRIMARY KEY (date, location, evalscript, identifier, file_name)
+                )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS responses_lookup ON responses (location, evalscript, date)')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS scanned_dirs (
+                    date TEXT, location TEXT, evalscript TEXT, identifier TEXT,
+                    mtime_ns INTEGER,
+                    PRIMARY KEY (date, location, evalscript, identifier)
+                )''')
+
+    def add_entries(self, entries):
+        entries = [(*entry, time.time()) for entry in entries if entry is not None]
+        if len(entries) == 0:
+            return
+        with self.lock, self.connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', entries)
+
+    def remove_entry(self, entry):
+        with self.lock, self.connect() as conn:
+            conn.execute('''
+                DELETE FROM responses
+                WHERE date = ? AND location = ? AND evalscript = ? AND identifier = ? AND file_name = ?''', entry)
+
+    def walk(self, root):
+        entries = []
+        for dir_path, _, file_names in os.walk(root):
+            for file_name in file_names:
+                entries.append(parse_response_path(os.path.join(dir_path, file_name), self.satellite_images_dir))
+        return entries
+
+    def iter_response_dirs(self):
+        '''
+        Yield the (date, location, evalscript, identifier) folders of the image tree with their mtime,
+        without listing the files inside them
+        '''
+        def subdirs(path):
+            try:
+                with os.scandir(path) as entries:
+                    return [entry for entry in entries if entry.is_dir()]
+            except FileNotFoundError:
+                return []
+
+        for date_dir in subdirs(self.satellite_images_dir):
+            for location_dir in subdirs(date_dir.path):
+                for evalscript_dir in subdirs(location_dir.path):
+                    if evalscript_dir.name in UNINDEXED_EVALSCRIPTS:
+                        continue
+                    for identifier_dir in subdirs(evalscript_dir.path):
+                        try:
+                            mtime_ns = identifier_dir.stat().st_mtime_ns
+                        except FileNotFoundError:
+                            continue
+                        if evalscript_dir.name == PRODUCTS_SOURCE_EVALSCRIPT:
+                            # Products are added to the indices folder without touching the response folder
+                            try:
+                                mtime_ns = max(mtime_ns, os.stat(os.path.join(identifier_dir.path, PRODUCTS_DIR_NAME)).st_mtime_ns)
+                            except FileNotFoundError:
+                                pass
+                        yield (date_dir.name, location_dir.name, evalscript_dir.name, identifier_dir.name), mtime_ns
+
+    def reconcile(self):
+        '''
+        Bring the index in line with the image tree after responses were added or removed outside
+        the hooks. Only the response folders whose mtime changed since the last scan are listed.
+        return:
+            changed: the number of response folders that were listed again or dropped
+        '''
+        with self.connect() as conn:
+            known = {tuple(row[:4]): row[4] for row in conn.execute('SELECT * FROM scanned_dirs').fetchall()}
+        seen = dict(self.iter_response_dirs())
+        changed = [key for key, mtime_ns in seen.items() if known.get(key) != mtime_ns]
+        removed = [key for key in known if key not in seen]
+        entries = []
+        for key in changed:
+            entries.extend(self.walk(os.path.join(self.satellite_images_dir, *key)))
+        with self.lock, self.connect() as conn:
+            # The products of a folder are indexed under their own name, they go with the folder identifier
+            conn.executemany(f'''
+                DELETE FROM responses WHERE date = ? AND location = ? AND identifier = ?
+                AND (evalscript = ? OR file_name LIKE '{PRODUCTS_DIR_NAME}/%')''',
+                [(date, location, identifier, evalscript) for date, location, evalscript, identifier in changed + removed])
+            conn.executemany('DELETE FROM scanned_dirs WHERE date = ? AND location = ? AND evalscript = ? AND identifier = ?', removed)
+            conn.executemany('INSERT OR REPLACE INTO scanned_dirs VALUES (?, ?, ?, ?, ?)', [(*key, seen[key]) for key in changed])
+        self.add_entries(entries)
+        return len(changed) + len(removed)
+
+    def rebuild(self):
+        '''
+        Forget the index content and scan the whole image tree again
+        '''
+        with self.lock, self.connect() as conn:
+            conn.execute('DELETE FROM responses')
+            conn.execute('DELETE FROM scanned_dirs')
+        self.reconcile()
+
+    def record_response(self, path):
+        '''
+        Downloader hook, index a single saved response file
+        '''
+        self.add_entries([parse_response_path(path, self.satellite_images_dir)])
+
+    def record_product(self, path):
+        '''
+        Product hook, index a product saved in the indices folder of an ALL response
+        '''
+        self.add_entries([parse_response_path(path, self.satellite_images_dir)])
+
+    def record_dir(self, dir_path):
+        '''
+        Downloader hook, index the responses under a single <date>/<location>/<evalscript> folder
+        '''
+        self.add_entries(self.walk(dir_path))
+
+    def query(self, location=None, evalscript=None, dates=None):
+        '''
+        Get the downloaded responses, optionally filtered
+        args:
+            location: a location name
+            evalscript: an evalscript name
+            dates: a list of dates
+        return:
+            downloaded_data: a dataframe with date, location, evalscript, identifier and file_name columns sorted by date
+        '''
+        conditions = []
+        params = []
+        if location is not None:
+            conditions.append('location = ?')
+            params.append(location)
+        if evalscript is not None:
+            conditions.append('evalscript = ?')
+            params.append(evalscript)
+        if dates is not None:
+            dates = list(dates)
+            conditions.append(f'date IN ({", ".join("?" * len(dates))})')
+            params.extend(dates)
+        sql = f'SELECT {", ".join(INDEX_COLUMNS)} FROM responses'
+        if len(conditions) > 0:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY date, location, evalscript, identifier, file_name'
+        with self.connect() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        return pd.DataFrame(rows, columns=INDEX_COLUMNS)
+
+    def watch_events(self):
+        tree = inotify.adapters.InotifyTree(self.satellite_images_dir)
+        for _, type_names, dir_path, file_name in tree.event_gen(yield_nones=False):
+            if not file_name:
+                continue
+            entry = parse_response_path(os.path.join(dir_path, file_name), self.satellite_images_dir)
+            if entry is None:
+                continue
+            if 'IN_CLOSE_WRITE' in type_names or 'IN_MOVED_TO' in type_names:
+                self.add_entries([entry])
+            elif 'IN_DELETE' in type_names or 'IN_MOVED_FROM' in type_names:
+                self.remove_entry(entry)
+
+    def start_watcher(self):
+        '''
+        Keep the index up to date from inotify events in a background thread.
+        Returns False when inotify is not available, the downloader hooks still update the index.
+        '''
+        if inotify is None or self.watcher is not None:
+            return self.watcher is not None
+        os.makedirs(self.satellite_images_dir, exist_ok=True)
+        self.watcher = threading.Thread(target=self.watch_events, daemon=True)
+        self.watcher.start()
+        return True
+
+
+_DOWNLOAD_INDEX = None
+_DOWNLOAD_INDEX_LOCK = threading.Lock()
+
+
+def get_download_index(watch=False):
+    '''
+    Get the download index of the project, reconciling it with the image tree on first use
+    args:
+        watch: start the inotify watcher. Only the long-lived UI process should, every watcher
+            holds one inotify watch per folder of the image tree and the worker processes would
+            run into the per-user limit.
+    '''
+    global _DOWNLOAD_INDEX
+    with _DOWNLOAD_INDEX_LOCK:
+        if _DOWNLOAD_INDEX is None:
+            _DOWNLOAD_INDEX = DownloadIndex()
+        if watch:
+            _DOWNLOAD_INDEX.start_watcher()
+        return _DOWNLOAD_INDEX
+
+
+def record_product(path):
+    '''
+    Product hook of spectral_indices and biophysical, index a product when it is saved in the image
+    tree. Products of rasters outside of it, e.g. the compositing cubes, are skipped without opening the index.
+    '''
+    if parse_response_path(path) is not None:
+        get_download_index().record_product(path)
@@ -0,0 +1,189 @@
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+import json
+
+
+DEFAULT_MANIFEST_PATH = './data/satellite_images/manifest.sqlite'
+CHUNK_SIZE = 1 << 20
+
+
+def get_output_files(result):
+    '''
+    Collect the response files of a download result: a path, or a dictionary, list or tuple holding
+    paths, e.g. the evalscript -> response path dictionary of new_app.download_combined_responses_from_sentinelhub.
+    Values that are not paths of existing files are ignored.
+    '''
+    if isinstance(result, dict):
+        return [path for key in sorted(result.keys()) for path in get_output_files(result[key])]
+    if isinstance(result, (list, tuple)):
+        return [path for value in result for path in get_output_files(value)]
+    if isinstance(result, (str, os.PathLike)) and os.path.isfile(result):
+        return [os.fspath(result)]
+    return []
+
+
+def describe_files(file_paths):
+    '''
+    Get the byte size and checksum of the response files of a download, as they are on disk
+    args:
+        file_paths: the response files
+    return:
+        size_bytes: the total size of the files
+        checksum: a sha256 of the bytes of the files, in order
+    '''
+    checksum = hashlib.sha256()
+    size_bytes = 0
+    for file_path in file_paths:
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                checksum.update(chunk)
+                size_bytes += len(chunk)
+    return size_bytes, checksum.hexdigest()
+
+
+def describe_output(result):
+    '''
+    Get the response files, byte size and checksum of a download result
+    args:
+        result: the value returned by the download function
+    return:
+        file_paths, size_bytes, checksum: see get_output_files and describe_files
+    '''
+    file_paths = get_output_files(result)
+    return (file_paths, *describe_files(file_paths))
+
+
+class DownloadManifest:
+    '''
+    Crash-safe record of the status of every download job of a regional run.
+    Every status change is its own SQLite transaction, a job is only marked done after
+    its download returned, so an interrupted run resumes from the jobs that are not done.
+    The response files of a done job are recorded with their size and sha256, so a job whose
+    files went missing, were truncated or are corrupt is planned again.
+    '''
+    def __init__(self, path=DEFAULT_MANIFEST_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.create_tables()
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create_tables(self):
+        with self.connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    location TEXT, date TEXT, evalscript TEXT,
+                    status TEXT,
+                    size_bytes INTEGER,
+                    checksum TEXT,
+                    files TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    started_at REAL,
+                    finished_at REAL,
+                    error TEXT
+                )''')
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(jobs)').fetchall()]
+            if 'files' not in columns:
+                conn.execute('ALTER TABLE jobs ADD COLUMN files TEXT')
+            conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+
+    def mark_started(self, job):
+        with self.lock, self.connect() as conn:
+            conn.execute('''
+                INSERT INTO jobs (job_id, location, date, evalscript, status, attempts, started_at)
+                VALUES (?, ?, ?, ?, 'running', 1, ?)
+                ON CONFLICT(job_id) DO UPDATE SET
+                    status = 'running', attempts = attempts + 1, started_at = excluded.started_at,
+                    finished_at = NULL, error = NULL''',
+                (job['job_id'], job['location'], job['date'], job['evalscript'], time.time()))
+
+    def mark_done(self, job, size_bytes, checksum, file_paths=None):
+        with self.lock, self.connect() as conn:
+            conn.execute('''
+                UPDATE jobs SET status = 'done', size_bytes = ?, checksum = ?, files = ?, finished_at = ?
+                WHERE job_id = ?''', (size_bytes, checksum, json.dumps(file_paths or []), time.time(), job['job_id']))
+
+    def mark_failed(self, job, error):
+        with self.lock, self.connect() as conn:
+            conn.execute('''
+                UPDATE jobs SET status = 'failed', error = ?, finished_at = ?
+                WHERE job_id = ?''', (error, time.time(), job['job_id']))
+
+    def get_done_jobs(self):
+        '''
+        The done jobs, as job_id -> (files, size_bytes, checksum)
+        '''
+        with self.connect() as conn:
+            rows = conn.execute("SELECT job_id, files, size_bytes, checksum FROM jobs WHERE status = 'done'").fetchall()
+        return {job_id: (json.loads(files or '[]'), size_bytes, checksum) for job_id, files, size_bytes, checksum in rows}
+
+    def get_done_job_ids(self):
+        return set(self.get_done_jobs().keys())
+
+    def is_intact(self, file_paths, size_bytes, checksum, verify=False):
+        '''
+        Check the recorded files of a done job are still on disk with their recorded size,
+        and with verify their recorded sha256
+        '''
+        if not all(os.path.isfile(file_path) for file_path in file_paths):
+            return False
+        if sum(os.path.getsize(file_path) for file_path in file_paths) != size_bytes:
+            return False
+        return not verify or describe_files(file_paths)[1] == checksum
+
+    def plan(self, jobs, verify=False):
+        '''
+        Drop the jobs the manifest already records as done and whose files are intact.
+        Jobs left running by an interrupted run are planned again.
+        args:
+            jobs: a list of download jobs
+            verify: also hash the files of the done jobs against their checksum, which reads them all,
+                otherwise only their sizes are checked
+        return:
+            pending_jobs: the jobs that still have to run
+        '''
+        done_jobs = self.get_done_jobs()
+        return [job for job in jobs if job['job_id'] not in done_jobs or not self.is_intact(*done_jobs[job['job_id']], verify=verify)]
+
+    def wrap(self, download_fn):
+        '''
+        Wrap a download function so every call is recorded in the manifest
+        args:
+            download_fn: a function taking a job and returning its result, which holds the paths
+                of its response files (see get_output_files)
+        return:
+            recorded_download_fn: the same function, recording status, files, size, checksum and timings
+        '''
+        def recorded_download_fn(job):
+            self.mark_started(job)
+            try:
+                result = download_fn(job)
+            except Exception as e:
+                self.mark_failed(job, repr(e))
+                raise
+            file_paths, size_bytes, checksum = describe_output(result)
+            self.mark_done(job, size_bytes, checksum, file_paths)
+            return result
+        return recorded_download_fn
+
+    def get_summary(self):
+        '''
+        Count the jobs per status
+        '''
+        with self.connect() as conn:
+            rows = conn.execute('SELECT status, COUNT(*), SUM(size_bytes) FROM jobs GROUP BY status').fetchall()
+        return {status: {'jobs': count, 'size_bytes': size_bytes or 0} for status, count, size_bytes in rows}
@@ -0,0 +1,194 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import urlparse
+import catalog_cache
+import evalscript_registry
+
+
+DEFAULT_HOST = 'services.sentinel-hub.com'
+
+
+def get_job_id(polygon, date, evalscript, location):
+    bbox_hash = catalog_cache.get_bbox_hash(polygon.bounds)[:evalscript_registry.HASH_LENGTH]
+    script_hash = evalscript_registry.get_evalscript_hash(evalscript) or '-'
+    return f'{location}/{date}/{evalscript}/{bbox_hash}/{script_hash}'
+
+
+def make_download_job(polygon, date, evalscript, location, host=None, url=None):
+    '''
+    Describe a single (square, date, evalscript) download
+    args:
+        polygon: the shapely polygon of the area of interest
+        date: the acquisition date in YYYY-MM-DD format
+        evalscript: the name of the evalscript (ALL, TRUECOLOR, CLP, FCOVER, NDVI)
+        location: the location name the download is filed under
+        host: the host serving the request, used for the per-host concurrency limit
+        url: optional url of the request, used to derive the host when host is not given
+    return:
+        job: a dictionary describing the download job. Its job_id holds the bbox hash and the
+            evalscript content hash, so a job is new again when the polygon or the script changes.
+    '''
+    job = {
+        'job_id': get_job_id(polygon, date, evalscript, location),
+        'polygon': polygon,
+        'date': date,
+        'evalscript': evalscript,
+        'location': location,
+        'host': host,
+        'url': url,
+    }
+    return job
+
+
+def build_download_jobs(polygons, dates, evalscripts, host=None):
+    '''
+    Build the full cross product of download jobs
+    args:
+        polygons: a dictionary of location name -> shapely polygon
+        dates: a list of dates, or a dictionary of location name -> list of dates
+        evalscripts: a list of evalscript names
+        host: the host serving the requests
+    return:
+        jobs: a list of download jobs
+    '''
+    jobs = []
+    for location, polygon in polygons.items():
+        location_dates = dates[location] if isinstance(dates, dict) else dates
+        for date in location_dates:
+            for evalscript in evalscripts:
+                jobs.append(make_download_job(polygon, date, evalscript, location, host=host))
+    return jobs
+
+
+def get_job_host(job):
+    '''
+    Get the host a job will be sent to
+    args:
+        job: a download job
+    return:
+        host: the host name
+    '''
+    if job.get('host'):
+        return job['host']
+    if job.get('url'):
+        return urlparse(job['url']).netloc
+    return DEFAULT_HOST
+
+
+def download_job_with_sentinelhub(job):
+    '''
+    Default download function, runs the job through new_app.get_any_image_from_sentinelhub
+    args:
+        job: a download job
+    return:
+        result: the (image, final_dir) tuple returned by new_app
+    '''
+    import new_app
+    return new_app.get_any_image_from_sentinelhub(job['polygon'], job['date'], job['evalscript'], job['location'])
+
+
+class HostLimiter:
+    '''
+    Per-host concurrency limits shared by all the workers of a scheduler run.
+    '''
+    def __init__(self, max_per_host=4, host_limits=None):
+        self.max_per_host = max_per_host
+        self.host_limits = host_limits or {}
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def get_semaphore(self, host):
+        '''
+        Get (or lazily create) the semaphore guarding a host
+        '''
+        with self.lock:
+            if host not in self.semaphores:
+                limit = self.host_limits.get(host, self.max_per_host)
+                self.semaphores[host] = threading.BoundedSemaphore(limit)
+            return self.semaphores[host]
+
+    def run(self, host, fn, *args):
+        '''
+        Run fn while holding a slot for host
+        '''
+        with self.get_semaphore(host):
+            return fn(*args)
+
+
+def run_download_job(job, download_fn, limiter):
+    '''
+    Run a single job and record its outcome instead of raising
+    args:
+        job: a download job
+        download_fn: a function taking the job and returning the downloaded result
+        limiter: the HostLimiter of the run
+    return:
+        job_result: a dictionary with the job, its status, result, error and elapsed time
+    '''
+    start = time.time()
+    job_result = {
+        'job_id': job['job_id'],
+        'job': job,
+        'status': 'done',
+        'result': None,
+        'error': None,
+        'elapsed': 0.0,
+    }
+    try:
+        job_result['result'] = limiter.run(get_job_host(job), download_fn, job)
+    except Exception as e:
+        job_result['status'] = 'failed'
+        job_result['error'] = repr(e)
+    job_result['elapsed'] = time.time() - start
+    return job_result
+
+
+def run_download_jobs(jobs, download_fn=None, max_workers=8, max_per_host=4, host_limits=None, progress_callback=None):
+    '''
+    Run a list of download jobs on a bounded worker pool with per-host concurrency limits.
+    A failing job does not stop the others, it is reported in its own result.
+    args:
+        jobs: a list of download jobs (see make_download_job)
+        download_fn: a function taking a job and returning its result, defaults to new_app
+        max_workers: the size of the worker pool
+        max_per_host: the default number of in-flight jobs allowed per host
+        host_limits: optional dictionary of host -> number of in-flight jobs, overrides max_per_host
+        progress_callback: optional function called as progress_callback(n_finished, n_total, job_result)
+    return:
+        results: a list of job results, in the same order as jobs
+    '''
+    if download_fn is None:
+        download_fn = download_job_with_sentinelhub
+    limiter = HostLimiter(max_per_host=max_per_host, host_limits=host_limits)
+    results = [None] * len(jobs)
+    total = len(jobs)
+    finished = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_download_job, job, download_fn, limiter): i for i, job in enumerate(jobs)}
+        for future in as_completed(futures):
+            job_result = future.result()
+            results[futures[future]] = job_result
+            finished += 1
+            if progress_callback is not None:
+                progress_callback(finished, total, job_result)
+    return results
+
+
+def summarize_download_results(results):
+    '''
+    Summarize the outcome of a scheduler run
+    args:
+        results: the list returned by run_download_jobs
+    return:
+        summary: a dictionary with counts, total time and the failed jobs
+    '''
+    failed = [r for r in results if r['status'] == 'failed']
+    summary = {
+        'total': len(results),
+        'done': len(results) - len(failed),
+        'failed': len(failed),
+        'total_job_seconds': sum(r['elapsed'] for r in results),
+        'failures': {r['job_id']: r['error'] for r in failed},
+    }
+    return summary
@@ -0,0 +1,104 @@
+import os
+import hashlib
+import threading
+
+
+SCRIPTS_DIR = './scripts'
+SCRIPT_FILES = {
+    'CAB': 'cab.js',
+    'FCOVER': 'fcover.js',
+    'LAI': 'lai.js',
+    'TRUECOLOR': 'truecolor.js',
+    'CLP': 'clp.js',
+    'ALL': 'all.js',
+    'NDVI': 'ndvi.js',
+    'COMBINED': 'combined.js',
+}
+HASH_LENGTH = 12
+
+
+class EvalscriptRegistry:
+    '''
+    In-memory cache of the evalscripts in scripts/.
+    A script is read once and only re-read when its file changes on disk.
+    '''
+    def __init__(self, scripts_dir=SCRIPTS_DIR, script_files=SCRIPT_FILES):
+        self.scripts_dir = scripts_dir
+        self.script_files = script_files
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def names(self):
+        return list(self.script_files.keys())
+
+    def load(self, script_name):
+        '''
+        Get the cached (text, hash) of a script, reloading it if the file changed
+        '''
+        path = os.path.join(self.scripts_dir, self.script_files[script_name])
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        signature = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            entry = self.entries.get(script_name)
+            if entry is None or entry['signature'] != signature:
+                with open(path) as f:
+                    text = f.read()
+                entry = {
+                    'signature': signature,
+                    'text': text,
+                    'hash': hashlib.sha256(text.encode()).hexdigest()[:HASH_LENGTH],
+                }
+                self.entries[script_name] = entry
+            return entry
+
+    def get(self, script_name):
+        '''
+        Get the text of a script, or None if it does not exist
+        '''
+        if script_name not in self.script_files:
+            return None
+        entry = self.load(script_name)
+        return None if entry is None else entry['text']
+
+    def get_hash(self, script_name):
+        '''
+        Get the content hash of a script, stable as long as the script text does not change
+        '''
+        if script_name not in self.script_files:
+            return None
+        entry = self.load(script_name)
+        return None if entry is None else entry['hash']
+
+
+_REGISTRY = EvalscriptRegistry()
+
+
+def get_evalscript_registry():
+    return _REGISTRY
+
+
+def get_evalscript(script_name):
+    return _REGISTRY.get(script_name)
+
+
+def get_evalscript_hash(script_name):
+    return _REGISTRY.get_hash(script_name)
+
+
+def get_artifact_file_name(prefix, evalscript, extension):
+    '''
+    Name a feature artifact derived from an evalscript, e.g. training_data_ALL_<hash>.pkl.
+    Editing a script changes the names of the artifacts derived from it and only those.
+    args:
+        prefix: the artifact kind, e.g. training_data or processed_data
+        evalscript: the evalscript the artifact is derived from
+        extension: the file extension without the dot
+    return:
+        file_name: the artifact file name
+    '''
+    script_hash = get_evalscript_hash(evalscript)
+    if script_hash is None:
+        return f'{prefix}_{evalscript}.{extension}'
+    return f'{prefix}_{evalscript}_{script_hash}.{extension}'
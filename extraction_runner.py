@@ -0,0 +1,153 @@
+import os
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+
+STAGES = ['training_data', 'processed_data']
+# Each worker runs one unit on one core, nested BLAS / OpenMP threads would only compete for them
+WORKER_THREAD_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS']
+
+
+def make_extraction_unit(location, evalscript, stage='training_data', dates=None, year='2021', other_flag=False):
+    '''
+    Describe the extraction of one (location, evalscript), the unit of work of the pool
+    args:
+        location: the location name
+        evalscript: the evalscript name
+        stage: 'training_data' builds the per-date table of data_reader.get_training_data_evalscript,
+            'processed_data' labels it into the feature store with data_processor.get_processed_data
+        dates: the dates of the training data
+        year: the year of the training data
+        other_flag: label the polygons as Other, see data_processor.get_processed_data
+    return:
+        unit: a dictionary with a unit_id
+    '''
+    if stage not in STAGES:
+        raise ValueError(f'Invalid stage {stage}, expected one of {STAGES}')
+    return {
+        'unit_id': f'{stage}/{location}/{evalscript}',
+        'location': location,
+        'evalscript': evalscript,
+        'stage': stage,
+        'dates': dates,
+        'year': year,
+        'other_flag': other_flag,
+    }
+
+
+def extract_unit(unit):
+    '''
+    Default unit function. The table is written to disk by the stage itself and only its
+    shape travels back to the parent process.
+    '''
+    if unit['stage'] == 'training_data':
+        import data_reader
+        table = data_reader.get_training_data_evalscript(location=unit['location'], evalscript=unit['evalscript'], dates=unit['dates'], year=unit['year'])
+    else:
+        import data_processor
+        raw_data = data_processor.load_raw_data(location=unit['location'], evalscript=unit['evalscript'])
+        table = data_processor.get_processed_data(raw_data, location=unit['location'], evalscript=unit['evalscript'], other_flag=unit['other_flag'])
+    return {'n_rows': len(table), 'n_columns': len(table.columns)}
+
+
+def run_extraction_unit(unit, unit_fn=None):
+    '''
+    Run one unit in a worker process, a failure is reported in the result instead of raised
+    '''
+    if unit_fn is None:
+        unit_fn = extract_unit
+    start = time.time()
+    unit_result = {'unit_id': unit['unit_id'], 'unit': unit, 'status': 'done', 'result': None, 'error': None, 'elapsed': 0.0, 'pid': os.getpid()}
+    try:
+        unit_result['result'] = unit_fn(unit)
+    except Exception as e:
+        unit_result['status'] = 'failed'
+        unit_result['error'] = repr(e)
+    unit_result['elapsed'] = time.time() - start
+    return unit_result
+
+
+def init_worker():
+    for variable in WORKER_THREAD_VARIABLES:
+        os.environ.setdefault(variable, '1')
+
+
+def run_extraction_units(units, unit_fn=None, max_workers=None, progress_callback=None, start_method='spawn'):
+    '''
+    Fan (location, evalscript) units out across a process pool. Every unit writes its own outputs,
+    so the units do not wait on each other and the wall time goes down with the number of cores.
+    args:
+        units: a list of extraction units (see make_extraction_unit)
+        unit_fn: a picklable module-level function taking a unit, defaults to extract_unit
+        max_workers: the number of processes, defaults to the CPU count
+        progress_callback: optional function called as progress_callback(n_finished, n_total, unit_result)
+        start_method: the multiprocessing start method. spawn does not inherit the threads of a
+            running streamlit server, which fork would.
+    return:
+        results: a list of unit results in the same order as units, whatever order they finished in.
+            A unit that failed has status 'failed' and does not affect the others.
+    '''
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    results = [None] * len(units)
+    total = len(units)
+    finished = 0
+    context = multiprocessing.get_context(start_method)
+
+    def run_pool(indices, n_workers):
+        # Returns the units taken down by a worker that died, a dead worker breaks the whole pool
+        nonlocal finished
+        broken = []
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=context, initializer=init_worker) as executor:
+            futures = {executor.submit(run_extraction_unit, units[i], unit_fn): i for i in indices}
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except BrokenProcessPool as e:
+                    results[i] = make_failed_result(units[i], e)
+                    broken.append(i)
+                    continue
+                except Exception as e:
+                    results[i] = make_failed_result(units[i], e)
+                finished += 1
+                if progress_callback is not None:
+                    progress_callback(finished, total, results[i])
+        return sorted(broken)
+
+    pending = list(range(len(units)))
+    while len(pending) > 0:
+        broken = run_pool(pending, max(1, min(max_workers, len(pending))))
+        if len(broken) < len(pending):
+            pending = broken
+            continue
+        # Nothing got through, run the remaining units one pool each so a crashing unit only fails itself
+        for i in broken:
+            if len(run_pool([i], 1)) > 0:
+                finished += 1
+                if progress_callback is not None:
+                    progress_callback(finished, total, results[i])
+        break
+    return results
+
+
+def make_failed_result(unit, error):
+    return {'unit_id': unit['unit_id'], 'unit': unit, 'status': 'failed', 'result': None, 'error': repr(error), 'elapsed': 0.0, 'pid': None}
+
+
+def summarize_extraction_results(results):
+    '''
+    Summarize the outcome of a pool run, like download_scheduler.summarize_download_results
+    '''
+    failed = [r for r in results if r['status'] == 'failed']
+    summary = {
+        'total': len(results),
+        'done': len(results) - len(failed),
+        'failed': len(failed),
+        'total_unit_seconds': sum(r['elapsed'] for r in results),
+        'workers': len(set(r['pid'] for r in results if r['pid'] is not None)),
+        'failures': {r['unit_id']: r['error'] for r in failed},
+    }
+    return summary
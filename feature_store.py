@@ -0,0 +1,193 @@
+import os
+import re
+import glob
+import shutil
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+import pixel_table
+import evalscript_registry
+
+
+FEATURE_STORE_DIR = './data/feature_store'
+ROW_GROUP_SIZE = 64 * 1024
+PARTITION_SCHEMA = pa.schema([('location', pa.string()), ('year', pa.int32()), ('evalscript', pa.string())])
+KEY_COLUMNS = ['location', 'year'] + pixel_table.GRID_COLUMNS
+DATE_PATTERN = re.compile(r'_(\d{4})-\d{2}-\d{2}$')
+
+
+def get_partition_dir(location, year, evalscript, store_dir=FEATURE_STORE_DIR):
+    return os.path.join(store_dir, f'location={location}', f'year={int(year)}', f'evalscript={evalscript}')
+
+
+def get_year_from_columns(columns):
+    '''
+    Get the acquisition year of a table from its <band>_<YYYY-MM-DD> column names
+    '''
+    years = [int(match.group(1)) for match in (DATE_PATTERN.search(str(col)) for col in columns) if match is not None]
+    if len(years) == 0:
+        return None
+    values, counts = np.unique(years, return_counts=True)
+    return int(values[np.argmax(counts)])
+
+
+def write_features(table, location, evalscript, year=None, store_dir=FEATURE_STORE_DIR, row_group_size=ROW_GROUP_SIZE):
+    '''
+    Write a pixel table to its location/year/evalscript partition, replacing what was there.
+    Pixel coordinates are stored with it so bbox filters can skip whole row groups.
+    args:
+        table: a pixel table with grid_id, row and col columns, e.g. a processed table with Labels
+        location: the location name
+        evalscript: the evalscript the features come from
+        year: the acquisition year, read from the date suffix of the columns when not given
+        store_dir: the root of the store
+        row_group_size: the number of rows per row group, the unit of sampling
+    return:
+        partition_dir: the folder the partition was written to
+    '''
+    if year is None:
+        year = get_year_from_columns(table.columns)
+    if year is None:
+        raise ValueError(f'Cannot find the year of the {location} {evalscript} table, give it explicitly')
+    partition_dir = get_partition_dir(location, year, evalscript, store_dir)
+    table = table.reset_index(drop=True)
+    table = table.drop(columns=[col for col in PARTITION_SCHEMA.names if col in table.columns])
+    if 'longitude' not in table.columns:
+        table = pixel_table.add_coordinates(table)
+    table.columns = [str(col) for col in table.columns]
+    temp_dir = partition_dir + '.tmp'
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    file_name = evalscript_registry.get_artifact_file_name('part', evalscript, 'parquet')
+    pq.write_table(pa.Table.from_pandas(table, preserve_index=False), os.path.join(temp_dir, file_name), row_group_size=row_group_size)
+    shutil.rmtree(partition_dir, ignore_errors=True)
+    os.replace(temp_dir, partition_dir)
+    return partition_dir
+
+
+def has_partition(location, evalscript, year=None, store_dir=FEATURE_STORE_DIR):
+    '''
+    Check whether a partition was written from the current version of its evalscript
+    '''
+    year_pattern = '*' if year is None else str(int(year))
+    file_name = evalscript_registry.get_artifact_file_name('part', evalscript, 'parquet')
+    return len(glob.glob(os.path.join(store_dir, f'location={location}', f'year={year_pattern}', f'evalscript={evalscript}', file_name))) > 0
+
+
+def get_years(store_dir=FEATURE_STORE_DIR, locations=None):
+    '''
+    The years held by the store, for all the locations or the given ones
+    '''
+    years = set()
+    for location in locations or ['*']:
+        for path in glob.glob(os.path.join(store_dir, f'location={location}', 'year=*')):
+            years.add(int(os.path.basename(path).split('=', 1)[1]))
+    return sorted(years)
+
+
+def open_dataset(store_dir=FEATURE_STORE_DIR, locations=None, years=None, evalscripts=None):
+    '''
+    Open the partitions matching the given locations, years and evalscripts as one dataset.
+    Partitions are selected from the folder names, so the other ones are never opened.
+    The schemas of the partitions are unified, columns missing from a partition read as nulls.
+    '''
+    patterns = []
+    for location in locations or ['*']:
+        for year in years or ['*']:
+            for evalscript in evalscripts or ['*']:
+                patterns.append(os.path.join(store_dir, f'location={location}', f'year={year}', f'evalscript={evalscript}', '*.parquet'))
+    paths = sorted(set(path for pattern in patterns for path in glob.glob(pattern)))
+    if len(paths) == 0:
+        return None
+    schemas = [pq.read_schema(path) for path in paths]
+    schema = pa.unify_schemas([schema.remove_metadata() for schema in schemas] + [PARTITION_SCHEMA])
+    partitioning = ds.partitioning(PARTITION_SCHEMA, flavor='hive')
+    return ds.dataset(paths, schema=schema, format='parquet', partitioning=partitioning, partition_base_dir=store_dir)
+
+
+def get_filter(labels=None, bbox=None):
+    '''
+    Build the row filter pushed down to the parquet reader
+    args:
+        labels: optional list of labels to keep
+        bbox: optional [min_lon, min_lat, max_lon, max_lat]
+    return:
+        expression: a pyarrow expression or None
+    '''
+    expression = None
+    conditions = []
+    if labels is not None:
+        conditions.append(ds.field('Labels').isin(list(labels)))
+    if bbox is not None:
+        min_lon, min_lat, max_lon, max_lat = bbox
+        conditions.append((ds.field('longitude') >= min_lon) & (ds.field('longitude') <= max_lon))
+        conditions.append((ds.field('latitude') >= min_lat) & (ds.field('latitude') <= max_lat))
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def read_features(store_dir=FEATURE_STORE_DIR, locations=None, years=None, evalscripts=None, columns=None,
+                  labels=None, bbox=None, sample_fraction=None, seed=0):
+    '''
+    Read from the feature store, materialising only the requested columns and rows
+    args:
+        store_dir: the root of the store
+        locations: optional list of locations, the other partitions are not opened
+        years: optional list of years
+        evalscripts: optional list of evalscripts
+        columns: optional list of feature columns, the key and label columns are always read
+        labels: optional list of labels to keep, pushed down to the row groups
+        bbox: optional [min_lon, min_lat, max_lon, max_lat], pushed down to the row groups
+        sample_fraction: optional fraction of the row groups to read, picked at random with seed
+        seed: the seed of the row-group sample
+    return:
+        features: a pandas dataframe with the location, year and evalscript partition columns
+    '''
+    dataset = open_dataset(store_dir, locations, years, evalscripts)
+    if dataset is None:
+        return pd.DataFrame()
+    if columns is not None:
+        columns = list(dict.fromkeys(KEY_COLUMNS + ['evalscript', 'Labels'] + list(columns)))
+        columns = [col for col in columns if col in dataset.schema.names]
+    expression = get_filter(labels, bbox)
+    if sample_fraction is None:
+        table = dataset.to_table(columns=columns, filter=expression)
+    else:
+        rng = np.random.default_rng(seed)
+        tables = []
+        for fragment in dataset.get_fragments():
+            row_groups = fragment.split_by_row_group(expression)
+            n_sampled = int(np.ceil(len(row_groups) * sample_fraction))
+            for index in sorted(rng.choice(len(row_groups), size=n_sampled, replace=False)):
+                tables.append(row_groups[index].to_table(schema=dataset.schema, columns=columns, filter=expression))
+        if len(tables) == 0:
+            return pd.DataFrame()
+        table = pa.concat_tables(tables)
+    return table.to_pandas()
+
+
+def read_location_features(store_dir=FEATURE_STORE_DIR, locations=None, years=None, evalscripts=None, columns=None,
+                           labels=None, bbox=None, sample_fraction=None, seed=0):
+    '''
+    Same as read_features with the evalscripts of each pixel side by side, one row per pixel
+    like data_processor.merge_final_processed_data_evalscripts_for_location builds
+    '''
+    if evalscripts is None:
+        evalscripts = sorted(set(os.path.basename(path).split('=', 1)[1] for path in glob.glob(os.path.join(store_dir, '*', '*', 'evalscript=*'))))
+    merged = None
+    for evalscript in evalscripts:
+        features = read_features(store_dir, locations, years, [evalscript], columns, labels, bbox, sample_fraction, seed)
+        if len(features) == 0:
+            continue
+        features = features.drop(columns=['evalscript'])
+        if merged is None:
+            merged = features
+        else:
+            features = features.drop(columns=[col for col in ['Labels', 'latitude', 'longitude'] if col in features.columns])
+            merged = merged.merge(features, on=KEY_COLUMNS, how='inner')
+    if merged is None:
+        return pd.DataFrame()
+    return merged
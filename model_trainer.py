@@ -13,10 +13,33 @@ import os
 import pickle
 import geopandas as gpd
 import streamlit as st
+import pixel_table
+import feature_store
 
 
-def read_all_processed_data(file_path='./data/joblibs/processed_data.joblib'):
-    processed_data_gdf = joblib.load(file_path)
+DEFAULT_PROCESSED_DATA_PATH = './data/joblibs/processed_data.joblib'
+
+
+def read_all_processed_data(file_path=None, locations=None, years=None, columns=None, sample_fraction=None):
+    '''
+    Read the labelled pixels. With file_path the joblib file is read, otherwise the feature store,
+    where unlabelled pixels are filtered out before they are materialised. The store falls back to
+    the default joblib file while it is empty.
+    The feature columns are suffixed with their acquisition dates, so the tables of two years do not
+    line up: when the store holds several years, years has to select one of them.
+    '''
+    if file_path is None:
+        store_years = feature_store.get_years(locations=locations)
+        years = store_years if years is None else [int(year) for year in years if int(year) in store_years]
+        if len(years) > 1:
+            raise ValueError(f'The feature store holds the years {years}, whose date columns do not line up, read one of them at a time')
+        processed_data_gdf = pd.DataFrame()
+        if len(years) == 1:
+            processed_data_gdf = feature_store.read_location_features(locations=locations, years=years, columns=columns, labels=[0, 1, 2], sample_fraction=sample_fraction)
+        if len(processed_data_gdf) == 0:
+            file_path = DEFAULT_PROCESSED_DATA_PATH
+    if file_path is not None:
+        processed_data_gdf = joblib.load(file_path)
     processed_data_gdf = processed_data_gdf[processed_data_gdf['Labels'] != -1]
     return processed_data_gdf
 
@@ -54,21 +77,108 @@ def balance_data_downsample(processed_data_gdf):
     return processed_data_downsampled
 
 
-def train_and_predict(df, use_october=False, n_estimators=50, max_depth=10, test_size=0.25):
+def get_feature_names(data, use_october=False):
+    '''
+    Names of the features a model is trained on, from a pixel dataframe or a training matrix
+    '''
+    columns = data.columns if isinstance(data, pd.DataFrame) else data[2]['columns']
     if not use_october:
-        columns = df.columns
-        columns_october = [col for col in columns if '-10-' in col]
-        df = df.drop(columns_october, axis=1)
-    y = df['Labels']
-    X = df.drop(['Labels', 'geometry', 'latitude', 'longitude', 'location'], axis=1)
-    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size)
+        columns = [col for col in columns if '-10-' not in col]
+    return [col for col in columns if col not in pixel_table.META_COLUMNS]
+
+
+DEFAULT_PREDICT_CHUNK_ROWS = 2**18
+
+
+def get_training_arrays(data, use_october=False):
+    '''
+    Get the features, labels and feature names of a pixel dataframe or of a training matrix
+    args:
+        data: a dataframe with a Labels column, or the (features, labels, schema) tuple of
+            training_matrix.load_training_matrix
+        use_october: keep the October columns
+    return:
+        X, y, feature_names: for a training matrix X is the memmap itself unless October columns
+            have to be dropped, and the unlabelled rows (-1) are kept, see split_training_rows
+    '''
+    if isinstance(data, pd.DataFrame):
+        df = data
+        if not use_october:
+            columns_october = [col for col in df.columns if '-10-' in col]
+            df = df.drop(columns_october, axis=1)
+        y = df['Labels']
+        X = df.drop(pixel_table.META_COLUMNS, axis=1, errors='ignore')
+        return X, y, list(X.columns)
+    X, y, schema = data
+    feature_names = get_feature_names(data, use_october=use_october)
+    if len(feature_names) < len(schema['columns']):
+        # Build the matrix without the October dates to avoid this copy
+        X = X[:, [schema['columns'].index(col) for col in feature_names]]
+    return X, y, feature_names
+
+
+def split_training_rows(y, row_order, test_size=0.25):
+    '''
+    Train / test split of a training matrix along its stored row_order permutation, as boolean masks
+    over its rows instead of copies of them. Unlabelled rows are in neither.
+    return:
+        train_rows, test_rows: two boolean arrays of len(y)
+    '''
+    row_order = row_order[y[row_order] != -1]
+    n_test = int(np.ceil(len(row_order) * test_size))
+    train_rows = np.zeros(len(y), dtype=bool)
+    test_rows = np.zeros(len(y), dtype=bool)
+    test_rows[row_order[:n_test]] = True
+    train_rows[row_order[n_test:]] = True
+    return train_rows, test_rows
+
+
+def fit_rows(clf, X, y, rows):
+    '''
+    Fit a classifier on the masked rows of X. The other rows get a zero sample weight, so a memmapped
+    matrix is handed to the estimator as is instead of being copied into memory.
+    '''
+    # Labels of zero-weight rows do not count, only keep -1 out of the classes
+    y = np.where(rows, y, y[rows][0])
+    return clf.fit(X, y, sample_weight=rows.astype(np.float32))
+
+
+def predict_rows(clf, X, rows, chunk_rows=DEFAULT_PREDICT_CHUNK_ROWS):
+    '''
+    Predict the masked rows of X, reading it forward one contiguous slice at a time so only a chunk
+    of a memmapped matrix is in memory
+    '''
+    predictions = [np.empty(0, dtype=clf.classes_.dtype)]
+    for start in range(0, len(rows), chunk_rows):
+        chunk = rows[start:start + chunk_rows]
+        if chunk.any():
+            predictions.append(clf.predict(X[start:start + chunk_rows][chunk]))
+    return np.concatenate(predictions)
+
+
+def train_and_predict(df, use_october=False, n_estimators=50, max_depth=10, test_size=0.25):
+    '''
+    Train and evaluate a random forest
+    args:
+        df: a dataframe with a Labels column, or the (features, labels, schema) tuple of
+            training_matrix.load_training_matrix, which the forest reads without copying it
+    '''
+    X, y, _ = get_training_arrays(df, use_october=use_october)
     clf = RandomForestClassifier(n_estimators=n_estimators, max_depth=max_depth, random_state=0, n_jobs=-1, verbose=2)
-    
+    if isinstance(df, pd.DataFrame):
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size)
+    else:
+        train_rows, test_rows = split_training_rows(y, df[2]['row_order'], test_size=test_size)
+        y_test = y[test_rows]
+
     with st.spinner('Training model...'):
-        clf.fit(X_train, y_train)
+        if isinstance(df, pd.DataFrame):
+            clf.fit(X_train, y_train)
+        else:
+            fit_rows(clf, X, y, train_rows)
 
     with st.spinner('Evaluating model...'):
-        y_pred = clf.predict(X_test)
+        y_pred = clf.predict(X_test) if isinstance(df, pd.DataFrame) else predict_rows(clf, X, test_rows)
         st.write('Accuracy score: ', accuracy_score(y_test, y_pred))
         class_report = classification_report(y_test, y_pred, output_dict=True)
         class_report_df = pd.DataFrame(class_report)
@@ -84,13 +194,22 @@ def train_and_predict(df, use_october=False, n_estimators=50, max_depth=10, test
 
     return clf
 
+def predict_batches(clf, batches, feature_columns):
+    '''
+    Run a trained model over the batches of data_reader.iter_training_batches, one batch at a time
+    args:
+        clf: the trained classifier
+        batches: an iterable of batch dataframes
+        feature_columns: the columns the classifier was trained on, in training order
+    return:
+        predictions: a generator of series of predicted labels indexed by pixel position
+    '''
+    for batch in batches:
+        yield pd.Series(clf.predict(batch[feature_columns]), index=batch.index, name='Predictions')
+
 #Feature importance
 def feature_importance_plot(clf, df, use_october=False):
-    if not use_october:
-        columns = df.columns
-        columns_october = [col for col in columns if '-10-' in col]
-        df = df.drop(columns_october, axis=1)
-    X = df.drop(['Labels', 'geometry', 'latitude', 'longitude', 'location'], axis=1)
+    feature_names = np.array(get_feature_names(df, use_october=use_october))
     feature_importance = clf.feature_importances_
     feature_importance = 100.0 * (feature_importance / feature_importance.max())
     sorted_idx = np.argsort(feature_importance)
@@ -99,19 +218,19 @@ def feature_importance_plot(clf, df, use_october=False):
     fig, ax = plt.subplots(figsize=(10, 3))
     ax.barh(pos, feature_importance[sorted_idx], align='center')
     ax.set_yticks(pos)
-    ax.set_yticklabels(X.columns[sorted_idx])
+    ax.set_yticklabels(feature_names[sorted_idx])
     ax.set_xlabel('Relative Importance')
     ax.set_title('Variable Importance')
     st.pyplot(fig)
     return fig
 
-def read_and_dwonsample_data(file_path='./data/joblibs/processed_data.joblib', remove_label = -1):
-    downsampled_data_path = os.path.join('./data/joblibs', f'processed_data_downsampled_{remove_label}.joblib')
+def read_and_dwonsample_data(file_path=None, remove_label = -1, year=None):
+    year_suffix = '' if year is None else f'_{year}'
+    downsampled_data_path = os.path.join('./data/joblibs', f'processed_data_downsampled_{remove_label}{year_suffix}.joblib')
     if os.path.exists(downsampled_data_path):
         processed_data_downsampled = joblib.load(downsampled_data_path)
         return processed_data_downsampled
-    processed_data_gdf = joblib.load(file_path)
-    processed_data_gdf = processed_data_gdf[processed_data_gdf['Labels'] != -1]
+    processed_data_gdf = read_all_processed_data(file_path, years=None if year is None else [year])
     processed_data_downsampled = balance_data_downsample(processed_data_gdf)
 
     if remove_label != -1:
@@ -132,7 +251,9 @@ def normalize_data(df):
     return df
 
 def main():
-    processed_data_downsampled = read_and_dwonsample_data()
+    store_years = feature_store.get_years()
+    year = st.selectbox('Year', store_years) if len(store_years) > 1 else None
+    processed_data_downsampled = read_and_dwonsample_data(year=year)
     processed_data_downsampled = normalize_data(processed_data_downsampled)
 
     st.write('Number of data points ', len(processed_data_downsampled))
@@ -1,29 +1,65 @@
 import streamlit as st
 import new_utils
+import catalog_search
+import tiling
+import download_index
+import evalscript_registry
+import async_engine
+import raster_cache
+import download_scheduler
+import spectral_indices
+import biophysical
 import numpy as np
 import pandas as pd
 import geopandas as gpd
 import os
+import io
+import json
+import tarfile
+import hashlib
 import matplotlib.pyplot as plt
 import folium
 from streamlit_folium import st_folium
 from senHub import SenHub
 from sentinelhub import SHConfig
 from sentinelhub import MimeType
+from sentinelhub.decoding import decode_data
+from sh_session import get_session_manager
+
+
+_SENTINELHUB_API_CONFIG = None
+
+# 'blocking' sends each request through SentinelHubRequest, 'async' through async_engine
+DOWNLOAD_ENGINE = 'blocking'
+
+# Outputs of scripts/combined.js and the format each one is saved with by the single-evalscript getters
+COMBINED_OUTPUTS = {
+    'ALL': MimeType.TIFF,
+    'TRUECOLOR': MimeType.PNG,
+    'CLP': MimeType.TIFF,
+    'FCOVER': MimeType.TIFF,
+    'NDVI': MimeType.TIFF,
+}
 
 
 def get_sentinelhub_api_config():
-    config = SHConfig()
-    config.instance_id       = 'a2624765-c205-4c43-9ad0-ef0c412e4ecc'   
-    config.sh_client_id      = '281a304c-4b24-4834-88a9-67716cb53b5f' 
-    config.sh_client_secret  = '->i.[t4J@Qo/-m#O+O@oyiJJG9f?d:GOHYOh[C^K'
-    return config
+    global _SENTINELHUB_API_CONFIG
+    if _SENTINELHUB_API_CONFIG is None:
+        config = SHConfig()
+        config.instance_id       = 'a2624765-c205-4c43-9ad0-ef0c412e4ecc'   
+        config.sh_client_id      = '281a304c-4b24-4834-88a9-67716cb53b5f' 
+        config.sh_client_secret  = '->i.[t4J@Qo/-m#O+O@oyiJJG9f?d:GOHYOh[C^K'
+        _SENTINELHUB_API_CONFIG = config
+    return _SENTINELHUB_API_CONFIG
 
 
-def get_sentinelhub_api_token():
+def get_sentinelhub_api_session_manager():
     config = get_sentinelhub_api_config()
-    token = SenHub(config).token
-    return token
+    return get_session_manager(config)
+
+
+def get_sentinelhub_api_token():
+    return get_sentinelhub_api_session_manager().token
 
 def get_centroid_of_polygon(polygon):
     centroid = polygon.centroid
@@ -48,13 +84,21 @@ def get_folium_map(center = [15,32], zoom_start = 12, basemap = 'Google Satellit
 
 def get_available_dates_from_sentinelhub(polygon, year='2023'):
     bounds = get_bounds_of_polygon(polygon)
-    token = get_sentinelhub_api_token()
+    session_manager = get_sentinelhub_api_session_manager()
     start_date = f'{year}-01-01'
     end_date = f'{year}-12-31'
-    dates = new_utils.get_available_dates_from_sentinelhub(bounds, token, start_date, end_date)
+    dates = new_utils.get_available_dates_from_sentinelhub(bounds, session_manager.token, start_date, end_date, session=session_manager.http_session)
     return dates
 
 
+def get_available_dates_for_squares(squares_gdf, start_year='2023', end_year=None):
+    if end_year is None:
+        end_year = start_year
+    session_manager = get_sentinelhub_api_session_manager()
+    square_dates = catalog_search.get_available_dates_for_squares(squares_gdf, start_year, end_year, session_manager.http_session, session_manager.token)
+    return square_dates
+
+
 def get_final_dir(location_name, date, evalscript):
     data_dir = './data/satellite_images'
     os.makedirs(data_dir, exist_ok=True)
@@ -68,80 +112,320 @@ def get_final_dir(location_name, date, evalscript):
     return final_dir
 
 
+# The single-evalscript getters of the module API. They wrap get_any_image_from_sentinelhub, so they go
+# through the raster cache and never read the request.json beside a response, which aliases lack.
 def get_true_color_image_from_sentinelhub(polygon, date, location='unknown'):
-    final_dir = get_final_dir(location, date, 'TRUECOLOR')
-    bbox = get_bounds_of_polygon(polygon)
-    evalscript_true_color = new_utils.get_sentinelhub_api_evalscript('TRUECOLOR')
-    config = get_sentinelhub_api_config()
-    sen_obj = SenHub(config, mime_type = MimeType.PNG)
-    sen_obj.set_dir(final_dir)
-    sen_obj.make_bbox(bbox)
-    sen_obj.make_request(evalscript_true_color, date)
-    imgs = sen_obj.download_data()
-    return imgs[0], final_dir
+    return get_any_image_from_sentinelhub(polygon, date, 'TRUECOLOR', location)
 
 def get_fcover_image_from_sentinelhub(polygon, date, location='unknown'):
-    final_dir = get_final_dir(location, date, 'FCOVER')
-    bbox = get_bounds_of_polygon(polygon)
-    evalscript_fcover = new_utils.get_sentinelhub_api_evalscript('FCOVER')
-    config = get_sentinelhub_api_config()
-    sen_obj = SenHub(config)
-    sen_obj.set_dir(final_dir)
-    sen_obj.make_bbox(bbox)
-    sen_obj.make_request(evalscript_fcover, date)
-    imgs = sen_obj.download_data()
-    return imgs[0], final_dir
+    return get_any_image_from_sentinelhub(polygon, date, 'FCOVER', location)
 
 def get_cloud_coverage_from_sentinelhub(polygon, date, location='unknown'):
-    final_dir = get_final_dir(location, date, 'CLP')
+    return get_any_image_from_sentinelhub(polygon, date, 'CLP', location)
+
+def get_ndvi_image_from_sentinelhub(polygon, date, location='unknown'):
+    return get_any_image_from_sentinelhub(polygon, date, 'NDVI', location)
+
+def get_all_bands_image_from_sentinelhub(polygon, date, location='unknown'):
+    return get_any_image_from_sentinelhub(polygon, date, 'ALL', location)
+
+def get_any_image_from_sentinelhub(polygon, date, evalscript, location='unknown'):
+    if evalscript not in COMBINED_OUTPUTS:
+        return None, None
+    if DOWNLOAD_ENGINE == 'async':
+        return get_image_with_async_engine(polygon, date, evalscript, location)
+    response_path, final_dir = download_response_from_sentinelhub(polygon, date, evalscript, location)
+    with open(response_path, 'rb') as f:
+        img = decode_data(f.read(), COMBINED_OUTPUTS[evalscript])
+    return img, final_dir
+
+
+def download_response_from_sentinelhub(polygon, date, evalscript, location='unknown'):
+    '''
+    Make sure the response of a single-evalscript request is on disk, through the raster cache,
+    without decoding it. Returns (response_path, final_dir).
+    '''
+    sen_obj, final_dir = make_sentinelhub_request(polygon, date, evalscript, location)
+    cache = raster_cache.get_raster_cache()
+    key = get_raster_cache_key(sen_obj, date, evalscript)
+    response_path = get_response_path(sen_obj, final_dir)
+    if cache.add_alias(key, response_path, location, date, evalscript) is None:
+        sen_obj.download_data(decode=False)
+        cache.put(key, response_path)
+        cache.add_alias(key, response_path, location, date, evalscript)
+    download_index.get_download_index().record_response(response_path)
+    return response_path, final_dir
+
+
+def probe_cloud_cover_from_sentinelhub(polygon, date, location='unknown', resolution=160):
+    '''
+    Download the CLP of a date at a coarse resolution, a few kilobytes instead of the full raster.
+    Probes are filed under a CLP_PROBE folder, which download_index leaves out, and aliased as
+    CLP_PROBE in the raster cache, so they are never mistaken for full-resolution CLP images.
+    Returns (clp, response_path, downloaded), downloaded is False when the probe came from the raster cache.
+    '''
+    final_dir = get_final_dir(location, date, 'CLP_PROBE')
+    config = get_sentinelhub_api_config()
+    sen_obj = SenHub(config, resolution=resolution)
+    sen_obj.set_dir(final_dir)
+    sen_obj.make_bbox(get_bounds_of_polygon(polygon))
+    sen_obj.make_request(new_utils.get_sentinelhub_api_evalscript('CLP'), date)
+    cache = raster_cache.get_raster_cache()
+    key = get_raster_cache_key(sen_obj, date, 'CLP')
+    response_path = get_response_path(sen_obj, final_dir)
+    downloaded = cache.add_alias(key, response_path, location, date, 'CLP_PROBE') is None
+    if downloaded:
+        sen_obj.download_data(decode=False)
+        cache.put(key, response_path)
+        cache.add_alias(key, response_path, location, date, 'CLP_PROBE')
+    with open(response_path, 'rb') as f:
+        clp = decode_data(f.read(), MimeType.TIFF)
+    return clp, response_path, downloaded
+
+
+def get_product_images_from_sentinelhub(polygon, date, names, location='unknown'):
+    '''
+    Get spectral_indices products (NDVI, TRUECOLOR, EVI...) computed locally from the ALL response
+    instead of one request each. The ALL response comes from the raster cache when it was already downloaded.
+    Returns a dictionary of name -> (image, product_dir).
+    '''
+    response_path, _ = download_response_from_sentinelhub(polygon, date, 'ALL', location)
+    product_paths = spectral_indices.compute_product_rasters(response_path, names)
+    return {name: (spectral_indices.read_product(response_path, name), os.path.dirname(product_paths[name])) for name in names}
+
+
+def get_biophysical_images_from_sentinelhub(polygon, date, names=None, location='unknown', acquisition_datetime=None, view_angles=None):
+    '''
+    Get FCOVER, LAI or CAB from the NumPy port of their networks run on the (raster-cached) ALL response,
+    instead of one full-raster request each. Sun angles are computed from acquisition_datetime, e.g. the
+    catalog datetime of the scene, or from the date at the Sentinel-2 overpass time.
+    Returns a dictionary of name -> (image, product_dir).
+    '''
+    if names is None:
+        names = biophysical.NETWORKS
+    response_path, _ = download_response_from_sentinelhub(polygon, date, 'ALL', location)
+    images = {}
+    for name in names:
+        product_path = biophysical.compute_network_raster(response_path, name, acquisition_datetime or date, view_angles=view_angles)
+        images[name] = (biophysical.read_product(product_path), os.path.dirname(product_path))
+    return images
+
+
+def get_raster_cache_key(sen_obj, date, evalscript, output='default'):
+    '''
+    Key of a prepared request in the raster cache, independent of the location name
+    '''
+    bbox = list(sen_obj.bbox)
+    crs = sen_obj.bbox.crs.ogc_string()
+    return raster_cache.get_cache_key(bbox, crs, sen_obj.resolution, sen_obj.bbox_size, date, sen_obj.data_source.api_id, evalscript, output)
+
+
+def get_response_path(sen_obj, final_dir):
+    return os.path.join(final_dir, sen_obj.get_request_hash(), f'response.{sen_obj.mime_type.extension}')
+
+
+def make_sentinelhub_request(polygon, date, evalscript, location='unknown'):
+    '''
+    Prepare the same request the single-evalscript getters send, without sending it
+    '''
+    final_dir = get_final_dir(location, date, evalscript)
     bbox = get_bounds_of_polygon(polygon)
-    evalscript_cloud_coverage = new_utils.get_sentinelhub_api_evalscript('CLP')
     config = get_sentinelhub_api_config()
-    sen_obj = SenHub(config)
+    sen_obj = SenHub(config, mime_type=COMBINED_OUTPUTS.get(evalscript, MimeType.TIFF))
     sen_obj.set_dir(final_dir)
     sen_obj.make_bbox(bbox)
-    sen_obj.make_request(evalscript_cloud_coverage, date)
-    imgs = sen_obj.download_data()
-    return imgs[0], final_dir
-
-def get_ndvi_image_from_sentinelhub(polygon, date, location='unknown'):
-    final_dir = get_final_dir(location, date, 'NDVI')
+    sen_obj.make_request(new_utils.get_sentinelhub_api_evalscript(evalscript), date)
+    return sen_obj, final_dir
+
+
+def download_images_with_async_engine(jobs, redownload=False, max_concurrency=16, progress_callback=None):
+    '''
+    Download many download_scheduler jobs with the asyncio engine. The responses are streamed
+    to the usual <date>/<location>/<evalscript>/<hash>/ folders and are not decoded, so the
+    memory use does not grow with the number of jobs.
+    Returns the engine results in job order, each with the final_dir of its job. Jobs of an
+    evalscript the engine cannot stream are reported as failed.
+    '''
+    cache = raster_cache.get_raster_cache()
+    final_dirs = {}
+    cache_keys = {}
+    aliases = {}
+    job_ids = []
+    unsupported = {}
+
+    def iter_async_jobs():
+        for job in jobs:
+            job_ids.append(job['job_id'])
+            if job['evalscript'] not in COMBINED_OUTPUTS:
+                unsupported[job['job_id']] = {
+                    'job_id': job['job_id'], 'response_path': None, 'final_dir': None, 'status': 'failed', 'size': 0,
+                    'error': ValueError(f'Evalscript {job["evalscript"]} is not supported by the async engine, expected one of {list(COMBINED_OUTPUTS)}'),
+                    'elapsed': 0.0,
+                }
+                continue
+            sen_obj, final_dir = make_sentinelhub_request(job['polygon'], job['date'], job['evalscript'], job['location'])
+            final_dirs[job['job_id']] = final_dir
+            cache_keys[job['job_id']] = get_raster_cache_key(sen_obj, job['date'], job['evalscript'])
+            aliases[job['job_id']] = (job['location'], job['date'], job['evalscript'])
+            async_job = async_engine.make_async_job(sen_obj.request.download_list[0], job_id=job['job_id'])
+            if not redownload:
+                # A response cached under another location name is linked in place and skipped by the engine
+                cache.add_alias(cache_keys[job['job_id']], async_job['response_path'], job['location'], job['date'], job['evalscript'])
+            yield async_job
+
+    session_manager = get_sentinelhub_api_session_manager()
+    results = async_engine.download_jobs(session_manager, iter_async_jobs(), redownload=redownload, max_concurrency=max_concurrency, progress_callback=progress_callback)
+    for result in results:
+        result['final_dir'] = final_dirs[result['job_id']]
+        if result['status'] == 'done':
+            cache.put(cache_keys[result['job_id']], result['response_path'])
+            cache.add_alias(cache_keys[result['job_id']], result['response_path'], *aliases[result['job_id']])
+        if result['status'] != 'failed':
+            download_index.get_download_index().record_response(result['response_path'])
+    results_by_id = {result['job_id']: result for result in results}
+    results_by_id.update(unsupported)
+    return [results_by_id[job_id] for job_id in job_ids]
+
+
+def get_image_with_async_engine(polygon, date, evalscript, location='unknown'):
+    '''
+    Synchronous facade of the asyncio engine with the signature of get_any_image_from_sentinelhub
+    '''
+    if evalscript not in COMBINED_OUTPUTS:
+        return None, None
+    job = download_scheduler.make_download_job(polygon, date, evalscript, location)
+    result = download_images_with_async_engine([job], max_concurrency=1)[0]
+    if result['status'] == 'failed':
+        raise result['error']
+    with open(result['response_path'], 'rb') as f:
+        img = decode_data(f.read(), COMBINED_OUTPUTS[evalscript])
+    return img, result['final_dir']
+
+
+def get_combined_response_paths(location, date, evalscripts, request_hash):
+    response_paths = {}
+    for evalscript in evalscripts:
+        final_dir = get_final_dir(location, date, evalscript)
+        extension = COMBINED_OUTPUTS[evalscript].extension
+        response_paths[evalscript] = os.path.join(final_dir, request_hash, f'response.{extension}')
+    return response_paths
+
+
+def unpack_combined_response(tar_content, response_paths, request_params):
+    '''
+    Split the tar returned by a multi-output request into the per-evalscript
+    <date>/<location>/<evalscript>/<hash>/response.<ext> layout of get_final_dir
+    '''
+    with tarfile.open(fileobj=io.BytesIO(tar_content)) as tar:
+        for member in tar.getmembers():
+            evalscript = member.name.split('.')[0]
+            if evalscript not in response_paths:
+                continue
+            response_path = response_paths[evalscript]
+            os.makedirs(os.path.dirname(response_path), exist_ok=True)
+            with open(response_path, 'wb') as f:
+                f.write(tar.extractfile(member).read())
+            request_path = os.path.join(os.path.dirname(response_path), 'request.json')
+            with open(request_path, 'w') as f:
+                json.dump(request_params, f, indent=2)
+
+
+def download_combined_responses_from_sentinelhub(polygon, date, location='unknown', evalscripts=None, redownload=False):
+    '''
+    Make sure the outputs of a multi-output request for several evalscripts are on disk, through
+    the raster cache, without decoding them.
+    Returns a dictionary of evalscript -> response path.
+    '''
+    if evalscripts is None:
+        evalscripts = list(COMBINED_OUTPUTS.keys())
     bbox = get_bounds_of_polygon(polygon)
-    evalscript_ndvi = new_utils.get_sentinelhub_api_evalscript('NDVI')
+    evalscript_combined = new_utils.get_sentinelhub_api_evalscript('COMBINED')
     config = get_sentinelhub_api_config()
     sen_obj = SenHub(config)
-    sen_obj.set_dir(final_dir)
+    sen_obj.set_dir(None)
     sen_obj.make_bbox(bbox)
-    sen_obj.make_request(evalscript_ndvi, date)
-    imgs = sen_obj.download_data()
-    return imgs[0], final_dir
-
-def get_all_bands_image_from_sentinelhub(polygon, date, location='unknown'):
-    final_dir = get_final_dir(location, date, 'ALL')
+    sen_obj.make_multi_request(evalscript_combined, date, {evalscript: COMBINED_OUTPUTS[evalscript] for evalscript in evalscripts})
+    request_hash = sen_obj.get_request_hash()
+    response_paths = get_combined_response_paths(location, date, evalscripts, request_hash)
+    cache = raster_cache.get_raster_cache()
+    cache_keys = {evalscript: get_raster_cache_key(sen_obj, date, 'COMBINED', evalscript) for evalscript in evalscripts}
+    cached = not redownload and all(cache.add_alias(cache_keys[evalscript], response_path, location, date, evalscript) is not None for evalscript, response_path in response_paths.items())
+    if not cached:
+        response = sen_obj.download_data(save=False, decode=False)[0]
+        request_params = sen_obj.request.download_list[0].get_request_params()
+        unpack_combined_response(response.content, response_paths, request_params)
+        for evalscript, response_path in response_paths.items():
+            cache.put(cache_keys[evalscript], response_path)
+            cache.add_alias(cache_keys[evalscript], response_path, location, date, evalscript)
+    for response_path in response_paths.values():
+        download_index.get_download_index().record_response(response_path)
+    return response_paths
+
+
+def get_combined_images_from_sentinelhub(polygon, date, location='unknown', evalscripts=None, redownload=False, products=None, networks=None):
+    '''
+    Download several evalscripts for the same bbox and date with one multi-output request.
+    Returns a dictionary of evalscript -> (image, final_dir), the same pairs get_any_image_from_sentinelhub returns.
+    products are spectral_indices products and networks biophysical networks (FCOVER, LAI, CAB) computed
+    locally from the ALL output instead of requested, they are added to the dictionary as name -> (image, product_dir).
+    '''
+    if evalscripts is None:
+        evalscripts = list(COMBINED_OUTPUTS.keys())
+    local_names = list(products or []) + list(networks or [])
+    if local_names and ('ALL' not in evalscripts or len(set(local_names) & set(evalscripts)) > 0):
+        raise ValueError('Local products need the ALL output and cannot also be requested as evalscripts')
+    response_paths = download_combined_responses_from_sentinelhub(polygon, date, location, evalscripts, redownload)
+    images = {}
+    for evalscript, response_path in response_paths.items():
+        with open(response_path, 'rb') as f:
+            img = decode_data(f.read(), COMBINED_OUTPUTS[evalscript])
+        final_dir = os.path.dirname(os.path.dirname(response_path))
+        images[evalscript] = (img, final_dir)
+    for name in products or []:
+        images[name] = (spectral_indices.read_product(response_paths['ALL'], name), os.path.dirname(spectral_indices.get_product_path(response_paths['ALL'], name)))
+    for name in networks or []:
+        product_path = biophysical.compute_network_raster(response_paths['ALL'], name, date)
+        images[name] = (biophysical.read_product(product_path), os.path.dirname(product_path))
+    return images
+
+
+def get_tiled_image_from_sentinelhub(polygon, date, evalscript, location='unknown', resolution=10, max_tile_size=tiling.MAX_TILE_SIZE, max_workers=8, redownload=False):
+    '''
+    Download an area bigger than the per-request pixel limit (e.g. a whole state) as pixel-aligned
+    sub-tiles fetched in parallel, mosaicked into a single GeoTIFF saved as
+    <date>/<location>/<evalscript>/<hash>/response.tiff so data_reader reads it like any other response.
+    Returns the path of the mosaic instead of the image, which may not fit in memory.
+    '''
+    final_dir = get_final_dir(location, date, evalscript)
     bbox = get_bounds_of_polygon(polygon)
-    evalscript_all = new_utils.get_sentinelhub_api_evalscript('ALL')
+    evalscript_text = new_utils.get_sentinelhub_api_evalscript(evalscript)
     config = get_sentinelhub_api_config()
-    sen_obj = SenHub(config)
-    sen_obj.set_dir(final_dir)
+    sen_obj = SenHub(config, resolution=resolution)
     sen_obj.make_bbox(bbox)
-    sen_obj.make_request(evalscript_all, date)
-    imgs = sen_obj.download_data()
-    return imgs[0], final_dir
+    size = sen_obj.bbox_size
+    request_key = json.dumps([bbox, list(size), date, evalscript, evalscript_registry.get_evalscript_hash(evalscript), resolution, max_tile_size])
+    request_hash = hashlib.sha1(request_key.encode()).hexdigest()
+    response_path = os.path.join(final_dir, request_hash, 'response.tiff')
+    cache = raster_cache.get_raster_cache()
+    cache_key = get_raster_cache_key(sen_obj, date, evalscript, output='mosaic')
+    if not redownload and cache.add_alias(cache_key, response_path, location, date, evalscript) is not None:
+        download_index.get_download_index().record_response(response_path)
+        return response_path, final_dir
+    tiles = tiling.get_tile_grid(bbox, size, max_tile_size=max_tile_size)
+
+    def fetch_tile(tile):
+        tile_obj = SenHub(config, resolution=resolution)
+        tile_obj.set_dir(None)
+        tile_obj.make_bbox(tile['bbox'], size=tile['size'])
+        tile_obj.make_request(evalscript_text, date)
+        return tile_obj.download_data(save=False)[0]
+
+    tiling.build_mosaic_geotiff(tiles, fetch_tile, bbox, size, response_path, max_workers=max_workers)
+    cache.put(cache_key, response_path)
+    cache.add_alias(cache_key, response_path, location, date, evalscript)
+    download_index.get_download_index().record_response(response_path)
+    return response_path, final_dir
 
-def get_any_image_from_sentinelhub(polygon, date, evalscript, location='unknown'):
-    if evalscript == 'TRUECOLOR':
-        return get_true_color_image_from_sentinelhub(polygon, date, location)
-    elif evalscript == 'FCOVER':
-        return get_fcover_image_from_sentinelhub(polygon, date, location)
-    elif evalscript == 'CLP':
-        return get_cloud_coverage_from_sentinelhub(polygon, date, location)
-    elif evalscript == 'ALL':
-        return get_all_bands_image_from_sentinelhub(polygon, date, location)
-    elif evalscript == 'NDVI':
-        return get_ndvi_image_from_sentinelhub(polygon, date, location)
-    else:
-        return None, None
-    
 
 def display_true_color_image(image, image_save_path=None):
     factor = 3.5/255
@@ -2,7 +2,9 @@ import geopandas as gpd
 import os
 import folium
 import requests
-import jsonlines as jsonl
+import catalog_cache
+import catalog_search
+import evalscript_registry
 import glob
 from PIL import Image
 
@@ -46,7 +48,7 @@ def read_geojson(geojson_folder, geojson_name):
 
 
 
-def get_available_dates_from_sentinelhub(bbox, token, start_date, end_date):
+def get_available_dates_from_sentinelhub(bbox, token, start_date, end_date, session=None):
     '''
     Get a list of dates that have available images for a specific bounding box and time period
     from the SentinelHub API
@@ -55,6 +57,7 @@ def get_available_dates_from_sentinelhub(bbox, token, start_date, end_date):
         token: the SentinelHub API token
         start_date: the start date of the time period
         end_date: the end date of the time period
+        session: optional requests session to reuse pooled connections
     return:
         dates: a list of dates that have available images
     '''
@@ -66,9 +69,15 @@ def get_available_dates_from_sentinelhub(bbox, token, start_date, end_date):
     'Content-Type': 'application/json',
     'Authorization': 'Bearer '+ token,
     }
-    data = f'{{ "collections": [ "sentinel-2-l2a" ], "datetime": "{start_date}T00:00:00Z/{end_date}T23:59:59Z", "bbox": {bbox}, "limit": 100, "distinct": "date" }}'
-    response = requests.post('https://services.sentinel-hub.com/api/v1/catalog/search', headers=headers, data=data)
-    dates = response.json()['features']
+    payload = {
+        'collections': ['sentinel-2-l2a'],
+        'datetime': f'{start_date}T00:00:00Z/{end_date}T23:59:59Z',
+        'bbox': bbox,
+        'distinct': 'date',
+    }
+    if session is None:
+        session = requests
+    dates = catalog_search.search_catalog(session, headers, payload)
     cache_available_dates_from_sentinelhub(bbox, start_date, end_date, dates)
     print('dates fetched from api')
     return dates
@@ -79,7 +88,7 @@ def cache_available_dates_from_sentinelhub(bbox, start_date, end_date, dates):
     '''
     Cache a list of dates that have already been fetched from the SentinelHub API.
     This is to avoid making repeated requests to the API. The cached dates are stored
-    in a jsonl file called cached_dates.jsonl in a folder called cache/cached_dates.
+    in the indexed catalog store of catalog_cache, one entry per bbox and time period.
     args:
         bbox: the bounding box of the area of interest
         start_date: the start date of the time period
@@ -88,29 +97,15 @@ def cache_available_dates_from_sentinelhub(bbox, start_date, end_date, dates):
     return:
         None
     '''
-    cache_folder = './cache'
-    os.makedirs(cache_folder, exist_ok=True)
-    cache_dates_folder = os.path.join(cache_folder, 'cached_dates')
-    os.makedirs(cache_dates_folder, exist_ok=True)
-    cache_dates_file = os.path.join(cache_dates_folder, 'cached_dates.jsonl')
-    if not os.path.exists(cache_dates_file):
-        with open(cache_dates_file, 'w') as f:
-            f.write('')
-    current_entry = {
-        'bbox': bbox,
-        'start_date': start_date,
-        'end_date': end_date,
-        'dates': dates
-    }
-    with jsonl.open(cache_dates_file, mode='a') as writer:
-        writer.write(current_entry)
+    catalog_cache.get_catalog_cache().put(bbox, start_date, end_date, dates)
 
 
 def get_cached_available_dates_from_sentinelhub(bbox, start_date, end_date):
     '''
     Get a list of dates that have available images for a specific bounding box and time period
-    that have already been fetched from the SentinelHub API. if the dates have not been fetched
-    before, return None.
+    that have already been fetched from the SentinelHub API. A cached query over a larger
+    bounding box and longer time period also answers the request. if the dates have not been
+    fetched before, return None.
     args:
         bbox: the bounding box of the area of interest
         start_date: the start date of the time period
@@ -118,20 +113,7 @@ def get_cached_available_dates_from_sentinelhub(bbox, start_date, end_date):
     return:
         dates: a list of dates that have available images
     '''
-    cache_dates_file = './cache/cached_dates/cached_dates.jsonl'
-    if not os.path.exists(cache_dates_file):
-        return None
-    current_entry = {
-        'bbox': bbox,
-        'start_date': start_date,
-        'end_date': end_date,
-        'dates': []
-    }
-    with jsonl.open(cache_dates_file, mode='r') as reader:
-        for entry in reader:
-            if entry['bbox'] == bbox and entry['start_date'] == start_date and entry['end_date'] == end_date:
-                return entry['dates']
-    return None
+    return catalog_cache.get_catalog_cache().get(bbox, start_date, end_date)
 
 
 
@@ -211,66 +193,11 @@ def get_sentinelhub_api_evalscript(script_name):
         evalscript: a SentinelHub API evalscript
     '''
     
-    # Open and Read The Javascripts that will be passed to the SentinelHub API
-    if os.path.exists('./scripts/cab.js'):
-        with open('./scripts/cab.js') as f:
-            evalscript_cab = f.read()
-    else:
-        evalscript_cab = None
-
-    if os.path.exists('./scripts/fcover.js'):
-        with open('./scripts/fcover.js') as f:
-            evalscript_fcover = f.read()
-    else:
-        evalscript_fcover = None
-
-    if os.path.exists('./scripts/lai.js'):
-        with open('./scripts/lai.js') as f:
-            evalscript_lai = f.read()
-    else:
-        evalscript_lai = None
-
-    if os.path.exists('./scripts/truecolor.js'):
-        with open('./scripts/truecolor.js') as f:
-            evalscript_truecolor = f.read()
-    else:
-        evalscript_truecolor = None
-
-    if os.path.exists('./scripts/clp.js'):
-        with open('./scripts/clp.js') as f:
-            evalscript_clp = f.read()
-    else:
-        evalscript_clp = None
-
-    if os.path.exists('./scripts/all.js'):
-        with open('./scripts/all.js') as f:
-            evalscript_all = f.read()
-    else:
-        evalscript_all = None
-
-    if os.path.exists('./scripts/ndvi.js'):
-        with open('./scripts/ndvi.js') as f:
-            evalscript_ndvi = f.read()
-    else:
-        evalscript_ndvi = None
-
-    # Dictionry of JavaScript files
-    Scripts = {
-        'CAB': evalscript_cab,
-        'FCOVER': evalscript_fcover,
-        'LAI': evalscript_lai,
-        'TRUECOLOR': evalscript_truecolor,
-        'CLP': evalscript_clp,
-        'ALL': evalscript_all,
-        'NDVI': evalscript_ndvi
-    }
-    
-
-    if script_name in Scripts.keys():
-        return Scripts[script_name]
+    # The registry reads each script once and re-reads it only when the file changes
+    registry = evalscript_registry.get_evalscript_registry()
+    if script_name in registry.names():
+        return registry.get(script_name)
     else:
-        keys = Scripts.keys()
-        keys = list(keys)
+        keys = registry.names()
         print(f'Script name must be one of the following: {keys}')
         return None
-
@@ -0,0 +1,181 @@
+import os
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from affine import Affine
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+GRIDS_PATH = './data/grids.json'
+GRID_COLUMNS = ['grid_id', 'row', 'col']
+# Columns of the pixel tables that are not model features
+META_COLUMNS = ['Labels', 'geometry', 'latitude', 'longitude', 'location', 'year'] + GRID_COLUMNS
+
+
+def get_grid(img):
+    '''
+    Describe the pixel grid of an image, enough to recompute the position of any pixel
+    '''
+    return {
+        'transform': list(img.transform)[:6],
+        'crs': img.crs.to_string() if img.crs is not None else 'EPSG:4326',
+        'width': img.width,
+        'height': img.height,
+    }
+
+
+def get_grid_id(grid):
+    return hashlib.sha1(json.dumps(grid, sort_keys=True).encode()).hexdigest()[:12]
+
+
+@contextmanager
+def file_lock(path):
+    '''
+    Exclusive lock shared by the processes writing the same file, a no-op where fcntl is missing
+    '''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path + '.lock', 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class GridRegistry:
+    '''
+    Small json store of the grids referenced by the grid_id column of the pixel tables.
+    Several extraction processes can register grids at the same time, each write merges
+    the grids already on disk.
+    '''
+    def __init__(self, path=GRIDS_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.grids = {}
+        self.reload()
+
+    def reload(self):
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                self.grids.update(json.load(f))
+
+    def register(self, grid):
+        grid_id = get_grid_id(grid)
+        with self.lock:
+            if grid_id not in self.grids:
+                with file_lock(self.path):
+                    self.reload()
+                    self.grids[grid_id] = grid
+                    temp_path = f'{self.path}.{os.getpid()}.tmp'
+                    with open(temp_path, 'w') as f:
+                        json.dump(self.grids, f, indent=2)
+                    os.replace(temp_path, self.path)
+        return grid_id
+
+    def get(self, grid_id):
+        if grid_id not in self.grids:
+            # Registered by another process after this one started
+            with self.lock:
+                self.reload()
+        return self.grids[grid_id]
+
+
+_GRID_REGISTRY = None
+_GRID_REGISTRY_LOCK = threading.Lock()
+
+
+def get_grid_registry():
+    global _GRID_REGISTRY
+    with _GRID_REGISTRY_LOCK:
+        if _GRID_REGISTRY is None:
+            _GRID_REGISTRY = GridRegistry()
+        return _GRID_REGISTRY
+
+
+def image_as_pixel_table(img, bands_names=None):
+    '''
+    Read an image into a compact table: one column per band plus the grid id (categorical)
+    and the int32 row and column of each pixel. Coordinates and geometries are not stored,
+    they are computed from the grid when needed.
+    args:
+        img: an open rasterio dataset
+        bands_names: the names of the bands, used as column names when they match the band count
+    return:
+        table: a pandas dataframe
+    '''
+    grid_id = get_grid_registry().register(get_grid(img))
+    n_pixels = img.width * img.height
+    bands = img.read()
+    bands = np.ascontiguousarray(bands.reshape(img.count, n_pixels).T)
+    if bands_names is not None and img.count == len(bands_names):
+        table = pd.DataFrame(bands, columns=bands_names)
+    else:
+        table = pd.DataFrame(bands)
+    rows, cols = np.divmod(np.arange(n_pixels, dtype=np.int32), np.int32(img.width))
+    table['grid_id'] = pd.Categorical.from_codes(np.zeros(n_pixels, dtype=np.int8), categories=[grid_id])
+    table['row'] = rows
+    table['col'] = cols
+    return table
+
+
+def get_coordinates(table):
+    '''
+    Compute the pixel-centre coordinates of every row of a pixel table from its grid
+    args:
+        table: a dataframe with grid_id, row and col columns
+    return:
+        longitudes, latitudes: two float64 arrays aligned with the table rows
+    '''
+    longitudes = np.empty(len(table), dtype=np.float64)
+    latitudes = np.empty(len(table), dtype=np.float64)
+    grid_ids = table['grid_id'].astype('category')
+    registry = get_grid_registry()
+    for code, grid_id in enumerate(grid_ids.cat.categories):
+        mask = (grid_ids.cat.codes == code).values
+        transform = Affine(*registry.get(grid_id)['transform'])
+        cols = table['col'].values[mask] + 0.5
+        rows = table['row'].values[mask] + 0.5
+        longitudes[mask] = transform.a * cols + transform.b * rows + transform.c
+        latitudes[mask] = transform.d * cols + transform.e * rows + transform.f
+    return longitudes, latitudes
+
+
+def add_coordinates(table):
+    '''
+    Copy of a pixel table with latitude and longitude columns
+    '''
+    table = table.copy()
+    table['longitude'], table['latitude'] = get_coordinates(table)
+    return table
+
+
+def to_geodataframe(table, longitude=None, latitude=None):
+    '''
+    Materialise point geometries for export or map display only.
+    The coordinates come from the longitude and latitude columns when given, otherwise from the grid.
+    '''
+    if longitude is not None and latitude is not None:
+        longitudes, latitudes = table[longitude].values, table[latitude].values
+        crs = 'EPSG:4326'
+    else:
+        longitudes, latitudes = get_coordinates(table)
+        grid_ids = table['grid_id'].astype('category').cat.categories
+        crs = get_grid_registry().get(grid_ids[0])['crs'] if len(grid_ids) > 0 else 'EPSG:4326'
+    return gpd.GeoDataFrame(table, geometry=gpd.points_from_xy(longitudes, latitudes), crs=crs)
+
+
+def drop_geometry(gdf):
+    '''
+    Turn a geodataframe with per-pixel geometries into a plain dataframe without them
+    '''
+    geometry_columns = [col for col in gdf.columns if 'geometry' in col]
+    return pd.DataFrame(gdf.drop(columns=geometry_columns))
@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+import evalscript_registry
+
+
+DEFAULT_CACHE_DIR = './data/raster_cache'
+BBOX_DECIMALS = 6
+
+
+def get_cache_key(bbox, crs, resolution, size, date, data_collection, evalscript, output='default'):
+    '''
+    Canonical hash of everything that defines the content of a response.
+    The location name is not part of it, so the same request filed under several names
+    has a single key.
+    args:
+        bbox: [min_x, min_y, max_x, max_y]
+        crs: the crs of the bbox, e.g. 'EPSG:4326'
+        resolution: the requested resolution in meters
+        size: the (width, height) of the response in pixels
+        date: the acquisition date in YYYY-MM-DD format
+        data_collection: the collection id, e.g. 'sentinel-2-l1c'
+        evalscript: the evalscript name, hashed through the evalscript registry
+        output: the output identifier of the response
+    return:
+        key: a hex digest
+    '''
+    canonical = {
+        'bbox': [round(float(value), BBOX_DECIMALS) for value in bbox],
+        'crs': str(crs),
+        'resolution': resolution,
+        'size': [int(value) for value in size],
+        'date': date,
+        'data_collection': data_collection,
+        'evalscript': evalscript,
+        'evalscript_hash': evalscript_registry.get_evalscript_hash(evalscript),
+        'output': output,
+    }
+    return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode()).hexdigest()
+
+
+def link_file(source_path, target_path):
+    '''
+    Hard link a file, falling back to a copy across file systems. The target appears atomically.
+    '''
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    temp_path = f'{target_path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.link(source_path, temp_path)
+    except OSError:
+        shutil.copyfile(source_path, temp_path)
+    os.replace(temp_path, target_path)
+
+
+class RasterCache:
+    '''
+    Content-addressed store of downloaded responses.
+    Each response is stored once under objects/<key[:2]>/<key>/response.<ext>, and the
+    <date>/<location>/<evalscript>/<hash>/ folders the rest of the code reads are hard links to it.
+    The aliases table keeps track of which location names point to which object.
+    '''
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, 'aliases.sqlite')
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.create_tables()
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def create_tables(self):
+        with self.connect() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS aliases (
+                    alias_path TEXT PRIMARY KEY,
+                    key TEXT, location TEXT, date TEXT, evalscript TEXT,
+                    created_at REAL
+                )''')
+            conn.execute('CREATE INDEX IF NOT EXISTS aliases_key ON aliases (key)')
+
+    def get_object_path(self, key, extension):
+        return os.path.join(self.cache_dir, 'objects', key[:2], key, f'response.{extension}')
+
+    def get(self, key, extension):
+        '''
+        Get the path of a cached response, or None if it was never downloaded
+        '''
+        object_path = self.get_object_path(key, extension)
+        return object_path if os.path.exists(object_path) else None
+
+    def put(self, key, response_path):
+        '''
+        Store a freshly downloaded response under its key, without copying it
+        '''
+        extension = response_path.rsplit('.', 1)[-1]
+        object_path = self.get_object_path(key, extension)
+        if not os.path.exists(object_path):
+            link_file(response_path, object_path)
+        return object_path
+
+    def add_alias(self, key, alias_path, location, date, evalscript):
+        '''
+        Make a cached response available at alias_path and record the location name pointing to it
+        args:
+            key: the cache key
+            alias_path: the <date>/<location>/<evalscript>/<hash>/response.<ext> path
+            location: the location name
+            date: the acquisition date
+            evalscript: the evalscript name
+        return:
+            alias_path: the path, or None if the key is not cached
+        '''
+        object_path = self.get(key, alias_path.rsplit('.', 1)[-1])
+        if object_path is None:
+            if not os.path.exists(alias_path):
+                return None
+            # A response downloaded before the cache existed becomes the cached object
+            object_path = self.put(key, alias_path)
+        if not os.path.exists(alias_path):
+            link_file(object_path, alias_path)
+        with self.lock, self.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO aliases VALUES (?, ?, ?, ?, ?, ?)', (alias_path, key, location, date, evalscript, time.time()))
+        return alias_path
+
+    def get_aliases(self, key):
+        '''
+        Get the alias paths and location names of a cached response
+        '''
+        with self.connect() as conn:
+            rows = conn.execute('SELECT alias_path, location FROM aliases WHERE key = ? ORDER BY created_at', (key,)).fetchall()
+        return rows
+
+
+_RASTER_CACHE = None
+_RASTER_CACHE_LOCK = threading.Lock()
+
+
+def get_raster_cache():
+    '''
+    Get the raster cache of the project
+    '''
+    global _RASTER_CACHE
+    with _RASTER_CACHE_LOCK:
+        if _RASTER_CACHE is None:
+            _RASTER_CACHE = RasterCache()
+        return _RASTER_CACHE
@@ -0,0 +1,193 @@
+import time
+import asyncio
+import random
+import threading
+import email.utils
+
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class RetryableResponseError(Exception):
+    '''
+    Raised when a response is still throttled or failing after every retry.
+    '''
+    def __init__(self, status_code, message=''):
+        super().__init__(f'HTTP {status_code} {message}'.strip())
+        self.status_code = status_code
+
+
+def parse_retry_after(value):
+    '''
+    Parse a Retry-After header, given either in seconds or as an HTTP date
+    args:
+        value: the header value
+    return:
+        seconds: the number of seconds to wait, or None if the header is missing or invalid
+    '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class AdaptiveConcurrencyController:
+    '''
+    AIMD controller of the number of in-flight Sentinel Hub calls.
+    The limit grows by one after every window of successful fast calls and is halved on a 429,
+    a 5xx or a call slower than the latency target. The limit is halved at most once per burst:
+    a failure of a call issued before the last decrease is counted but does not halve it again.
+    Calls wait for a free slot and for any Retry-After pause announced by the server.
+    '''
+    def __init__(self, initial_limit=4, min_limit=1, max_limit=32, latency_target=30.0,
+                 max_retries=5, base_backoff=1.0, max_backoff=60.0):
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.in_flight = 0
+        self.successes_since_increase = 0
+        self.last_decrease = 0.0
+        self.paused_until = 0.0
+        self.stats = {'calls': 0, 'successes': 0, 'throttled': 0, 'server_errors': 0, 'retries': 0, 'decreases': 0, 'increases': 0}
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while True:
+                wait = self.paused_until - time.time()
+                if wait <= 0 and self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+                self.condition.wait(timeout=wait if wait > 0 else None)
+
+    async def acquire_async(self, poll_interval=0.05):
+        '''
+        acquire for coroutines, polls the slots instead of blocking the event loop on the condition
+        '''
+        while True:
+            with self.condition:
+                wait = self.paused_until - time.time()
+                if wait <= 0 and self.in_flight < self.limit:
+                    self.in_flight += 1
+                    return
+            await asyncio.sleep(wait if wait > 0 else poll_interval)
+
+    def count(self, stat):
+        with self.condition:
+            self.stats[stat] += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_success(self, latency, issued_at=None):
+        with self.condition:
+            self.stats['successes'] += 1
+            if latency > self.latency_target:
+                self.decrease(issued_at)
+                return
+            self.successes_since_increase += 1
+            if self.successes_since_increase >= self.limit:
+                self.successes_since_increase = 0
+                if self.limit < self.max_limit:
+                    self.limit += 1
+                    self.stats['increases'] += 1
+                    self.condition.notify_all()
+
+    def on_throttle(self, status_code, retry_after=None, issued_at=None):
+        with self.condition:
+            if status_code == 429:
+                self.stats['throttled'] += 1
+            else:
+                self.stats['server_errors'] += 1
+            self.decrease(issued_at)
+            if retry_after is not None:
+                self.paused_until = max(self.paused_until, time.time() + retry_after)
+
+    def decrease(self, issued_at=None):
+        '''
+        Halve the limit, unless the failing call was issued before the last decrease:
+        the calls of one burst fail together and only the first of them should count
+        '''
+        if issued_at is not None and issued_at < self.last_decrease:
+            return
+        self.limit = max(self.min_limit, self.limit // 2)
+        self.successes_since_increase = 0
+        self.last_decrease = time.time()
+        self.stats['decreases'] += 1
+
+    def get_backoff(self, attempt):
+        '''
+        Full-jitter exponential backoff
+        '''
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+
+    def call(self, fn, *args, retry=True, **kwargs):
+        '''
+        Run fn under the controller. fn returns a requests-like response, 429 and 5xx responses
+        are retried with jittered backoff, honouring Retry-After.
+        args:
+            fn: a function sending one HTTP request and returning its response
+            retry: False when the caller has its own retry loop (e.g. the sentinelhub download client),
+                the response is then returned as is and only adapts the limit, so the backoff is not applied twice
+        return:
+            response: the first response that is not throttled or failing
+        '''
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            start = time.time()
+            try:
+                with self.condition:
+                    self.stats['calls'] += 1
+                response = fn(*args, **kwargs)
+            finally:
+                self.release()
+            latency = time.time() - start
+            if response.status_code not in RETRY_STATUS_CODES:
+                self.on_success(latency, issued_at=start)
+                return response
+            if not retry:
+                self.on_throttle(response.status_code, issued_at=start)
+                return response
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            self.on_throttle(response.status_code, retry_after, issued_at=start)
+            if attempt == self.max_retries:
+                break
+            with self.condition:
+                self.stats['retries'] += 1
+            time.sleep(retry_after if retry_after is not None else self.get_backoff(attempt))
+        raise RetryableResponseError(response.status_code, 'after retries')
+
+    def get_status(self):
+        '''
+        Current limits and throttle counts, to tune the throughput against the quota
+        '''
+        with self.condition:
+            return {'limit': self.limit, 'in_flight': self.in_flight, 'paused_for': max(0.0, self.paused_until - time.time()), **self.stats}
+
+
+_CONTROLLER = None
+_CONTROLLER_LOCK = threading.Lock()
+
+
+def get_controller():
+    '''
+    Get the controller shared by every Sentinel Hub call of the process
+    '''
+    global _CONTROLLER
+    with _CONTROLLER_LOCK:
+        if _CONTROLLER is None:
+            _CONTROLLER = AdaptiveConcurrencyController()
+        return _CONTROLLER
@@ -6,8 +6,7 @@ from sentinelhub import (
     DataCollection,
     bbox_to_dimensions,
 )
-from oauthlib.oauth2 import BackendApplicationClient
-from requests_oauthlib import OAuth2Session
+from sh_session import get_session_manager
 
 class SenHub:
     ''' 
@@ -20,7 +19,7 @@ class SenHub:
         self.config = config
         self.setInputParameters(data_source)
         self.setOutputParameters(identifier, mime_type)
-        self.set_token()
+        self.session_manager = get_session_manager(config)
 
     def setInputParameters(self, data_source):
         '''
@@ -37,14 +36,17 @@ class SenHub:
 
     def set_token(self):
         '''
-        Fetch Tooken from sentinelhub api to be used for available dates 
+        Fetch Tooken from sentinelhub api to be used for available dates.
+        The token is shared process-wide and only re-fetched when it expires.
         '''
-        client_id = self.config.sh_client_id
-        client_secret = self.config.sh_client_secret
-        client = BackendApplicationClient(client_id=client_id)
-        oauth = OAuth2Session(client=client)
-        token = oauth.fetch_token(token_url='https://services.sentinel-hub.com/oauth/token',client_secret=client_secret)
-        self.token =  token['access_token']
+        return self.session_manager.token
+
+    @property
+    def token(self):
+        '''
+        Current token of the shared session
+        '''
+        return self.session_manager.token
 
     def get_input_data(self, date):
         '''
@@ -64,12 +66,15 @@ class SenHub:
         '''
         self.dir_path = dir_path
 
-    def make_bbox(self, bbox):
+    def make_bbox(self, bbox, size=None):
         '''
         Wrap bbox to provide to the sentinelhub API.
+        The size in pixels is derived from the resolution unless given explicitly.
         '''
         self.bbox = BBox(bbox=bbox, crs=CRS.WGS84)
-        self.bbox_size = bbox_to_dimensions(self.bbox, resolution=self.resolution)
+        if size is None:
+            size = bbox_to_dimensions(self.bbox, resolution=self.resolution)
+        self.bbox_size = size
                 
     def make_request(self, metric, date):
         '''
@@ -87,11 +92,42 @@ class SenHub:
             config=self.config,
             )
 
-    def download_data(self, save=True , redownload=False):
+    def make_multi_request(self, metric, date, outputs):
+        '''
+        Setup a single Sentinal Hub Request with several named outputs.
+        outputs is a dictionary of output identifier -> mime type, the response is a tar
+        holding one file per output.
+        '''
+        input_data = self.get_input_data(date)
+        output_data = [SentinelHubRequest.output_response(identifier, mime_type) for identifier, mime_type in outputs.items()]
+        self.request = SentinelHubRequest(
+            data_folder=self.dir_path,
+            evalscript=metric,
+            input_data=[input_data],
+            responses=output_data,
+            bbox=self.bbox,
+            size=self.bbox_size,
+            config=self.config,
+            )
+
+    def get_request_hash(self):
         '''
-        Make The Request and download the data
+        Hash of the current request, the name of the folder sentinelhub saves it under
         '''
-        return self.request.get_data(save_data=save, redownload=redownload)
+        return self.request.download_list[0].get_hashed_name()
+
+    def download_data(self, save=True , redownload=False, decode=True):
+        '''
+        Make The Request and download the data, reusing the shared session
+        so no extra OAuth request or TLS handshake is made per image
+        '''
+        download_list = self.request.get_download_list()
+        for download_request in download_list:
+            download_request.save_response = save
+            download_request.return_data = True
+            download_request.data_folder = self.dir_path
+        client = self.session_manager.get_download_client(redownload=redownload)
+        return client.download(download_list, decode_data=decode)
 
 
 
@@ -0,0 +1,125 @@
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from sentinelhub import SentinelHubSession, SentinelHubDownloadClient, DownloadClient
+import rate_limiter
+
+
+class PooledDownloadClient(SentinelHubDownloadClient):
+    '''
+    Sentinel Hub download client sending its requests through a pooled requests session
+    instead of opening a new connection per image, under the shared rate-limit controller.
+    The client keeps its own 429 and 5xx retry loop, the controller only adapts the concurrency.
+    '''
+    def __init__(self, *, http_session, **kwargs):
+        super().__init__(**kwargs)
+        self.http_session = http_session
+        self.download_lock = threading.Lock()
+
+    def download(self, *args, **kwargs):
+        '''
+        SentinelHubDownloadClient.download makes a new lock per call and drops it at the end,
+        which would race when several threads share this client. Keep one lock for its lifetime
+        so the rate-limit state is shared safely by every call.
+        '''
+        self.lock = self.download_lock
+        return DownloadClient.download(self, *args, **kwargs)
+
+    def _do_download(self, request):
+        if request.url is None:
+            raise ValueError(f'Faulty request {request}, no URL specified.')
+        return rate_limiter.get_controller().call(
+            self.http_session.request,
+            request.request_type.value,
+            url=request.url,
+            json=request.post_values,
+            headers=self._prepare_headers(request),
+            timeout=self.config.download_timeout_seconds,
+            retry=False,
+        )
+
+
+class SessionManager:
+    '''
+    Process-wide holder of the Sentinel Hub OAuth token and a pooled HTTP session.
+    The token is cached until it is close to expiry and refreshed by a single thread.
+    '''
+    def __init__(self, config, pool_size=32, refresh_before_expiry=120):
+        self.config = config
+        self.refresh_before_expiry = refresh_before_expiry
+        self.lock = threading.Lock()
+        self.sh_session = None
+        self.download_clients = {}
+        self.set_http_session(pool_size)
+
+    def set_http_session(self, pool_size):
+        '''
+        Setup a requests session with a connection pool big enough for concurrent downloads
+        '''
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.http_session = requests.Session()
+        self.http_session.mount('https://', adapter)
+        self.http_session.mount('http://', adapter)
+
+    def get_sentinelhub_session(self):
+        '''
+        Get the sentinelhub session, creating it (one OAuth request) on first use
+        and refreshing its token at most once when it is about to expire
+        '''
+        with self.lock:
+            if self.sh_session is None:
+                self.sh_session = SentinelHubSession(config=self.config, refresh_before_expiry=self.refresh_before_expiry)
+            # Touching the token under the lock makes sure only one thread refreshes it
+            self.sh_session.token
+            return self.sh_session
+
+    def get_download_client(self, redownload=False, raise_download_errors=True):
+        '''
+        Get the download client sharing the token and the connection pool of this manager.
+        One client is kept per set of options, so its rate-limit state carries over from call to call.
+        '''
+        session = self.get_sentinelhub_session()
+        key = (redownload, raise_download_errors)
+        with self.lock:
+            if key not in self.download_clients:
+                self.download_clients[key] = PooledDownloadClient(
+                    http_session=self.http_session,
+                    session=session,
+                    config=self.config,
+                    redownload=redownload,
+                    raise_download_errors=raise_download_errors,
+                )
+            return self.download_clients[key]
+
+    @property
+    def token(self):
+        '''
+        The current access token
+        '''
+        return self.get_sentinelhub_session().token['access_token']
+
+    @property
+    def headers(self):
+        '''
+        Authorization headers for the current token
+        '''
+        return {'Authorization': 'Bearer ' + self.token}
+
+
+_SESSION_MANAGERS = {}
+_SESSION_MANAGERS_LOCK = threading.Lock()
+
+
+def get_session_manager(config):
+    '''
+    Get the process-wide session manager for a Sentinel Hub config
+    args:
+        config: a sentinelhub SHConfig with sh_client_id and sh_client_secret set
+    return:
+        manager: the SessionManager shared by every caller using the same credentials
+    '''
+    key = (config.sh_client_id, config.sh_client_secret, getattr(config, 'sh_token_url', None))
+    with _SESSION_MANAGERS_LOCK:
+        if key not in _SESSION_MANAGERS:
+            _SESSION_MANAGERS[key] = SessionManager(config)
+        return _SESSION_MANAGERS[key]
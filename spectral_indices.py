@@ -0,0 +1,171 @@
+import os
+import numpy as np
+import rasterio
+import training_matrix
+import download_index
+
+
+INDICES_DIR_NAME = download_index.PRODUCTS_DIR_NAME
+BANDS_NAMES = training_matrix.ALL_BANDS_NAMES
+# name -> (bands read from the ALL raster, function of the bands as float32 arrays)
+INDICES = {
+    'NDVI': (['B04', 'B08'], lambda b: normalized_difference(b['B08'], b['B04'])),
+    'EVI': (['B02', 'B04', 'B08'], lambda b: ratio(2.5 * (b['B08'] - b['B04']), b['B08'] + 6 * b['B04'] - 7.5 * b['B02'] + 1)),
+    'NDWI': (['B03', 'B08'], lambda b: normalized_difference(b['B03'], b['B08'])),
+    'SAVI': (['B04', 'B08'], lambda b: ratio(1.5 * (b['B08'] - b['B04']), b['B08'] + b['B04'] + 0.5)),
+    'NDBI': (['B08', 'B11'], lambda b: normalized_difference(b['B11'], b['B08'])),
+}
+# name -> bands stacked as an 8-bit image, like the AUTO sample type of scripts/truecolor.js
+COMPOSITES = {
+    'TRUECOLOR': ['B04', 'B03', 'B02'],
+}
+PRODUCTS = list(INDICES.keys()) + list(COMPOSITES.keys())
+
+
+def ratio(numerator, denominator):
+    '''
+    Elementwise division, NaN where the denominator is 0 (no-data pixels of the ALL raster)
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = numerator / denominator
+    result[denominator == 0] = np.nan
+    return result.astype(np.float32, copy=False)
+
+
+def normalized_difference(a, b):
+    return ratio(a - b, a + b)
+
+
+def to_uint8(values):
+    return np.clip(np.round(values * 255), 0, 255).astype(np.uint8)
+
+
+def get_required_bands(names):
+    bands = set()
+    for name in names:
+        if name in INDICES:
+            bands.update(INDICES[name][0])
+        elif name in COMPOSITES:
+            bands.update(COMPOSITES[name])
+        else:
+            raise ValueError(f'Unknown product {name}, expected one of {PRODUCTS}')
+    return sorted(bands, key=BANDS_NAMES.index)
+
+
+def compute_products(bands, names):
+    '''
+    Compute products from named bands
+    args:
+        bands: a dictionary of band name -> float32 array, any shape
+        names: the products to compute
+    return:
+        products: a dictionary of name -> array. Indices are float32 with the shape of the bands,
+            composites are uint8 with one more trailing axis holding their bands
+    '''
+    products = {}
+    for name in names:
+        if name in INDICES:
+            products[name] = INDICES[name][1](bands)
+        else:
+            products[name] = np.stack([to_uint8(bands[band]) for band in COMPOSITES[name]], axis=-1)
+    return products
+
+
+def compute_products_from_array(all_bands, names, chunk_rows=256):
+    '''
+    Compute products from a decoded ALL image, chunk_rows rows at a time
+    args:
+        all_bands: a (height, width, 13) array, as decode_data returns the ALL response
+        names: the products to compute
+        chunk_rows: the number of rows computed at once, bounds the temporaries
+    return:
+        products: a dictionary of name -> (height, width) float32 index or (height, width, 3) uint8 composite
+    '''
+    height, width = all_bands.shape[:2]
+    products = {}
+    for name in names:
+        if name in INDICES:
+            products[name] = np.empty((height, width), dtype=np.float32)
+        else:
+            products[name] = np.empty((height, width, len(COMPOSITES[name])), dtype=np.uint8)
+    required = get_required_bands(names)
+    for row_off in range(0, height, chunk_rows):
+        rows = slice(row_off, min(row_off + chunk_rows, height))
+        bands = {band: all_bands[rows, :, BANDS_NAMES.index(band)].astype(np.float32) for band in required}
+        for name, values in compute_products(bands, names).items():
+            products[name][rows] = values
+    return products
+
+
+def get_product_path(response_path, name):
+    '''
+    Products are cached next to the ALL response they come from, in <hash>/indices/<name>.tif,
+    where download_index lists them under their name
+    '''
+    return os.path.join(os.path.dirname(response_path), INDICES_DIR_NAME, f'{name}.tif')
+
+
+def is_product_fresh(response_path, product_path):
+    return os.path.exists(product_path) and os.path.getmtime(product_path) >= os.path.getmtime(response_path)
+
+
+def compute_product_rasters(response_path, names=None, max_window_bytes=training_matrix.DEFAULT_MAX_WINDOW_BYTES, overwrite=False):
+    '''
+    Compute products from an ALL raster in one windowed pass, reading only the bands they need,
+    and cache them as GeoTIFFs beside it. Products already cached are not recomputed.
+    args:
+        response_path: the path of an ALL response
+        names: the products to compute, defaults to all of them
+        max_window_bytes: the memory ceiling of the window of bands read at a time
+        overwrite: recompute the cached products
+    return:
+        product_paths: a dictionary of name -> GeoTIFF path
+    '''
+    if names is None:
+        names = PRODUCTS
+    product_paths = {name: get_product_path(response_path, name) for name in names}
+    missing = [name for name in names if overwrite or not is_product_fresh(response_path, product_paths[name])]
+    if len(missing) == 0:
+        return product_paths
+    required = get_required_bands(missing)
+    os.makedirs(os.path.dirname(product_paths[missing[0]]), exist_ok=True)
+    with rasterio.open(response_path) as img:
+        if img.count != len(BANDS_NAMES):
+            raise Exception(f'{response_path} has {img.count} bands, expected the {len(BANDS_NAMES)} bands of the ALL evalscript')
+        profile = {'driver': 'GTiff', 'width': img.width, 'height': img.height, 'crs': img.crs, 'transform': img.transform, 'compress': 'deflate'}
+        outputs = {}
+        for name in missing:
+            if name in INDICES:
+                outputs[name] = rasterio.open(product_paths[name] + '.tmp', 'w', count=1, dtype='float32', nodata=np.nan, **profile)
+            else:
+                outputs[name] = rasterio.open(product_paths[name] + '.tmp', 'w', count=len(COMPOSITES[name]), dtype='uint8', **profile)
+        try:
+            band_indexes = [BANDS_NAMES.index(band) + 1 for band in required]
+            for window in training_matrix.get_row_windows(img, max_window_bytes):
+                values = img.read(band_indexes, window=window).astype(np.float32)
+                bands = dict(zip(required, values))
+                for name, product in compute_products(bands, missing).items():
+                    if name in INDICES:
+                        outputs[name].write(product, 1, window=window)
+                    else:
+                        outputs[name].write(np.moveaxis(product, -1, 0), window=window)
+        finally:
+            for output in outputs.values():
+                output.close()
+    for name in missing:
+        os.replace(product_paths[name] + '.tmp', product_paths[name])
+        download_index.record_product(product_paths[name])
+    return product_paths
+
+
+def read_product(response_path, name):
+    '''
+    Read a product of an ALL response as a (height, width) or (height, width, bands) array,
+    computing and caching it first when needed
+    '''
+    product_path = compute_product_rasters(response_path, [name])[name]
+    with rasterio.open(product_path) as img:
+        values = img.read()
+    if name in INDICES:
+        return values[0]
+    return np.moveaxis(values, 0, -1)
@@ -0,0 +1,113 @@
+import os
+import time
+import queue
+import threading
+import download_scheduler
+
+
+def download_response_with_sentinelhub(job):
+    '''
+    Default download stage, makes sure the response of the job is on disk without decoding it
+    args:
+        job: a download job (see download_scheduler.make_download_job)
+    return:
+        downloaded: the (response_path, final_dir) tuple returned by new_app
+    '''
+    import new_app
+    return new_app.download_response_from_sentinelhub(job['polygon'], job['date'], job['evalscript'], job['location'])
+
+
+def run_streaming_pipeline(jobs, process_fn, download_fn=None, sink_fn=None, download_workers=8, process_workers=None,
+                           queue_size=16, max_per_host=4, host_limits=None, progress_callback=None):
+    '''
+    Run download and processing as overlapping stages connected by a bounded queue.
+    Download workers put each finished raster on the queue as soon as it is on disk, and
+    process workers decode it and extract its features right away. A download worker waits
+    while the queue is full, so the rasters waiting for processing are bounded by queue_size
+    plus one per worker. The extracted features are kept in the results unless sink_fn is given,
+    only with a sink is the memory of the whole pipeline bounded, whatever the size of the region.
+    args:
+        jobs: an iterable of download jobs, consumed lazily
+        process_fn: a function taking (job, downloaded) and returning the features of the raster
+        download_fn: a function taking a job and returning what process_fn needs, defaults to
+            download_response_with_sentinelhub
+        sink_fn: optional function called with (job, features) as soon as a raster is processed.
+            When given, the features are not kept in the results.
+        download_workers: the number of download threads
+        process_workers: the number of decode / feature extraction threads, defaults to the CPU count
+        queue_size: the number of downloaded rasters allowed to wait for processing
+        max_per_host: the number of in-flight downloads allowed per host
+        host_limits: optional dictionary of host -> number of in-flight downloads
+        progress_callback: optional function called as progress_callback(n_finished, job_result)
+    return:
+        results: a list of job results in job order, with the same keys as download_scheduler
+            results plus the stage a failed job failed at
+    '''
+    if download_fn is None:
+        download_fn = download_response_with_sentinelhub
+    if process_workers is None:
+        process_workers = os.cpu_count() or 1
+    limiter = download_scheduler.HostLimiter(max_per_host=max_per_host, host_limits=host_limits)
+    downloaded_queue = queue.Queue(maxsize=queue_size)
+    jobs_iterator = iter(enumerate(jobs))
+    jobs_lock = threading.Lock()
+    results = {}
+    results_lock = threading.Lock()
+
+    def finish(position, job_result):
+        with results_lock:
+            results[position] = job_result
+            finished = len(results)
+        if progress_callback is not None:
+            progress_callback(finished, job_result)
+
+    def next_job():
+        with jobs_lock:
+            return next(jobs_iterator, None)
+
+    def download_worker():
+        while True:
+            item = next_job()
+            if item is None:
+                return
+            position, job = item
+            job_result = {'job_id': job['job_id'], 'job': job, 'status': 'done', 'stage': None, 'result': None, 'error': None, 'elapsed': 0.0}
+            start = time.time()
+            try:
+                downloaded = limiter.run(download_scheduler.get_job_host(job), download_fn, job)
+            except Exception as e:
+                job_result.update(status='failed', stage='download', error=repr(e), elapsed=time.time() - start)
+                finish(position, job_result)
+                continue
+            job_result['elapsed'] = time.time() - start
+            downloaded_queue.put((position, job_result, downloaded))
+
+    def process_worker():
+        while True:
+            item = downloaded_queue.get()
+            if item is None:
+                return
+            position, job_result, downloaded = item
+            start = time.time()
+            try:
+                features = process_fn(job_result['job'], downloaded)
+                if sink_fn is not None:
+                    sink_fn(job_result['job'], features)
+                else:
+                    job_result['result'] = features
+            except Exception as e:
+                job_result.update(status='failed', stage='process', error=repr(e))
+            job_result['elapsed'] += time.time() - start
+            finish(position, job_result)
+
+    process_threads = [threading.Thread(target=process_worker, daemon=True) for _ in range(process_workers)]
+    download_threads = [threading.Thread(target=download_worker, daemon=True) for _ in range(download_workers)]
+    for thread in process_threads + download_threads:
+        thread.start()
+    for thread in download_threads:
+        thread.join()
+    for _ in process_threads:
+        downloaded_queue.put(None)
+    for thread in process_threads:
+        thread.join()
+    return [results[position] for position in sorted(results)]
@@ -0,0 +1,21 @@
+import os
+import sys
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+@pytest.fixture
+def project_dir(tmp_path, monkeypatch):
+    '''
+    Run a test in an empty project folder, the modules keep their data under paths relative to the
+    working directory and open their shared stores on first use
+    '''
+    import download_index
+    import pixel_table
+    os.symlink(os.path.join(REPO_DIR, 'scripts'), tmp_path / 'scripts')
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(download_index, '_DOWNLOAD_INDEX', None)
+    monkeypatch.setattr(pixel_table, '_GRID_REGISTRY', None)
+    return tmp_path
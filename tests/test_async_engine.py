@@ -0,0 +1,106 @@
+import os
+import asyncio
+import threading
+import pytest
+aiohttp = pytest.importorskip('aiohttp')
+from aiohttp import web
+import async_engine
+
+
+class StubConfig:
+    download_timeout_seconds = 30
+
+
+class StubSessionManager:
+    config = StubConfig()
+    token = 'token'
+
+
+class StubServer:
+    '''
+    Stand-in for the process API, counts the requests in flight
+    '''
+    def __init__(self, delay=0.05):
+        self.delay = delay
+        self.in_flight = 0
+        self.peak = 0
+
+    async def handle(self, request):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if request.path == '/drop':
+                response = web.StreamResponse()
+                response.content_length = 1000
+                await response.prepare(request)
+                await response.write(b'x' * 10)
+                request.transport.close()
+                return response
+            return web.Response(body=request.path.encode() * 100)
+        finally:
+            self.in_flight -= 1
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_post('/{name}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        return f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+
+def make_job(url, tmp_path, name):
+    return {
+        'job_id': name, 'url': f'{url}/{name}', 'payload': {}, 'headers': {}, 'request_params': {},
+        'request_path': None, 'response_path': str(tmp_path / name / 'response.tiff'),
+    }
+
+
+def run_engine(tmp_path, names, max_concurrency, progress_callback=None, jobs_thread=None):
+    server = StubServer()
+
+    async def main():
+        url = await server.start()
+        try:
+            def iter_jobs():
+                for name in names:
+                    if jobs_thread is not None:
+                        jobs_thread.append(threading.get_ident())
+                    yield make_job(url, tmp_path, name)
+            engine = async_engine.AsyncDownloadEngine(StubSessionManager(), max_concurrency=max_concurrency)
+            return await engine.download_jobs(iter_jobs(), progress_callback=progress_callback), threading.get_ident()
+        finally:
+            await server.runner.cleanup()
+
+    results, loop_thread = asyncio.run(main())
+    return server, results, loop_thread
+
+
+def test_engine_reaches_its_concurrency_above_the_shared_limit(tmp_path):
+    names = [f'job{i}' for i in range(200)]
+    server, results, _ = run_engine(tmp_path, names, max_concurrency=64)
+    assert [result['job_id'] for result in results] == names
+    assert all(result['status'] == 'done' for result in results)
+    assert 32 < server.peak <= 64
+
+
+def test_jobs_are_prepared_off_the_event_loop(tmp_path):
+    jobs_thread = []
+    _, _, loop_thread = run_engine(tmp_path, ['a', 'b', 'c'], max_concurrency=2, jobs_thread=jobs_thread)
+    assert len(jobs_thread) == 3 and loop_thread not in jobs_thread
+
+
+def test_dropped_download_leaves_no_partial_file(tmp_path):
+    _, results, _ = run_engine(tmp_path, ['ok', 'drop'], max_concurrency=2)
+    assert [result['status'] for result in results] == ['done', 'failed']
+    assert os.listdir(tmp_path / 'drop') == []
+
+
+def test_progress_callback_error_stops_the_download(tmp_path):
+    def progress_callback(result, finished):
+        raise RuntimeError('callback failed')
+
+    with pytest.raises(RuntimeError, match='callback failed'):
+        run_engine(tmp_path, [f'job{i}' for i in range(50)], max_concurrency=2, progress_callback=progress_callback)
@@ -0,0 +1,33 @@
+import numpy as np
+from shapely.geometry import box
+import cloud_gate
+
+POLYGON = box(32.0, 15.0, 32.05, 15.05)
+LOCATION = 'test'
+
+
+def make_probe_fn(cached_dates=(), failed_dates=()):
+    def probe_fn(job):
+        if job['date'] in failed_dates:
+            raise RuntimeError('probe failed')
+        return np.full((4, 4), 0.9, dtype=np.float32), job['date'] not in cached_dates
+    return probe_fn
+
+
+def test_only_sent_probes_are_counted():
+    dates = ['2023-01-01', '2023-01-06', '2023-01-11']
+    gate = cloud_gate.CloudGate(probe_fn=make_probe_fn(cached_dates=['2023-01-06'], failed_dates=['2023-01-11']))
+    probes = gate.probe(POLYGON, dates, LOCATION, max_workers=2)
+    assert probes['2023-01-01']['overcast'] and probes['2023-01-06']['overcast']
+    assert probes['2023-01-11'] is None
+    report = gate.get_report()
+    assert report['probe_requests'] == 1
+    assert report['probe_failures'] == 1
+    assert report['probe_bytes'] == cloud_gate.estimate_response_bytes(POLYGON, 'CLP', gate.probe_resolution)
+
+
+def test_dates_are_probed_once():
+    gate = cloud_gate.CloudGate(probe_fn=make_probe_fn())
+    gate.probe(POLYGON, ['2023-01-01'], LOCATION)
+    gate.probe(POLYGON, ['2023-01-01'], LOCATION)
+    assert gate.get_report()['probe_requests'] == 1
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import rasterio
+from rasterio.transform import from_bounds
+import datacube_store
+import pixel_table
+
+DATES = ['2023-06-01', '2023-07-16']
+
+
+def write_response(path, seed):
+    values = np.random.default_rng(seed).uniform(0, 1, (13, 5, 7)).astype(np.float32)
+    profile = {'driver': 'GTiff', 'width': 7, 'height': 5, 'count': 13, 'dtype': 'float32', 'crs': 'EPSG:4326',
+               'transform': from_bounds(32.0, 15.0, 32.007, 15.005, 7, 5)}
+    with rasterio.open(path, 'w', **profile) as img:
+        img.write(values)
+
+
+def test_datacube_table_lines_up_with_the_geotiff_table(project_dir):
+    tables = []
+    for i, date in enumerate(DATES):
+        path = str(project_dir / f'{date}.tiff')
+        write_response(path, i)
+        datacube_store.append_to_datacube('square', 'ALL', date, path)
+        with rasterio.open(path) as img:
+            table = pixel_table.image_as_pixel_table(img, datacube_store.ALL_BANDS_NAMES)
+        table.columns = [col if col in pixel_table.GRID_COLUMNS else f'{col}_{date}' for col in table.columns]
+        tables.append(table.drop(columns=pixel_table.GRID_COLUMNS) if i > 0 else table)
+    expected = pd.concat(tables, axis=1)
+    expected = expected[[col for col in expected.columns if col not in pixel_table.GRID_COLUMNS] + pixel_table.GRID_COLUMNS]
+    table = datacube_store.datacube_to_table(datacube_store.open_datacube('square', 'ALL'))
+    pd.testing.assert_frame_equal(table, expected)
+
+
+def test_datacube_selection_keeps_its_grid_offsets(project_dir):
+    path = str(project_dir / 'response.tiff')
+    write_response(path, 0)
+    datacube_store.append_to_datacube('square', 'ALL', DATES[0], path)
+    values = datacube_store.open_datacube('square', 'ALL').isel(y=slice(1, 3), x=slice(2, 6))
+    table = datacube_store.datacube_to_table(values)
+    with rasterio.open(path) as img:
+        full = pixel_table.image_as_pixel_table(img, datacube_store.ALL_BANDS_NAMES)
+    full = full[(full['row'] >= 1) & (full['row'] < 3) & (full['col'] >= 2) & (full['col'] < 6)].reset_index(drop=True)
+    assert table[pixel_table.GRID_COLUMNS].equals(full[pixel_table.GRID_COLUMNS])
+    np.testing.assert_array_equal(table[f'B04_{DATES[0]}'].values, full['B04'].values)
@@ -0,0 +1,130 @@
+import json
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+from sentinelhub import SHConfig, DownloadRequest, MimeType
+from sentinelhub.constants import RequestType
+import download_scheduler
+import sh_session
+
+
+class StubServer(ThreadingHTTPServer):
+    '''
+    Stand-in for the Sentinel Hub API, counts the requests in flight per Host header and the
+    client connections it accepted
+    '''
+    daemon_threads = True
+
+    def __init__(self, delay=0.05):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.peak = {}
+        self.connections = set()
+
+    def url(self, host='127.0.0.1'):
+        return f'http://{host}:{self.server_port}'
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        host = self.headers['Host']
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.in_flight[host] = server.in_flight.get(host, 0) + 1
+            server.peak[host] = max(server.peak.get(host, 0), server.in_flight[host])
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight[host] -= 1
+        body = json.dumps({'path': self.path}).encode()
+        self.send_response(500 if self.path.endswith('/fail') else 200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(pool_size):
+    config = SHConfig()
+    config.max_download_attempts = 1
+    manager = sh_session.SessionManager(config, pool_size=pool_size)
+    return sh_session.PooledDownloadClient(http_session=manager.http_session, config=config)
+
+
+def post_with_session(http_session):
+    def download(job):
+        response = http_session.post(job['url'], json={})
+        response.raise_for_status()
+        return response.json()
+    return download
+
+
+def make_jobs(urls):
+    return [{'job_id': f'job{i}', 'url': url} for i, url in enumerate(urls)]
+
+
+def download_with_client(client):
+    def download(job):
+        request = DownloadRequest(url=job['url'], request_type=RequestType.POST, post_values={}, data_type=MimeType.JSON, use_session=False)
+        return client.download([request])[0]
+    return download
+
+
+def test_requests_to_one_host_stay_within_max_per_host(server):
+    http_session = sh_session.SessionManager(SHConfig(), pool_size=16).http_session
+    jobs = make_jobs([f'{server.url()}/{i}' for i in range(40)])
+    results = download_scheduler.run_download_jobs(jobs, download_fn=post_with_session(http_session), max_workers=16, max_per_host=3)
+    assert [result['status'] for result in results] == ['done'] * len(jobs)
+    assert [result['result']['path'] for result in results] == [f'/{i}' for i in range(40)]
+    assert server.peak == {f'127.0.0.1:{server.server_port}': 3}
+
+
+def test_host_limits_apply_per_host(server):
+    http_session = sh_session.SessionManager(SHConfig(), pool_size=16).http_session
+    urls = [f'{server.url(host)}/{i}' for i in range(20) for host in ['127.0.0.1', 'localhost']]
+    host_limits = {f'localhost:{server.server_port}': 1}
+    download_scheduler.run_download_jobs(make_jobs(urls), download_fn=post_with_session(http_session), max_workers=16, max_per_host=4, host_limits=host_limits)
+    assert server.peak == {f'127.0.0.1:{server.server_port}': 4, f'localhost:{server.server_port}': 1}
+
+
+def test_pooled_client_stays_within_max_per_host(server):
+    client = make_client(pool_size=16)
+    jobs = make_jobs([f'{server.url()}/{i}' for i in range(40)])
+    results = download_scheduler.run_download_jobs(jobs, download_fn=download_with_client(client), max_workers=16, max_per_host=3)
+    assert [result['result']['path'] for result in results] == [f'/{i}' for i in range(40)]
+    assert 0 < server.peak[f'127.0.0.1:{server.server_port}'] <= 3
+
+
+def test_pooled_session_reuses_its_connections(server):
+    client = make_client(pool_size=4)
+    jobs = make_jobs([f'{server.url()}/{i}' for i in range(40)])
+    download_scheduler.run_download_jobs(jobs, download_fn=download_with_client(client), max_workers=4, max_per_host=4)
+    # One keep-alive connection per worker instead of one per request
+    assert len(server.connections) <= 4
+
+
+def test_failed_job_does_not_stop_the_others(server):
+    client = make_client(pool_size=4)
+    jobs = make_jobs([f'{server.url()}/{i}' for i in range(5)] + [f'{server.url()}/fail'])
+    results = download_scheduler.run_download_jobs(jobs, download_fn=download_with_client(client), max_workers=4, max_per_host=4)
+    assert [result['status'] for result in results] == ['done'] * 5 + ['failed']
+    assert results[-1]['error'] is not None
@@ -0,0 +1,76 @@
+import os
+import shutil
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_bounds
+import biophysical
+import download_index
+import pixel_table
+import spectral_indices
+
+HEIGHT, WIDTH = 6, 8
+DATES = ['2023-06-01', '2023-07-16']
+
+
+def write_all_response(date, location='square', identifier='abc123'):
+    '''
+    Save a random 13-band ALL response where the downloader puts it, with one no-data pixel
+    '''
+    response_path = os.path.join(download_index.SATELLITE_IMAGES_DIR, date, location, 'ALL', identifier, 'response.tiff')
+    os.makedirs(os.path.dirname(response_path))
+    values = np.random.default_rng(0).uniform(0.01, 0.4, (13, HEIGHT, WIDTH)).astype(np.float32)
+    values[:, 0, 0] = 0
+    profile = {'driver': 'GTiff', 'width': WIDTH, 'height': HEIGHT, 'count': 13, 'dtype': 'float32', 'crs': 'EPSG:4326',
+               'transform': from_bounds(32.0, 15.0, 32.001, 15.001, WIDTH, HEIGHT)}
+    with rasterio.open(response_path, 'w', **profile) as img:
+        img.write(values)
+    return response_path
+
+
+def test_computed_fcover_is_indexed_under_its_name(project_dir):
+    response_path = write_all_response(DATES[0])
+    index = download_index.get_download_index()
+    assert len(index.query(evalscript='FCOVER')) == 0
+    product_path = biophysical.compute_network_raster(response_path, 'FCOVER', DATES[0])
+    rows = index.query(evalscript='FCOVER')
+    assert rows[['date', 'location', 'identifier', 'file_name']].values.tolist() == [[DATES[0], 'square', 'abc123', 'indices/FCOVER.tif']]
+    assert os.path.samefile(download_index.get_entry_path(rows.iloc[0]), product_path)
+    with rasterio.open(download_index.get_entry_path(rows.iloc[0])) as img:
+        table = pixel_table.image_as_pixel_table(img, ['FCOVER'])
+    assert len(table) == HEIGHT * WIDTH
+    assert np.isnan(table['FCOVER'].iloc[0]) and table['FCOVER'].iloc[1:].notna().all()
+
+
+def test_computed_spectral_products_are_indexed_under_their_name(project_dir):
+    response_path = write_all_response(DATES[0])
+    spectral_indices.compute_product_rasters(response_path, ['NDVI', 'TRUECOLOR'])
+    index = download_index.get_download_index()
+    for name in ['NDVI', 'TRUECOLOR']:
+        rows = index.query(evalscript=name)
+        assert rows['file_name'].tolist() == [f'indices/{name}.tif']
+        assert os.path.samefile(download_index.get_entry_path(rows.iloc[0]), spectral_indices.get_product_path(response_path, name))
+
+
+def test_reconcile_finds_and_drops_products(project_dir):
+    response_path = write_all_response(DATES[0])
+    product_path = biophysical.compute_network_raster(response_path, 'FCOVER', DATES[0])
+    # A fresh index file only learns about the product from the image tree
+    index = download_index.DownloadIndex(path=str(project_dir / 'other.sqlite'))
+    assert len(index.query(evalscript='FCOVER')) == 1
+    shutil.rmtree(os.path.dirname(product_path))
+    index.reconcile()
+    assert len(index.query(evalscript='FCOVER')) == 0
+    assert len(index.query(evalscript='ALL')) == 1
+
+
+@pytest.mark.parametrize('evalscript, columns', [('FCOVER', ['FCOVER']), ('NDVI', ['NDVI']), ('TRUECOLOR', ['TRUECOLOR_0', 'TRUECOLOR_1', 'TRUECOLOR_2'])])
+def test_training_data_reads_products_computed_from_all(project_dir, evalscript, columns):
+    for module in ['streamlit', 'streamlit_folium', 'folium', 'matplotlib']:
+        pytest.importorskip(module)
+    import data_reader
+    for date in DATES:
+        write_all_response(date)
+    training_data = data_reader.get_training_data_evalscript(location='square', evalscript=evalscript, dates=DATES, year='2023')
+    assert [f'{col}_{date}' for date in DATES for col in columns] == [col for col in training_data.columns if col.startswith(evalscript)]
+    assert len(training_data) == HEIGHT * WIDTH
@@ -0,0 +1,34 @@
+import os
+import numpy as np
+import pytest
+import rasterio
+import tiling
+
+BBOX = [32.0, 15.0, 32.01, 15.006]
+SIZE = (10, 6)
+
+
+def make_fetch_tile(source, fail_at=None):
+    def fetch_tile(tile):
+        if (tile['row_offset'], tile['col_offset']) == fail_at:
+            raise RuntimeError('tile failed')
+        width, height = tile['size']
+        return source[tile['row_offset']:tile['row_offset'] + height, tile['col_offset']:tile['col_offset'] + width]
+    return fetch_tile
+
+
+def test_mosaic_matches_the_source(tmp_path):
+    source = np.arange(SIZE[0] * SIZE[1] * 2, dtype=np.float32).reshape(SIZE[1], SIZE[0], 2)
+    tiles = tiling.get_tile_grid(BBOX, SIZE, max_tile_size=4)
+    file_path = tiling.build_mosaic_geotiff(tiles, make_fetch_tile(source), BBOX, SIZE, str(tmp_path / 'mosaic.tif'), max_workers=2)
+    with rasterio.open(file_path) as img:
+        np.testing.assert_array_equal(np.moveaxis(img.read(), 0, -1), source)
+    assert os.listdir(tmp_path) == ['mosaic.tif']
+
+
+def test_failed_tile_removes_the_temporary_mosaic(tmp_path):
+    source = np.ones((SIZE[1], SIZE[0]), dtype=np.float32)
+    tiles = tiling.get_tile_grid(BBOX, SIZE, max_tile_size=4)
+    with pytest.raises(RuntimeError, match='tile failed'):
+        tiling.build_mosaic_geotiff(tiles, make_fetch_tile(source, fail_at=(4, 4)), BBOX, SIZE, str(tmp_path / 'mosaic.tif'), max_workers=1)
+    assert os.listdir(tmp_path) == []
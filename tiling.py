@@ -0,0 +1,143 @@
+import os
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# Sentinel Hub process API limit on the width and height of a single request, in pixels
+MAX_TILE_SIZE = 2500
+
+
+def get_tile_grid(bbox, size, max_tile_size=MAX_TILE_SIZE):
+    '''
+    Split a bbox into pixel-aligned sub-tiles no bigger than max_tile_size pixels per side.
+    All the tiles share the pixel grid of the full bbox, so they mosaic without resampling.
+    args:
+        bbox: [min_x, min_y, max_x, max_y] of the full area
+        size: (width, height) of the full area in pixels
+        max_tile_size: the maximum width and height of a tile in pixels
+    return:
+        tiles: a list of dictionaries with the tile bbox, size and its row/col offset in the mosaic
+    '''
+    min_x, min_y, max_x, max_y = bbox
+    width, height = size
+    pixel_width = (max_x - min_x) / width
+    pixel_height = (max_y - min_y) / height
+    tiles = []
+    for row_start in range(0, height, max_tile_size):
+        row_end = min(row_start + max_tile_size, height)
+        for col_start in range(0, width, max_tile_size):
+            col_end = min(col_start + max_tile_size, width)
+            tile_bbox = [
+                min_x + col_start * pixel_width,
+                max_y - row_end * pixel_height,
+                min_x + col_end * pixel_width,
+                max_y - row_start * pixel_height,
+            ]
+            tiles.append({
+                'bbox': tile_bbox,
+                'size': (col_end - col_start, row_end - row_start),
+                'row_offset': row_start,
+                'col_offset': col_start,
+            })
+    return tiles
+
+
+def as_band_last(image):
+    image = np.asarray(image)
+    if image.ndim == 2:
+        image = image[:, :, np.newaxis]
+    return image
+
+
+def open_mosaic_geotiff(file_path, bbox, size, bands, dtype, crs='EPSG:4326'):
+    '''
+    Create an empty tiled GeoTIFF with the geotransform of the full bbox
+    args:
+        file_path: where to save the GeoTIFF
+        bbox: [min_x, min_y, max_x, max_y] of the full area
+        size: (width, height) of the full area in pixels
+        bands: the number of bands
+        dtype: the data type of the bands
+        crs: the crs of the bbox
+    return:
+        dst: the rasterio dataset opened for writing
+    '''
+    width, height = size
+    min_x, min_y, max_x, max_y = bbox
+    transform = from_origin(min_x, max_y, (max_x - min_x) / width, (max_y - min_y) / height)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    return rasterio.open(
+        file_path, 'w', driver='GTiff',
+        height=height, width=width, count=bands, dtype=dtype,
+        crs=crs, transform=transform,
+        tiled=True, compress='deflate', BIGTIFF='IF_SAFER',
+    )
+
+
+def write_tile(dst, tile, image):
+    '''
+    Write a downloaded tile at its offset in the mosaic
+    '''
+    image = as_band_last(image)
+    tile_width, tile_height = tile['size']
+    window = Window(tile['col_offset'], tile['row_offset'], tile_width, tile_height)
+    data = image[:tile_height, :tile_width, :].transpose(2, 0, 1)
+    dst.write(data, window=window)
+
+
+def build_mosaic_geotiff(tiles, fetch_tile, bbox, size, file_path, max_workers=8):
+    '''
+    Fetch the tiles in parallel and write each one into a single GeoTIFF as soon as it arrives.
+    At most max_workers tiles are submitted at a time and each finished tile is dropped once written,
+    so only the in-flight tiles are held in memory. The file is written under a temporary name
+    and moved in place once every tile is written, the temporary file is removed if a tile fails.
+    args:
+        tiles: the tiles returned by get_tile_grid
+        fetch_tile: a function taking a tile and returning its image array (height, width[, bands])
+        bbox: [min_x, min_y, max_x, max_y] of the full area
+        size: (width, height) of the full area in pixels
+        file_path: where to save the mosaic
+        max_workers: the number of tiles fetched in parallel
+    return:
+        file_path: the saved file path
+    '''
+    tmp_path = file_path + '.tmp'
+    dst = None
+    remaining = iter(tiles)
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {}
+            for tile in remaining:
+                futures[executor.submit(fetch_tile, tile)] = tile
+                if len(futures) >= max_workers:
+                    break
+            while len(futures) > 0:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    tile = futures.pop(future)
+                    image = as_band_last(future.result())
+                    if dst is None:
+                        # The band count and dtype of the mosaic are those of the first tile to arrive
+                        dst = open_mosaic_geotiff(tmp_path, bbox, size, image.shape[2], image.dtype)
+                    write_tile(dst, tile, image)
+                    del image
+                    next_tile = next(remaining, None)
+                    if next_tile is not None:
+                        futures[executor.submit(fetch_tile, next_tile)] = next_tile
+                del done
+    except BaseException:
+        # A failed tile leaves an incomplete mosaic, it must not stay beside the file
+        if dst is not None:
+            dst.close()
+            dst = None
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        if dst is not None:
+            dst.close()
+    os.replace(tmp_path, file_path)
+    return file_path
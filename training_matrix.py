@@ -0,0 +1,159 @@
+import os
+import json
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+import pixel_table
+import evalscript_registry
+
+
+TRAINING_MATRICES_DIR = './data/training_matrices'
+DEFAULT_MAX_WINDOW_BYTES = 64 * 2**20
+ALL_BANDS_NAMES = ["B01", "B02", "B03", "B04", "B05", "B06", "B07", "B08", "B8A", "B09", "B10", "B11", "B12"]
+
+
+def get_matrix_dir(location, year, evalscript, matrices_dir=TRAINING_MATRICES_DIR):
+    '''
+    Folder of the training matrix of a location, named after the evalscript version it comes from
+    '''
+    file_name = evalscript_registry.get_artifact_file_name('training_matrix', evalscript, 'npy')
+    return os.path.join(matrices_dir, f'{location}_{year}', os.path.splitext(file_name)[0])
+
+
+def has_training_matrix(output_dir):
+    return all(os.path.exists(os.path.join(output_dir, name)) for name in ['features.npy', 'labels.npy', 'pixel_index.npy', 'row_order.npy', 'schema.json'])
+
+
+def get_bands_names(script, count):
+    if script == 'ALL' and count == len(ALL_BANDS_NAMES):
+        return ALL_BANDS_NAMES
+    if count == 1:
+        return [script]
+    return [f'{script}_{i}' for i in range(count)]
+
+
+def get_row_windows(img, max_window_bytes=DEFAULT_MAX_WINDOW_BYTES):
+    row_bytes = img.width * img.count * np.dtype(img.dtypes[0]).itemsize
+    rows_per_window = max(1, int(max_window_bytes // max(1, row_bytes)))
+    return [Window(0, row_off, img.width, min(rows_per_window, img.height - row_off)) for row_off in range(0, img.height, rows_per_window)]
+
+
+def get_window_coordinates(transform, window):
+    row_off, col_off = int(window.row_off), int(window.col_off)
+    cols, rows = np.meshgrid(
+        np.arange(col_off, col_off + int(window.width), dtype=np.float64) + 0.5,
+        np.arange(row_off, row_off + int(window.height), dtype=np.float64) + 0.5,
+    )
+    longitudes = transform.a * cols + transform.b * rows + transform.c
+    latitudes = transform.d * cols + transform.e * rows + transform.f
+    return longitudes.ravel(), latitudes.ravel()
+
+
+def build_training_matrix(image_paths, output_dir, script='ALL', labels_fn=None, keep_unlabelled=False,
+                          seed=0, max_window_bytes=DEFAULT_MAX_WINDOW_BYTES):
+    '''
+    Write the pixels of several dates straight from the rasters into a preallocated float32
+    (n_pixels, n_dates x n_bands) memory-mapped array, with a labels vector and a json schema beside it.
+    Rows are written in pixel order, so every window is one sequential write. The shuffle is
+    a separate permutation of the rows, row_order.npy, applied when the matrix is split.
+    args:
+        image_paths: a dictionary of date -> image path, the images share the same grid
+        output_dir: the folder receiving features.npy, labels.npy, pixel_index.npy, row_order.npy and schema.json
+        script: the evalscript of the images, used to name the bands
+        labels_fn: optional function taking (longitudes, latitudes) arrays and returning the pixel labels
+        keep_unlabelled: keep the pixels labelled -1, only used with labels_fn
+        seed: the seed of the row_order permutation
+        max_window_bytes: the memory ceiling of the window read from one raster at a time
+    return:
+        schema: the schema written to schema.json
+    '''
+    dates = sorted(image_paths.keys())
+    os.makedirs(output_dir, exist_ok=True)
+    if os.path.exists(os.path.join(output_dir, 'schema.json')):
+        os.remove(os.path.join(output_dir, 'schema.json'))
+    with rasterio.open(image_paths[dates[0]]) as img:
+        grid = pixel_table.get_grid(img)
+        windows = get_row_windows(img, max_window_bytes)
+        n_pixels = img.width * img.height
+        # First pass on the coordinates only, to know which pixels are kept before allocating
+        labels = np.full(n_pixels, -1, dtype=np.int8)
+        if labels_fn is not None:
+            for window in windows:
+                start = int(window.row_off) * img.width
+                longitudes, latitudes = get_window_coordinates(img.transform, window)
+                labels[start:start + len(longitudes)] = labels_fn(longitudes, latitudes)
+    if labels_fn is None or keep_unlabelled:
+        kept = np.arange(n_pixels, dtype=np.int64)
+    else:
+        kept = np.flatnonzero(labels != -1)
+
+    columns = []
+    counts = {}
+    for date in dates:
+        with rasterio.open(image_paths[date]) as img:
+            if pixel_table.get_grid(img) != grid:
+                raise Exception(f'The image of {date} is not on the grid of {dates[0]}')
+            counts[date] = img.count
+            columns.extend(f'{band}_{date}' for band in get_bands_names(script, img.count))
+    features = np.lib.format.open_memmap(os.path.join(output_dir, 'features.npy'), mode='w+', dtype=np.float32, shape=(len(kept), len(columns)))
+    # The kept pixels of a window are a contiguous block of rows, kept is sorted
+    window_starts = [int(window.row_off) * grid['width'] for window in windows] + [n_pixels]
+    row_bounds = np.searchsorted(kept, window_starts)
+    col_off = 0
+    for date in dates:
+        with rasterio.open(image_paths[date]) as img:
+            for i, window in enumerate(windows):
+                values = img.read(window=window).reshape(img.count, -1).T
+                window_pixels = kept[row_bounds[i]:row_bounds[i + 1]] - window_starts[i]
+                features[row_bounds[i]:row_bounds[i + 1], col_off:col_off + img.count] = values[window_pixels]
+        col_off += counts[date]
+    features.flush()
+    del features
+
+    np.save(os.path.join(output_dir, 'labels.npy'), labels[kept])
+    np.save(os.path.join(output_dir, 'pixel_index.npy'), kept)
+    np.save(os.path.join(output_dir, 'row_order.npy'), np.random.default_rng(seed).permutation(len(kept)))
+    schema = {
+        'columns': columns,
+        'shape': [len(kept), len(columns)],
+        'dtype': 'float32',
+        'script': script,
+        'dates': dates,
+        'grid': grid,
+        'labelled': labels_fn is not None,
+        'keep_unlabelled': keep_unlabelled,
+        'seed': seed,
+    }
+    # The schema is written last, a matrix without it is incomplete
+    temp_path = os.path.join(output_dir, 'schema.json.tmp')
+    with open(temp_path, 'w') as f:
+        json.dump(schema, f, indent=2)
+    os.replace(temp_path, os.path.join(output_dir, 'schema.json'))
+    return schema
+
+
+def load_training_matrix(output_dir):
+    '''
+    Open a matrix written by build_training_matrix without reading it into memory
+    return:
+        features: a read-only float32 memmap of shape (n_pixels, n_columns), rows in pixel order
+        labels: the int8 labels of the rows
+        schema: the sidecar schema with the column names, and the row_order permutation of the rows
+    '''
+    with open(os.path.join(output_dir, 'schema.json')) as f:
+        schema = json.load(f)
+    schema['row_order'] = np.load(os.path.join(output_dir, 'row_order.npy'))
+    features = np.load(os.path.join(output_dir, 'features.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(output_dir, 'labels.npy'))
+    return features, labels, schema
+
+
+def get_pixel_rows_cols(output_dir, schema=None):
+    '''
+    Row and column of every row of the matrix in the image grid, to map predictions back to pixels
+    '''
+    if schema is None:
+        with open(os.path.join(output_dir, 'schema.json')) as f:
+            schema = json.load(f)
+    pixel_index = np.load(os.path.join(output_dir, 'pixel_index.npy'))
+    return np.divmod(pixel_index, schema['grid']['width'])